@@ -1,17 +1,28 @@
 """Chaim Account Audit Slack application."""
 
 import json
-from operator import itemgetter
 import os
 import time
 
-import boto3
-from chalice import Chalice
-import requests
-from tabulate import tabulate
-from urllib.parse import unquote
+from chalice import Chalice, Rate, Response
 
-from chalicelib.permissions import Permissions
+from chalicelib.resilience import call, limit, setDeadline
+from chalicelib.slackrequest import (
+    InvalidSignature,
+    decodeForm,
+    decodeMessage,
+    signedHeaders,
+    verifyRequest,
+)
+from chalicelib.tracing import addStage, endTrace, span, startTrace
+from chalicelib.utils import Utils
+from chalicelib.warmup import httpSession, permissions, prime, snsClient
+
+# Both lambdas load this module. The database, rendering and http modules
+# (pymysql, tabulate, requests) are imported by the handlers that use them
+# so that the acknowledgement route stays within its memory budget,
+# see chaimaccountaudit/membench.py. keepWarm has them imported ahead of the
+# first audit, see chalicelib/warmup.py
 
 
 class SlackSendFail(Exception):
@@ -36,26 +47,18 @@ class NoData(Exception):
 
 app = Chalice(app_name="chaimaccountaudit")
 
+# users per page of Block Kit output
+PAGESIZE = 25
 
-def splitQS(req):
-    """Splits query string into key value pairs."""
-    try:
-        r = {}
-        # ensure the query string is unquoted
-        qs = unquote(req)
-        # split at the ampersand, returns a 1 element list if there is no &
-        bits = qs.split("&")
-        for bit in bits:
-            # split into key/value
-            k, v = bit.split("=")
-            # strip external whitespace/newlines from
-            # key and value and store in dictionary
-            r[k.strip()] = v.strip()
-        return r
-    except Exception as e:
-        msg = f"Exception in splitQS: {type(e).__name__}: {e}"
-        print(msg)
-        raise
+# slack accepts at most this many messages to a response_url
+MAXRESPONSES = 5
+
+# seconds to wait for slack to answer a post to a response_url, less if
+# the invocation's deadline is nearer
+SLACKTIMEOUT = float(os.environ.get("SLACKTIMEOUT", 5))
+
+# sent when an audit fails rather than leaving the user with no answer
+DEGRADED = "Sorry, chaim account audit couldn't finish that, please try again shortly."
 
 
 def getEnvParam(param):
@@ -72,14 +75,33 @@ def getEnvParam(param):
 
 def publishToSNS(topicarn, snsmsg):
     try:
-        sns = boto3.client("sns")
-        sns.publish(TopicArn=topicarn, Message=snsmsg)
+        with span("sns_publish"):
+            snsClient().publish(TopicArn=topicarn, Message=snsmsg)
     except Exception as e:
         msg = f"Exception in publishToSNS: {type(e).__name__}: {e}"
         print(msg)
         raise
 
 
+def postToSlack(respondurl, data):
+    """
+    Posts to a slack response_url, retrying connection failures, timeouts
+    and 429/5xx answers through the slack circuit breaker.
+    """
+    import requests
+
+    def post():
+        timeout = limit(SLACKTIMEOUT)
+        r = httpSession().post(respondurl, data=data, timeout=timeout)
+        if r.status_code == 429 or r.status_code >= 500:
+            raise SlackSendFail(f"status: {r.status_code}, text: {r.text}")
+        return r
+
+    retryon = (requests.ConnectionError, requests.Timeout, SlackSendFail)
+    with span("slack_post"):
+        return call("slack", post, retryon=retryon, timeout=SLACKTIMEOUT)
+
+
 def sendToSlack(respondurl, msg):
     """
     Send messages back to Slack
@@ -91,7 +113,7 @@ def sendToSlack(respondurl, msg):
         if respondurl != "ignoreme":
             if len(msg) > 0:
                 params = json.dumps(output(None, msg))
-                r = requests.post(respondurl, data=params)
+                r = postToSlack(respondurl, params)
                 if 200 != r.status_code:
                     emsg = "Failed to send back to initiating Slack channel"
                     emsg += ". status: {}, text: {}".format(r.status_code, r.text)
@@ -102,6 +124,31 @@ def sendToSlack(respondurl, msg):
         raise
 
 
+def sendBlocksToSlack(respondurl, text, blocks, replace=False):
+    """
+    Send a Block Kit message back to Slack
+
+    :param respondurl: the url to send back to
+    :param text: the fallback text for notifications
+    :param blocks: the blocks to display
+    :param replace: replace the message that the response_url came from
+    """
+    try:
+        if respondurl != "ignoreme":
+            params = {"response_type": "ephemeral", "text": text, "blocks": blocks}
+            if replace:
+                params["replace_original"] = True
+            r = postToSlack(respondurl, json.dumps(params))
+            if 200 != r.status_code:
+                emsg = "Failed to send back to initiating Slack channel"
+                emsg += ". status: {}, text: {}".format(r.status_code, r.text)
+                raise (SlackSendFail(emsg))
+    except Exception as e:
+        msg = f"Send blocks to Slack Failed: {e}"
+        print(msg)
+        raise
+
+
 def output(err, res=None, attachments=None):
     """Build the output string to return to slack."""
     try:
@@ -136,215 +183,260 @@ def makeAttachments(attachments, pretext=None):
         raise
 
 
-def chaimLastUsed(username, pms):
-    """returns the number of days since the user last used chaim."""
-    try:
-        sql = f"""
-        select lastslack
-        from
-        awsusers
-        where
-        name='{username}';
-        """
-        lastused = pms.sid.query(sql)[0][0]
-        if lastused == 0:
-            days = "Has never used chaim"
-        else:
-            now = int(time.time())
-            xlen = now - lastused
-            days = int(xlen / 86400)
-        return days
-    except Exception as e:
-        msg = f"Exception in chaimLastUsed: {type(e).__name__}: {e}"
-        print(msg)
-        raise
+def profileWanted(text):
+    """Profiling is on by CHAIMPROFILE or the hidden --profile flag."""
+    if os.environ.get("CHAIMPROFILE", "0") not in ("", "0"):
+        return True
+    return "--profile" in text.split()
 
 
-def listGroupMembers(group, pms):
-    try:
-        sql = f"""
-        select u.name as name
-        from
-        groupusermap g, awsusers u, awsgroups f
-        where
-        u.id=g.userid
-        and g.groupid=f.id
-        and f.name='{group}';
-        """
-        name = 0
-        rows = pms.sid.query(sql)
-        return [row[name] for row in rows]
-    except Exception as e:
-        msg = f"Exception in listGroupMembers: {type(e).__name__}: {e}"
-        print(msg)
-        raise
+def lambdaDeadline(context):
+    """epoch seconds at which this invocation times out, None if unknown"""
+    if context is None:
+        return None
+    return time.time() + context.get_remaining_time_in_millis() / 1000
 
 
-def getAccountUsers(account, pms):
-    try:
-        sql = f"""
-        select
-        a.id as aid, a.name as aname, u.name as uname, r.name as rname, r.id as rid
-        from
-        useracctrolemap x, awsusers u, awsaccounts a, awsroles r
-        where
-        a.name='{account}'
-        and u.id=x.userid
-        and a.id=x.accountid
-        and r.id=x.roleid
-        order by u.name,r.id;
-        """
-        aid = 0
-        aname = 1
-        uname = 2
-        rname = 3
-        rid = 4
-        fields = ["aid", "aname", "uname", "rname", "rid"]
-        rows = pms.sid.query(sql)
-        op = {}
-        for row in rows:
-            if row[uname] not in op:
-                op[row[uname]] = []
-            # remove CrossAccount from the role name
-            rdict = {"rname": row[rname].replace("CrossAccount", "")}
-            # Ensure the basic roles are the last in the sorted list of user roles
-            rdict["rid"] = row[rid] * 100 if row[rid] < 101 else row[rid]
-            op[row[uname]].append(rdict)
-        return sortData(op)
-    except Exception as e:
-        msg = f"Exception in getAccountUsers: {type(e).__name__}: {e}"
-        print(msg)
-        raise
+def sendSections(respondurl, sections):
+    """
+    Sends each section of a report as soon as it is rendered, the footer
+    (the section with no heading) with the one before it. Slack takes at
+    most MAXRESPONSES messages per response_url, so once only one is left
+    the remaining sections all go in it.
+    """
+    from chalicelib.audit import displaySections
 
+    sent = 1  # the title
+    pending = []
+    for section in sections:
+        if section[0] is not None and len(pending) > 0 and sent < MAXRESPONSES - 1:
+            sendToSlack(respondurl, f"```{displaySections(pending)}```")
+            sent += 1
+            pending = []
+        pending.append(section)
+    if len(pending) > 0:
+        sendToSlack(respondurl, f"```{displaySections(pending)}```")
 
-def sortData(rows):
-    try:
-        op = {}
-        for name in rows:
-            op[name] = sorted(rows[name], key=itemgetter("rid"))
-        return op
-    except Exception as e:
-        msg = f"Exception in sortData: {type(e).__name__}: {e}"
-        print(msg)
-        raise
 
+def progressiveAudit(respondurl, account, pms):
+    """
+    Audits an account, sending the title as soon as the account is found
+    and then each usage section as it is rendered. The messages are sent
+    one after the other over the same connection, so they arrive in order.
+
+    returns [accountid, snapshot]
+    """
+    from chalicelib.audit import (
+        accountGroups,
+        accountTitle,
+        getAccountUsers,
+        iterSections,
+        resolveAccount,
+    )
+    from chalicelib.snapshot import makeSnapshot
+
+    accountid, account, notfound = resolveAccount(account, pms)
+    if accountid is None:
+        sendToSlack(respondurl, notfound)
+        raise AccountNotFound(notfound)
+    sendToSlack(respondurl, accountTitle(account))
+    users = getAccountUsers(account, pms)
+    sendSections(respondurl, iterSections(users, accountGroups(pms)))
+    return [accountid, makeSnapshot(users)]
+
+
+def auditRequest(bodydict):
+    """Runs the audit asked for by the slash command and replies to Slack."""
+    from chalicelib.audit import (
+        accountReport,
+        displayReport,
+        parseUserNames,
+        saveSnapshot,
+        userAudit,
+    )
+    from chalicelib.blocks import renderPages
+    from chalicelib.rendercache import RenderCache
 
-def padLine(line, length=4):
     try:
-        while len(line) < length:
-            line.append("")
-        return line
+        spath = getEnvParam("SECRETPATH")
+        pms = permissions(spath)
+        if bodydict["text"].strip().startswith(("@", "<@")):
+            text, workspaceid = bodydict["text"], bodydict.get("team_id")
+            users, unknown = parseUserNames(text, workspaceid, pms)
+            sendToSlack(bodydict["response_url"], userAudit(users, pms, unknown))
+            return
+        text = bodydict["text"].strip()
+        diffmode = text.lower().startswith("diff ")
+        account = text[5:].strip() if diffmode else text
+        bucket = os.environ.get("RENDERBUCKET", "")
+        if len(bucket) == 0 and not diffmode:
+            accountid, snap = progressiveAudit(bodydict["response_url"], account, pms)
+            saveSnapshot(accountid, snap, pms)
+            return
+        accountid, snap, title, sections = accountReport(account, pms, diffmode)
+        if accountid is None:
+            sendToSlack(bodydict["response_url"], title)
+            raise AccountNotFound(title)
+        if not diffmode:
+            renderid = Utils().genUUID()
+            with span("render"):
+                pages = renderPages(title, sections, renderid, pagesize=PAGESIZE)
+            sendBlocksToSlack(bodydict["response_url"], title, pages[0])
+            # stored after the first page is sent, the buttons can wait for it
+            with span("render_cache"):
+                RenderCache(bucket).put(renderid, pages)
+        else:
+            with span("render"):
+                op = displayReport(title, sections)
+            sendToSlack(bodydict["response_url"], op)
+        saveSnapshot(accountid, snap, pms)
     except Exception as e:
-        msg = f"Exception in padLine: {type(e).__name__}: {e}"
+        msg = f"Exception in auditRequest: {type(e).__name__}: {e}"
         print(msg)
         raise
 
 
-def userPermRow(row, username, days):
-    """Turns a user row into a display list for tabulate."""
+@app.on_sns_message(topic="chaimaccountaudit")
+def doSNSReq(event):
+    trace = startTrace("doSNSReq")
+    setDeadline(lambdaDeadline(event.context))
+    bodydict = {}
     try:
-        extras = []
-        line = []
-        for role in row:
-            # print(role)
-            if role["rid"] < 1000:
-                extras.append(role["rname"])
-            else:
-                line.append(role["rname"])
-        msg = f"{username} ({days})"
-        if len(line) > 0:
-            msg += "\n"
-            msg += tabulate([padLine(line)], tablefmt="plain")
-        if len(extras) > 0:
-            for extra in extras:
-                msg += f"\n{extra}"
-        msg += "\n----------------------------------------"
-        return msg
+        bodydict = decodeMessage(event.message)
+        if "warmup" in bodydict:
+            print(json.dumps(prime(getEnvParam("SECRETPATH"))))
+            return
+        print(f"chaimaccountaudit rcvd: {bodydict}")
+        trace.correlationid = bodydict.get("correlationid")
+        if "publishedat" in bodydict:
+            addStage("sns_hop", time.time() - float(bodydict["publishedat"]))
+        if profileWanted(bodydict["text"]):
+            from chalicelib.profiling import profiled, stripFlag
+
+            bodydict["text"] = stripFlag(bodydict["text"])
+            with profiled("doSNSReq"):
+                auditRequest(bodydict)
+        else:
+            auditRequest(bodydict)
     except Exception as e:
-        msg = f"Exception in userPermRow: {type(e).__name__}: {e}"
+        msg = f"Exception in doSNSReq: {type(e).__name__}: {e}"
         print(msg)
-        raise
+        if not isinstance(e, AccountNotFound) and "response_url" in bodydict:
+            try:
+                sendToSlack(bodydict["response_url"], DEGRADED)
+            except Exception:
+                pass
+    finally:
+        endTrace()
+
 
+@app.schedule(Rate(1, unit=Rate.DAYS))
+def cleanKeyMapJob(event):
+    """Deletes expired keys from the keymap in small batches."""
+    from chalicelib.permissions import Permissions
 
-def displayPermissions(users, groups, pms):
     try:
-        op = ""
-        first = True
-        for user in users:
-            skip = False
-            for group in groups:
-                if user in group:
-                    skip = True
-            if skip:
-                continue
-            else:
-                if first:
-                    first = False
-                    sep = ""
-                else:
-                    sep = "\n\n"
-                days = chaimLastUsed(user, pms)
-                ustr = userPermRow(users[user], user, days)
-                op += f"{sep}{ustr}"
-        op += "\n\nSRE\nReadOnly  PowerUser  SysAdmin  AdminUser"
-        op += "\n----------------------------------------"
-        op += "\n\nSecurity\nReadOnly"
-        op += "\n----------------------------------------"
-        return op
+        spath = getEnvParam("SECRETPATH")
+        pms = Permissions(spath)
+        # stop with enough time left to report what was done
+        deadline = lambdaDeadline(event.context)
+        if deadline is not None:
+            deadline -= 5
+        res = pms.cleanKeyMapBatched(
+            days=int(os.environ.get("KEYMAPDAYS", 30)),
+            batchsize=int(os.environ.get("KEYMAPBATCHSIZE", 1000)),
+            pause=float(os.environ.get("KEYMAPPAUSE", 0.5)),
+            deadline=deadline,
+        )
+        print(f"cleanKeyMapJob: {json.dumps(res)}")
     except Exception as e:
-        msg = f"Exception in displayPermissions: {type(e).__name__}: {e}"
+        msg = f"Exception in cleanKeyMapJob: {type(e).__name__}: {e}"
         print(msg)
-        raise
 
 
-@app.on_sns_message(topic="chaimaccountaudit")
-def doSNSReq(event):
+@app.schedule(Rate(5, unit=Rate.MINUTES))
+def keepWarm(event):
+    """
+    Keeps both lambdas warm: a warmup message to the SNS handler and, if
+    APIURL is set, a warmup request to the slash command route.
+    """
     try:
-        bodydict = splitQS(event.message)
-        print(f"chaimaccountaudit rcvd: {bodydict}")
-        spath = getEnvParam("SECRETPATH")
-        pms = Permissions(spath)
-        accountid = pms.singleField(
-            "awsaccounts", "id", "name", "Name", bodydict["text"], notfoundOK=True
-        )
-        if accountid is None:
-            msg = f"""Account {bodydict["text"]} not found."""
-            sendToSlack(bodydict["response_url"], msg)
-            raise AccountNotFound(msg)
-        users = getAccountUsers(bodydict["text"], pms)
-        sre = listGroupMembers("SRE", pms)
-        security = listGroupMembers("security", pms)
-        msg = displayPermissions(users, (sre, security), pms)
-        title = f"""Permissions for account: *{bodydict["text"]}*"""
-        title += "\n\nThe number in brackets is the number of days since the"
-        title += " user last used chaim."
-        title += "\n(not necessarily last used chaim for this account)."
-        op = f"{title}\n\n```{msg}```"
-        sendToSlack(bodydict["response_url"], op)
-        # print(msg)
-        # print(sre)
-        # print(security)
-        # print(users)
+        publishToSNS(getEnvParam("SNSTOPICARN"), json.dumps({"warmup": "1"}))
+        apiurl = os.environ.get("APIURL", "")
+        if len(apiurl) > 0:
+            body = "warmup=1"
+            r = httpSession().post(
+                apiurl, data=body, headers=signedHeaders(body), timeout=10
+            )
+            print(f"keepWarm: {apiurl} returned {r.status_code}")
     except Exception as e:
-        msg = f"Exception in doSNSReq: {type(e).__name__}: {e}"
+        msg = f"Exception in keepWarm: {type(e).__name__}: {e}"
         print(msg)
 
 
 @app.route("/", methods=["POST"], content_types=["application/x-www-form-urlencoded"])
 def chaimaccountaudit():
+    trace = startTrace("chaimaccountaudit", Utils().genUUID())
     try:
         # the raw body string in the request from slack
         reqbody = app.current_request.raw_body.decode()
         # split the body apart into key value pairs
-        bodydict = splitQS(reqbody)
+        bodydict = decodeForm(reqbody)
+        # keepWarm signs its warmup requests too
+        verifyRequest(app.current_request.headers, reqbody)
+        if "warmup" in bodydict:
+            print(json.dumps(prime(full=False)))
+            return output(None, "warm")
         # fail if not a valid request from slack
         if "text" not in bodydict:
             raise SlackRecvFail(f"text key not sent by Slack\nbodydict: {bodydict}")
         # hand off to SNS as slack requires that this function returns within 3 seconds.
         snstopic = getEnvParam("SNSTOPICARN")
-        publishToSNS(snstopic, reqbody)
+        # carry the correlation id and publish time through to doSNSReq
+        bodydict["correlationid"] = trace.correlationid
+        bodydict["publishedat"] = time.time()
+        publishToSNS(snstopic, json.dumps(bodydict))
         return output(None, "Please wait...")
+    except InvalidSignature as e:
+        print(f"Rejected request: {e}")
+        return Response(body="", status_code=401)
     except Exception as e:
         msg = f"Exception in chaimaccountaudit: {type(e).__name__}: {e}"
         print(msg)
         return output(msg)
+    finally:
+        endTrace()
+
+
+@app.route(
+    "/interactive",
+    methods=["POST"],
+    content_types=["application/x-www-form-urlencoded"],
+)
+def interactive():
+    """Serves Next/Prev page button clicks from the cached rendering."""
+    from chalicelib.rendercache import RenderCache
+
+    try:
+        reqbody = app.current_request.raw_body.decode()
+        verifyRequest(app.current_request.headers, reqbody)
+        payload = json.loads(decodeForm(reqbody)["payload"])
+        action = payload["actions"][0]
+        renderid, page = action["value"].rsplit(":", 1)
+        pages = RenderCache(getEnvParam("RENDERBUCKET")).get(renderid)
+        if pages is None:
+            msg = "This audit has expired, please run it again."
+            sendToSlack(payload["response_url"], msg)
+        else:
+            text = pages[int(page)][0]["text"]["text"]
+            sendBlocksToSlack(
+                payload["response_url"], text, pages[int(page)], replace=True
+            )
+        return Response(body="", status_code=200)
+    except InvalidSignature as e:
+        print(f"Rejected request: {e}")
+        return Response(body="", status_code=401)
+    except Exception as e:
+        msg = f"Exception in interactive: {type(e).__name__}: {e}"
+        print(msg)
+        return Response(body="", status_code=200)
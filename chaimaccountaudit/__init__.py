@@ -1,2 +1,3 @@
 """Python chaimaccountaudit package."""
+
 __version__ = "0.1.8"
@@ -0,0 +1,266 @@
+"""Command line tools for chaim account auditing."""
+
+import argparse
+import csv
+import logging
+import os
+import re
+import sys
+
+import chalicelib.glue as glue
+from chalicelib.permissions import Permissions
+
+log = glue.log
+
+
+def getPermissions(args, quick=False):
+    return Permissions(
+        args.secretpath, testdb=args.testdb, quick=quick, stagepath=args.stage
+    )
+
+
+def doMigrate(args):
+    from chaimaccountaudit.schema import migrate
+
+    pms = getPermissions(args)
+    applied = migrate(pms.rwsid, dryrun=args.dryrun)
+    verb = "would apply" if args.dryrun else "applied"
+    if len(applied) > 0:
+        print(f"{verb} migrations: {', '.join(str(v) for v in applied)}")
+    else:
+        print("schema is up to date")
+    return 0
+
+
+def doExplain(args):
+    from chaimaccountaudit.explaincheck import checkPlans
+
+    pms = getPermissions(args)
+    failed = checkPlans(pms, minrows=args.minrows)
+    for name, sql, problem in failed:
+        print(f"{name}: {problem}\n    {sql}")
+    if len(failed) > 0:
+        print(f"{len(failed)} queries do full table scans or failed")
+        return 1
+    print("no full table scans found")
+    return 0
+
+
+def doCleanKeys(args):
+    pms = getPermissions(args)
+    startafter = None
+    if args.resume is not None:
+        expires, accesskey = args.resume.split(":", 1)
+        startafter = [int(expires), accesskey]
+
+    def progress(res):
+        print(f"""batch {res["batches"]}: deleted {res["deleted"]}""")
+
+    res = pms.cleanKeyMapBatched(
+        days=args.days,
+        batchsize=args.batchsize,
+        pause=args.pause,
+        dryrun=args.dryrun,
+        startafter=startafter,
+        progress=progress,
+    )
+    if args.dryrun:
+        print(f"""about {res["deleted"]} of {res["total"]} keys have expired""")
+    else:
+        print(f"""deleted {res["deleted"]} keys, about {res["total"]} remain""")
+        if not res["complete"] and res["checkpoint"] is not None:
+            expires, accesskey = res["checkpoint"]
+            print(f"resume with --resume {expires}:{accesskey}")
+    return 0
+
+
+def readKeys(text):
+    """
+    finds the aws access keys in text, so that lines pasted from cloudtrail
+    can be used as is. Falls back to one key per line.
+    """
+    keys = re.findall(r"\b(?:AKIA|ASIA)[A-Z0-9]{16}\b", text)
+    if len(keys) == 0:
+        keys = [line.strip() for line in text.splitlines() if len(line.strip()) > 0]
+    return list(dict.fromkeys(keys))
+
+
+def doWhosKeys(args):
+    text = " ".join(args.keys)
+    if args.infile is not None:
+        with open(args.infile) as ifn:
+            text += "\n" + ifn.read()
+    keys = readKeys(text)
+    pms = getPermissions(args)
+    res = pms.whosKeys(keys)
+    ofn = sys.stdout if args.outfile is None else open(args.outfile, "w", newline="")
+    try:
+        writer = csv.writer(ofn)
+        writer.writerow(["accesskey", "expires", "user", "account"])
+        for key in keys:
+            row = res[key]
+            if row is None:
+                writer.writerow([key, "", "not found", ""])
+            else:
+                writer.writerow(row)
+    finally:
+        if ofn is not sys.stdout:
+            ofn.close()
+    nfound = len([key for key in keys if res[key] is not None])
+    print(f"{nfound} of {len(keys)} keys found", file=sys.stderr)
+    return 0
+
+
+def doUserAudit(args):
+    from chalicelib.audit import displayUserPermissions, getUserAccounts
+
+    usernames = [name.lstrip("@") for name in args.users if len(name.lstrip("@")) > 0]
+    if args.infile is not None:
+        with open(args.infile) as ifn:
+            usernames += [line.strip() for line in ifn if len(line.strip()) > 0]
+    usernames = list(dict.fromkeys(usernames))
+    pms = getPermissions(args)
+    found = []
+    for username, days, accounts in getUserAccounts(usernames, pms):
+        found.append(username)
+        print(displayUserPermissions(username, days, accounts) + "\n")
+    for username in usernames:
+        if username not in found:
+            print(f"{username}: no chaim permissions found\n")
+    return 0
+
+
+def doExport(args):
+    from chalicelib.export import exportGrants
+
+    pms = getPermissions(args)
+    count = exportGrants(pms, args.outfile, fmt=args.format, gz=args.gzip)
+    print(f"exported {count} grants", file=sys.stderr)
+    return 0
+
+
+def auditFileName(account):
+    return re.sub(r"[^\w.-]+", "_", account) + ".txt"
+
+
+def doAudit(args):
+    from chaimaccountaudit.runner import runAudits
+
+    accounts = list(args.accounts)
+    if args.all:
+        accounts += getPermissions(args).accountNames()
+    accounts = list(dict.fromkeys(accounts))
+    if args.outdir is not None:
+        os.makedirs(args.outdir, exist_ok=True)
+    failed = 0
+    results = runAudits(
+        accounts,
+        args.secretpath,
+        args.stage,
+        testdb=args.testdb,
+        workers=args.workers,
+        diffmode=args.diff,
+        save=args.save,
+    )
+    for account, ok, text in results:
+        if not ok:
+            failed += 1
+            print(text, file=sys.stderr)
+        elif args.outdir is None:
+            print(f"{text}\n")
+        else:
+            with open(os.path.join(args.outdir, auditFileName(account)), "w") as ofn:
+                ofn.write(f"{text}\n")
+    print(
+        f"audited {len(accounts) - failed} of {len(accounts)} accounts", file=sys.stderr
+    )
+    return 1 if failed > 0 else 0
+
+
+def makeParser():
+    parser = argparse.ArgumentParser(prog="chaimaccountaudit", description=__doc__)
+    parser.add_argument("-s", "--stage", default="prod", help="chaim environment")
+    parser.add_argument(
+        "--secretpath",
+        default=os.environ.get("SECRETPATH", "/sre/chaim/"),
+        help="ssm parameter path",
+    )
+    parser.add_argument(
+        "--testdb", action="store_true", help="use the database on 127.0.0.1"
+    )
+    parser.add_argument("-d", "--debug", action="store_true", help="debug logging")
+    subs = parser.add_subparsers(dest="command", required=True)
+
+    sub = subs.add_parser("migrate", help="apply schema migrations")
+    sub.add_argument("-n", "--dryrun", action="store_true", help="show only")
+    sub.set_defaults(func=doMigrate)
+
+    sub = subs.add_parser("explain", help="check query plans for full table scans")
+    sub.add_argument(
+        "--minrows",
+        type=int,
+        default=1000,
+        help="ignore full scans of tables smaller than this",
+    )
+    sub.set_defaults(func=doExplain)
+
+    sub = subs.add_parser("cleankeys", help="delete expired keys from the keymap")
+    sub.add_argument("--days", type=int, default=30, help="expired more than")
+    sub.add_argument("--batchsize", type=int, default=1000, help="rows per delete")
+    sub.add_argument("--pause", type=float, default=0.5, help="seconds between batches")
+    sub.add_argument("--resume", help="expires:accesskey to resume after")
+    sub.add_argument(
+        "-n", "--dryrun", action="store_true", help="estimate only, delete nothing"
+    )
+    sub.set_defaults(func=doCleanKeys)
+
+    sub = subs.add_parser("whoskeys", help="who were these access keys issued to")
+    sub.add_argument("keys", nargs="*", help="access keys")
+    sub.add_argument("-i", "--infile", help="file of keys or cloudtrail output")
+    sub.add_argument("-o", "--outfile", help="csv file to write, default stdout")
+    sub.set_defaults(func=doWhosKeys)
+
+    sub = subs.add_parser("audit", help="audit accounts")
+    sub.add_argument("accounts", nargs="*", help="account names")
+    sub.add_argument("-a", "--all", action="store_true", help="audit every account")
+    sub.add_argument(
+        "-w", "--workers", type=int, default=4, help="number of worker processes"
+    )
+    sub.add_argument("-o", "--outdir", help="write one file per account here")
+    sub.add_argument(
+        "--diff", action="store_true", help="only show changes since the last audit"
+    )
+    sub.add_argument(
+        "--save", action="store_true", help="store audit snapshots for --diff"
+    )
+    sub.set_defaults(func=doAudit)
+
+    sub = subs.add_parser("user", help="a user's permissions across all accounts")
+    sub.add_argument("users", nargs="*", help="chaim user names")
+    sub.add_argument("-i", "--infile", help="file of user names, one per line")
+    sub.set_defaults(func=doUserAudit)
+
+    sub = subs.add_parser("export", help="export every account/user/role grant")
+    sub.add_argument(
+        "-o", "--outfile", default="-", help="file, s3://bucket/key or - for stdout"
+    )
+    sub.add_argument("-f", "--format", choices=["ndjson", "csv"], default="ndjson")
+    sub.add_argument("-z", "--gzip", action="store_true", help="gzip the output")
+    sub.set_defaults(func=doExport)
+    return parser
+
+
+def main(argv=None):
+    args = makeParser().parse_args(argv)
+    logging.basicConfig(format="%(message)s")
+    if args.debug:
+        glue.setDebug()
+    try:
+        return args.func(args)
+    except Exception as e:
+        print(f"{args.command} failed: {type(e).__name__}: {e}", file=sys.stderr)
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,154 @@
+"""
+EXPLAIN based query plan checks
+
+Runs each of the hot queries in permissions.py and audit.py through EXPLAIN
+rather than executing them and fails if any of them would do a full table
+scan. Point it at a database with production-like row counts (a restored
+snapshot), small tables are always scanned by the optimiser.
+"""
+
+import pymysql
+
+import chalicelib.audit as audit
+import chalicelib.glue as glue
+
+log = glue.log
+
+# a row that satisfies the callers' indexing into query results, so that
+# every query in a multi-query function gets explained
+FAKEROW = (1, 1, "x", "x", 1, 0, "never")
+# the hot queries whose callers need a row of another shape
+FAKEROWS = {
+    "getAccountUsers": ("x", "x", 1, 0, "never"),
+}
+
+
+class ExplainDB:
+    """
+    Stands in for a SlackIamDB: records the EXPLAIN output for every
+    query it is asked to run and returns a single fake row.
+    """
+
+    def __init__(self, sid, row=FAKEROW):
+        self.sid = sid
+        self.row = row
+        self.plans = []
+        self.affectedrows = 0
+        self.lastinsertid = 0
+
+    def query(self, sql, args=None):
+        verb = sql.strip().split(None, 1)[0].lower()
+        if verb in ("select", "delete", "update"):
+            self.explain(sql, args)
+        elif verb == "checksum":
+            # can't be explained, it reads every row of each table
+            tables = sql.strip().split(None, 2)[2]
+            for table in tables.split(","):
+                self.explain(f"select * from {table.strip()}")
+        return [self.row]
+
+    def explain(self, sql, args=None):
+        with self.sid.con.cursor(pymysql.cursors.DictCursor) as cur:
+            cur.execute(f"explain {sql}", args)
+            self.plans.append([" ".join(sql.split()), cur.fetchall()])
+
+    def streamQuery(self, sql, args=None):
+        yield from self.query(sql, args)
+
+    def singleField(self, table, field, where=None):
+        sql = "select " + field + " from " + table
+        if where is not None:
+            sql += " where " + where
+        sql += " limit 1"
+        return self.query(sql)[0][0]
+
+    def updateQuery(self, sql, args=None):
+        self.query(sql, args)
+        return 1
+
+    insertQuery = updateQuery
+    deleteQuery = updateQuery
+
+    def sqlStr(self, xstr):
+        return self.sid.sqlStr(xstr)
+
+    def sqlInt(self, xint):
+        return self.sid.sqlInt(xint)
+
+
+def hotQueries():
+    """
+    returns a list of [name, callable, fullscanok] for the hot queries.
+    fullscanok marks the queries that list a whole table on purpose.
+    """
+    return [
+        ["userNameFromSlackIds", lambda p: p.userNameFromSlackIds("T", "U"), False],
+        ["accountid", lambda p: p.checkIDs("awsaccounts", "name", "Acct", "x"), False],
+        ["userAllowed", lambda p: p.userAllowed("x", "x", "x"), False],
+        ["whosKey", lambda p: p.whosKey("AKIAX"), False],
+        ["whosKeys", lambda p: p.whosKeys(["AKIAY", "AKIAZ"]), False],
+        ["readUserToken", lambda p: p.readUserToken("x"), False],
+        ["checkSlackMap", lambda p: p.checkSlackMap(1, "U0", "T0"), False],
+        ["cleanKeyMap", lambda p: p.cleanKeyMap(dryrun=True), False],
+        ["listuserperms", lambda p: p.listuserperms("x"), False],
+        ["lastAuditSnapshot", lambda p: p.lastAuditSnapshot("1"), False],
+        ["pruneAuditSnapshots", lambda p: p.pruneAuditSnapshots("1"), False],
+        ["countLastSince", lambda p: p.countLastSince(2), False],
+        ["accountList", lambda p: p.accountList(), True],
+        ["accountIdNames", lambda p: p.accountIdNames(), True],
+        ["groupMembers", lambda p: p.groupMembers(), True],
+        ["refDataVersion", lambda p: p.refDataVersion(), True],
+        ["streamGrants", lambda p: list(p.streamGrants()), True],
+        ["getAccountUsers", lambda p: audit.getAccountUsers("x", p), False],
+        ["getUserAccounts", lambda p: list(audit.getUserAccounts(["x"], p)), False],
+    ]
+
+
+def fullScans(plan, minrows=1000):
+    """
+    returns the tables in an EXPLAIN result that are read with a full
+    table scan of at least minrows rows.
+    """
+    tables = []
+    for row in plan:
+        rows = row.get("rows") or 0
+        if row.get("type") == "ALL" and int(rows) >= minrows:
+            tables.append(f"""{row.get("table")} ({rows} rows)""")
+    return tables
+
+
+def checkPlans(pms, minrows=1000):
+    """
+    explains every hot query, returns a list of [name, sql, problem] for
+    each query that does a full table scan or that couldn't be explained.
+    """
+    sid = pms.sid
+    rwsid = pms.rwsid
+    replicahosts = pms.replicahosts
+    # explain against the primary
+    pms.replicahosts = []
+    failed = []
+    try:
+        for name, func, fullscanok in hotQueries():
+            row = FAKEROWS.get(name, FAKEROW)
+            pms.sid = ExplainDB(sid, row)
+            pms.rwsid = ExplainDB(rwsid, row)
+            try:
+                func(pms)
+            except Exception as e:
+                problem = f"failed: {type(e).__name__}: {e}"
+                log.error(f"{'FAILED':<10}{name}: {problem}")
+                failed.append([name, "", problem])
+            for sql, plan in pms.sid.plans + pms.rwsid.plans:
+                tables = fullScans(plan, minrows)
+                status = "ok"
+                if len(tables) > 0 and not fullscanok:
+                    status = "FULL SCAN"
+                    problem = f"full table scan of {', '.join(tables)}"
+                    failed.append([name, sql, problem])
+                log.info(f"{status:<10}{name}: {sql}")
+    finally:
+        pms.sid = sid
+        pms.rwsid = rwsid
+        pms.replicahosts = replicahosts
+    return failed
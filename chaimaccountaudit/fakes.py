@@ -0,0 +1,153 @@
+"""
+In-process stand-ins for the database and the parameter store
+
+Used by the tests and by membench to build real Permissions objects whose
+queries are answered without a database. FakeDB answers each statement
+with a function of its sql, so one fake can play every table a caller
+reads.
+"""
+
+import chalicelib.permissions
+from chalicelib.permissions import Permissions
+
+# the ssm parameters Permissions reads when it is created
+PARAMS = {
+    "snstopicarn": "arn:aws:sns:eu-west-1:123456789012:chaimaccountaudit",
+    "dbhost": "primary",
+    "dbrouser": "ro",
+    "dbdb": "chaim",
+    "dbropass": "ropass",
+    "dbrwuser": "rw",
+    "dbrwpass": "rwpass",
+    "poolid": "pool",
+    "dbreplicas": "",
+}
+
+
+class FakeParamStore:
+    """ssm: the Permissions parameters, and values by path for getParam"""
+
+    def __init__(self, values):
+        self.values = values
+        self.calls = 0
+        self.FETCHED_PARAMS = {}
+
+    def getParams(self, names, environment="prod", path="/sre/chaim/"):
+        return {name: self.values.get(name) for name in names}
+
+    def getParam(self, path, dcrypt=False):
+        self.calls += 1
+        return self.values[path]
+
+
+class FakeDB:
+    """
+    stands in for a SlackIamDB. answer(sql, args) returns the rows for a
+    statement, refuse(sql, args) returns an exception to raise, or None.
+    statements is everything run, pending what a rollback would undo and
+    committed what has been committed.
+    """
+
+    def __init__(self, answer=None, refuse=None, dbhost="primary", columns=None):
+        self.answer = answer or (lambda sql, args: [])
+        self.refuse = refuse or (lambda sql, args: None)
+        self.dbhost = dbhost
+        self.columns = columns or []
+        self.statements = []
+        self.pending = []
+        self.committed = []
+        self.commits = 0
+        self.rollbacks = 0
+        self.pings = 0
+
+    def query(self, sql, args=None):
+        err = self.refuse(sql, args)
+        if err is not None:
+            raise err
+        self.statements.append([sql, args])
+        self.pending.append([sql, args])
+        return self.answer(sql, args)
+
+    def streamQuery(self, sql, args=None):
+        yield from self.query(sql, args)
+
+    def singleField(self, table, field, where=None):
+        sql = "select " + field + " from " + table
+        if where is not None:
+            sql += " where " + where
+        rows = self.query(sql + " limit 1")
+        return rows[0][0] if len(rows) > 0 else None
+
+    def executeMany(self, sql, argslist):
+        self.query(sql, argslist)
+        return len(argslist)
+
+    def deleteQuery(self, sql, args=None):
+        rows = self.query(sql, args)
+        self.commit()
+        return len(rows)
+
+    insertQuery = deleteQuery
+    updateQuery = deleteQuery
+
+    def commit(self):
+        self.commits += 1
+        self.committed.extend(self.pending)
+        self.pending = []
+
+    def rollback(self):
+        self.rollbacks += 1
+        self.pending = []
+
+    def ping(self):
+        self.pings += 1
+
+    def sqlStr(self, xstr):
+        return "'" + xstr + "'"
+
+    def sqlInt(self, xint):
+        return str(xint)
+
+
+def rows(*rows):
+    """a FakeDB answer that gives rows for every statement"""
+    return lambda sql, args: list(rows)
+
+
+def refTables(accounts, groups=None, version="1"):
+    """
+    a FakeDB answer for the reference table queries, see
+    chalicelib/refdata.py: accounts is [[accountid, name]], groups
+    {group name: [user names]} and version the tables' checksum.
+    """
+    groups = groups or {}
+    members = [[group, user] for group, users in groups.items() for user in users]
+
+    def answer(sql, args):
+        if sql.startswith("checksum table"):
+            return [["chaim.awsaccounts", version]]
+        if sql.startswith("select id, name from awsaccounts"):
+            return accounts
+        if "from groupusermap" in sql:
+            return members
+        return []
+
+    return answer
+
+
+def fakePermissions(sid=None, rwsid=None, params=None):
+    """
+    a Permissions object created as the lambdas create it, with ssm values
+    from PARAMS and params, and sid and rwsid as given rather than
+    database connections.
+    """
+    ps = FakeParamStore(dict(PARAMS, **(params or {})))
+    paramstore = chalicelib.permissions.ParamStore
+    chalicelib.permissions.ParamStore = lambda: ps
+    try:
+        pms = Permissions("/sre/chaim/", quick=True)
+    finally:
+        chalicelib.permissions.ParamStore = paramstore
+    pms.sid = sid
+    pms.rwsid = rwsid
+    return pms
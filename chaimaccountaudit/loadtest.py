@@ -0,0 +1,174 @@
+"""
+Load test for the slash command acknowledgement route
+
+Slack gives up on a slash command that isn't answered within 3 seconds.
+This fires synthetic slash command posts at the `/` route at increasing
+concurrency and reports the latency percentiles and error rate at each
+level. By default the app is called in-process through the Chalice test
+client with SNS replaced by a local stub that takes SNSLATENCY ms to
+publish, or pass --url to load a `chalice local` (or deployed) endpoint.
+
+Run from the top of the repository (app.py has to be importable):
+
+    python -m chaimaccountaudit.loadtest
+    python -m chaimaccountaudit.loadtest --url http://127.0.0.1:8000/
+"""
+
+import argparse
+import contextlib
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# p99 budget for the in-process ack path in ms, checked by tests/test_loadtest.py
+BUDGETMS = 250
+
+LEVELS = [1, 4, 16, 32]
+REQUESTS = 200
+SNSLATENCY = 20
+
+BODY = (
+    "token=x&team_id=T0&team_domain=example&user_id=U0&user_name=someone"
+    "&command=%2Fchaimaccountaudit&text=myaccount"
+    "&response_url=https%3A%2F%2Fhooks.slack.com%2Fcommands%2FT0%2F1%2Fx"
+)
+HEADERS = {"Content-Type": "application/x-www-form-urlencoded"}
+
+
+class LocalSNS:
+    """stands in for the SNS client, publish takes latency ms"""
+
+    def __init__(self, latency=SNSLATENCY):
+        self.latency = latency / 1000
+        self.published = 0
+        self.lock = threading.Lock()
+
+    def publish(self, TopicArn=None, Message=None):
+        time.sleep(self.latency)
+        with self.lock:
+            self.published += 1
+        return {"MessageId": str(self.published)}
+
+
+def localTarget(snslatency=SNSLATENCY):
+    """
+    returns a function that posts one slash command to the app in-process.
+    The Chalice test client keeps the current request on the app object, so
+    concurrent requests can see each other's; every body here is the same.
+    """
+    from chalice.test import Client
+
+    import app
+    import chalicelib.slackrequest as slackrequest
+    import chalicelib.warmup as warmup
+
+    os.environ.setdefault("SNSTOPICARN", "arn:aws:sns:eu-west-1:123456789012:x")
+    warmup.SHARED["sns"] = LocalSNS(snslatency)
+    slackrequest.SECRET["secret"] = "loadtestsecret"
+    client = Client(app.app)
+
+    def post():
+        timestamp = str(int(time.time()))
+        headers = dict(HEADERS)
+        headers["X-Slack-Request-Timestamp"] = timestamp
+        headers["X-Slack-Signature"] = slackrequest.signature(
+            "loadtestsecret", timestamp, BODY
+        )
+        resp = client.http.post("/", headers=headers, body=BODY)
+        return resp.status_code == 200 and b"Please wait" in resp.body
+
+    return post
+
+
+def urlTarget(url):
+    """
+    returns a function that posts one slash command to url, which has to
+    be running with SLACKVERIFY=0
+    """
+    import requests
+
+    session = requests.Session()
+
+    def post():
+        resp = session.post(url, data=BODY, headers=HEADERS, timeout=10)
+        return resp.status_code == 200 and "Please wait" in resp.text
+
+    return post
+
+
+def percentile(values, pct):
+    """nearest rank percentile of an already sorted list"""
+    if len(values) == 0:
+        return 0.0
+    rank = max(1, int(round(pct / 100 * len(values))))
+    return values[min(rank, len(values)) - 1]
+
+
+def timed(post):
+    start = time.perf_counter()
+    try:
+        ok = post()
+    except Exception:
+        ok = False
+    return (time.perf_counter() - start) * 1000, ok
+
+
+def runLevel(post, concurrency, nrequests=REQUESTS):
+    """
+    sends nrequests posts with concurrency in flight at once, returns a
+    dict of the latency percentiles in ms and the error rate.
+    """
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(lambda _: timed(post), range(nrequests)))
+    times = sorted(ms for ms, ok in results)
+    errors = len([ok for ms, ok in results if not ok])
+    return {
+        "concurrency": concurrency,
+        "requests": nrequests,
+        "p50": percentile(times, 50),
+        "p95": percentile(times, 95),
+        "p99": percentile(times, 99),
+        "errors": errors / nrequests,
+    }
+
+
+def runLoad(post, levels=None, nrequests=REQUESTS):
+    # one post first so that imports and clients aren't timed
+    post()
+    return [runLevel(post, level, nrequests) for level in levels or LEVELS]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="load test the ack route")
+    parser.add_argument("--url", help="post to this url rather than in-process")
+    parser.add_argument(
+        "-c", "--concurrency", type=int, nargs="+", default=LEVELS, help="levels"
+    )
+    parser.add_argument("-n", "--requests", type=int, default=REQUESTS)
+    parser.add_argument("--snslatency", type=float, default=SNSLATENCY, help="ms")
+    parser.add_argument("--budget", type=float, default=BUDGETMS, help="p99 ms")
+    args = parser.parse_args(argv)
+    if args.url is None:
+        post = localTarget(args.snslatency)
+    else:
+        post = urlTarget(args.url)
+    # keep the app's log lines out of the report
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        results = runLoad(post, args.concurrency, args.requests)
+    failed = 0
+    print(f"{'conc':>5}{'p50':>9}{'p95':>9}{'p99':>9}{'errors':>9}")
+    for res in results:
+        ok = res["p99"] <= args.budget and res["errors"] == 0
+        failed += 0 if ok else 1
+        status = "ok" if ok else "OVER BUDGET"
+        print(
+            f"{res['concurrency']:>5}{res['p50']:>9.1f}{res['p95']:>9.1f}"
+            f"{res['p99']:>9.1f}{res['errors']:>8.1%}  {status}"
+        )
+    return 1 if failed > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,160 @@
+"""
+Peak memory benchmark for the lambda entry points
+
+Each entry point is run in a fresh python process, with AWS, the database
+and slack replaced by in-process stand-ins, and the peak RSS of the
+process is compared with its budget. The budgets leave room for the lambda
+runtime within the 128 MB configured in .chalice/config.json.
+
+Run from the top of the repository (app.py has to be importable):
+
+    python -m chaimaccountaudit.membench
+"""
+
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+# peak RSS budgets in MB
+CEILINGS = {"ack": 64, "audit": 80}
+
+# synthetic account size for the audit benchmark
+NUSERS = 2000
+NROLES = 4
+# the audited account and the SRE and security group members
+ACCOUNTS = [["123456789012", "myaccount"]]
+GROUPS = {"SRE": ["user.name00000"], "security": ["user.name00001"]}
+
+
+def auditTables(sql, args):
+    """a FakeDB answer: the reference tables and a synthetic account"""
+    from chaimaccountaudit.fakes import refTables
+
+    if "useracctrolemap" in sql:
+        return (
+            (f"user.name{i:05d}", f"CrossAccountRole{rid}", rid, 0, "never")
+            for i in range(NUSERS)
+            for rid in range(1, NROLES + 1)
+        )
+    return refTables(ACCOUNTS, GROUPS)(sql, args)
+
+
+class FakeResponse:
+    status_code = 200
+    text = "ok"
+
+
+def fakeEnvironment():
+    os.environ.setdefault("AWS_DEFAULT_REGION", "eu-west-1")
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+    os.environ["SNSTOPICARN"] = "arn:aws:sns:eu-west-1:123456789012:chaimaccountaudit"
+    os.environ["SECRETPATH"] = "/sre/chaim/"
+    os.environ.pop("RENDERBUCKET", None)
+    os.environ["REFCACHE"] = os.path.join(tempfile.mkdtemp(), "refdata")
+
+
+def benchAck():
+    """the slash command acknowledgement route with a stubbed SNS client"""
+    import boto3
+    from botocore.stub import Stubber
+    from chalice.test import Client
+
+    import app
+    import chalicelib.slackrequest as slackrequest
+
+    body = "token=x&text=myaccount&response_url=https://example.com/r"
+    slackrequest.SECRET["secret"] = "benchsecret"
+    timestamp = str(int(time.time()))
+    sns = boto3.client("sns")
+    stubber = Stubber(sns)
+    stubber.add_response("publish", {"MessageId": "1"})
+    stubber.activate()
+    boto3.client = lambda *args, **kwargs: sns
+    with Client(app.app) as client:
+        resp = client.http.post(
+            "/",
+            headers={
+                "Content-Type": "application/x-www-form-urlencoded",
+                "X-Slack-Request-Timestamp": timestamp,
+                "X-Slack-Signature": slackrequest.signature(
+                    "benchsecret", timestamp, body
+                ),
+            },
+            body=body,
+        )
+    if resp.status_code != 200:
+        raise RuntimeError(f"ack failed: {resp.status_code} {resp.body}")
+
+
+def benchAudit():
+    """the SNS audit handler against a synthetic account"""
+    from chalice.test import Client
+    import requests
+
+    import app
+    from chaimaccountaudit.fakes import FakeDB, fakePermissions
+    import chalicelib.permissions
+
+    sent = []
+    chalicelib.permissions.Permissions = lambda spath: fakePermissions(
+        sid=FakeDB(auditTables), rwsid=FakeDB()
+    )
+    requests.Session.post = (
+        lambda self, url, data=None, **kwargs: sent.append(data) or FakeResponse()
+    )
+    with Client(app.app) as client:
+        event = client.events.generate_sns_event(
+            message=json.dumps(
+                {"token": "x", "text": "myaccount", "response_url": "https://e.com/r"}
+            )
+        )
+        client.lambda_.invoke("doSNSReq", event)
+    if len(sent) == 0:
+        raise RuntimeError("audit sent nothing to slack")
+
+
+ENTRIES = {"ack": benchAck, "audit": benchAudit}
+
+
+def peakRSS():
+    """peak RSS of this process in MB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure(entry):
+    """runs one entry point in a new process, returns its peak RSS in MB"""
+    proc = subprocess.run(
+        [sys.executable, "-m", "chaimaccountaudit.membench", "--run", entry],
+        capture_output=True,
+        text=True,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"{entry} benchmark failed:\n{proc.stderr}")
+    return json.loads(proc.stdout.strip().splitlines()[-1])["peak_mb"]
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) == 2 and argv[0] == "--run":
+        fakeEnvironment()
+        ENTRIES[argv[1]]()
+        print(json.dumps({"entry": argv[1], "peak_mb": round(peakRSS(), 1)}))
+        return 0
+    failed = 0
+    for entry in ENTRIES:
+        peak = measure(entry)
+        ok = peak <= CEILINGS[entry]
+        failed += 0 if ok else 1
+        status = "ok" if ok else "OVER BUDGET"
+        print(f"{entry:<8}{peak:>8.1f} MB  budget {CEILINGS[entry]} MB  {status}")
+    return 1 if failed > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
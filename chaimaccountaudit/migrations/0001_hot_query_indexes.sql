@@ -0,0 +1,9 @@
+-- Indexes for the hot lookup paths used by the slack commands and the audit.
+--
+-- awsusers.name: checkIDs, chaimLastUsed, readUserToken, listuserperms
+-- awsaccounts.name: singleField account lookups, getAccountUsers
+-- awsgroups.name: listGroupMembers
+create index ix_awsusers_name on awsusers (name, lastslack, lastcli);
+create index ix_awsaccounts_name on awsaccounts (name);
+create index ix_awsgroups_name on awsgroups (name);
+create index ix_groupusermap_group on groupusermap (groupid, userid);
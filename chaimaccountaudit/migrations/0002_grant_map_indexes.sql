@@ -0,0 +1,7 @@
+-- Covering indexes for useracctrolemap.
+--
+-- account first: userAllowed and getAccountUsers (one account, all users)
+-- user first: listuserperms (one user, all accounts)
+create index ix_useracctrolemap_account on useracctrolemap (accountid, userid, roleid);
+create index ix_useracctrolemap_user on useracctrolemap (userid, accountid, roleid);
+create index ix_slackmap_workspace on slackmap (workspaceid, slackid, userid);
@@ -0,0 +1,6 @@
+-- keymap lookups by access key (whosKey) and expiry range scans (cleanKeyMap).
+create index ix_keymap_accesskey on keymap (accesskey);
+create index ix_keymap_expires on keymap (expires, accesskey);
+-- usage counts in countLastSince
+create index ix_awsusers_lastslack on awsusers (lastslack);
+create index ix_awsusers_lastcli on awsusers (lastcli);
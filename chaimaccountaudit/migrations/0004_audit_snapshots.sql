@@ -0,0 +1,9 @@
+-- compact per-account audit results, for reporting what changed since the
+-- last audit. snapshot is zlib compressed json, see chalicelib/snapshot.py
+create table auditsnapshot (
+    id int not null auto_increment primary key,
+    accountid varchar(32) not null,
+    taken int not null,
+    snapshot mediumblob not null,
+    key ix_auditsnapshot_account (accountid, taken)
+);
@@ -0,0 +1,55 @@
+"""
+Account audits from the command line
+
+Audits are spread over a pool of worker processes, each of which opens
+its own database connections once and reuses them for every account it
+is given.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+
+from chalicelib.audit import accountAudit, saveSnapshot
+from chalicelib.permissions import Permissions
+
+# the worker process's Permissions object, see initWorker
+WORKERPMS = None
+
+
+def initWorker(secretpath, stage, testdb):
+    global WORKERPMS
+    WORKERPMS = Permissions(secretpath, testdb=testdb, stagepath=stage)
+
+
+def auditAccount(account, diffmode=False, save=False):
+    """
+    audits one account with the worker's connection
+    returns [account, ok, text]
+    """
+    try:
+        accountid, snap, text = accountAudit(account, WORKERPMS, diffmode)
+        if accountid is None:
+            return [account, False, text]
+        if save:
+            saveSnapshot(accountid, snap, WORKERPMS)
+        return [account, True, text]
+    except Exception as e:
+        return [account, False, f"audit of {account} failed: {type(e).__name__}: {e}"]
+
+
+def runAudits(accounts, secretpath, stage, testdb=False, workers=4, **kwargs):
+    """
+    generator of [account, ok, text] for each account, in the order given.
+    kwargs are passed on to auditAccount
+    """
+    initargs = (secretpath, stage, testdb)
+    if workers < 2:
+        initWorker(*initargs)
+        for account in accounts:
+            yield auditAccount(account, **kwargs)
+        return
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=initWorker, initargs=initargs
+    ) as pool:
+        futures = [pool.submit(auditAccount, account, **kwargs) for account in accounts]
+        for future in futures:
+            yield future.result()
@@ -0,0 +1,131 @@
+"""Versioned schema migrations for the chaim database."""
+
+import os
+import re
+
+import chalicelib.glue as glue
+from chalicelib.utils import Utils
+
+log = glue.log
+
+MIGRATIONDIR = os.path.join(os.path.dirname(__file__), "migrations")
+
+CREATEINDEX = re.compile(r"^create\s+(?:unique\s+)?index\s+(\w+)\s+on\s+(\w+)", re.I)
+CREATETABLE = re.compile(r"^create\s+table\s+(?:if\s+not\s+exists\s+)?(\w+)", re.I)
+
+
+class MigrationFail(Exception):
+    pass
+
+
+def readMigrations(mdir=MIGRATIONDIR):
+    """
+    returns a list of [version, name, statements] for each migration file
+    in mdir, in version order.
+
+    migration files are named NNNN_description.sql
+    """
+    try:
+        migs = []
+        for fn in sorted(os.listdir(mdir)):
+            m = re.match(r"^(\d+)_(.+)\.sql$", fn)
+            if m is None:
+                continue
+            with open(os.path.join(mdir, fn)) as ifn:
+                stmts = splitStatements(ifn.read())
+            migs.append([int(m.group(1)), m.group(2), stmts])
+        return sorted(migs, key=lambda x: x[0])
+    except Exception as e:
+        msg = f"Exception in readMigrations: {type(e).__name__}: {e}"
+        log.error(msg)
+        raise
+
+
+def splitStatements(sqltext):
+    """splits a migration file into statements, dropping comments."""
+    lines = []
+    for line in sqltext.splitlines():
+        if line.strip().startswith("--"):
+            continue
+        lines.append(line)
+    stmts = []
+    for stmt in "\n".join(lines).split(";"):
+        if len(stmt.strip()) > 0:
+            stmts.append(stmt.strip())
+    return stmts
+
+
+def tableExists(rwsid, table):
+    sql = "select 1 from information_schema.tables"
+    sql += " where table_schema=database() and table_name=%s"
+    return len(rwsid.query(sql, [table])) > 0
+
+
+def appliedVersions(rwsid, dryrun=False):
+    """
+    the versions already applied. schemaversion is created if need be,
+    except in a dry run, which changes nothing and takes a missing table
+    as nothing applied.
+    """
+    if dryrun:
+        if not tableExists(rwsid, "schemaversion"):
+            return []
+    else:
+        sql = """
+        create table if not exists schemaversion (
+            version int not null primary key,
+            name varchar(255) not null,
+            applied int not null
+        )
+        """
+        rwsid.query(sql)
+    rows = rwsid.query("select version from schemaversion order by version")
+    return [row[0] for row in rows]
+
+
+def statementDone(rwsid, stmt):
+    """
+    True if stmt creates an index or a table that already exists.
+    MySQL commits each DDL statement as it goes, so a migration that failed
+    part way through is carried on from the statement that failed.
+    """
+    m = CREATEINDEX.match(stmt)
+    if m is not None:
+        sql = "select 1 from information_schema.statistics"
+        sql += " where table_schema=database() and table_name=%s and index_name=%s"
+        return len(rwsid.query(sql, [m.group(2), m.group(1)])) > 0
+    m = CREATETABLE.match(stmt)
+    if m is not None:
+        return tableExists(rwsid, m.group(1))
+    return False
+
+
+def migrate(rwsid, mdir=MIGRATIONDIR, dryrun=False):
+    """
+    applies any migrations that have not already been applied, skipping
+    statements whose index or table is already there (see statementDone).
+    returns a list of the versions applied (or that would be applied)
+    """
+    try:
+        done = appliedVersions(rwsid, dryrun)
+        ut = Utils()
+        applied = []
+        for version, name, stmts in readMigrations(mdir):
+            if version in done:
+                continue
+            log.info(f"applying migration {version:04d} {name}")
+            if not dryrun:
+                for stmt in stmts:
+                    if statementDone(rwsid, stmt):
+                        log.info(f"already done: {stmt.splitlines()[0]}")
+                        continue
+                    rwsid.query(stmt)
+                sql = "insert into schemaversion (version, name, applied) values "
+                sql += f"({version}, {rwsid.sqlStr(name)}, {ut.getNow()})"
+                rwsid.insertQuery(sql)
+            applied.append(version)
+        return applied
+    except Exception as e:
+        msg = f"Exception in migrate: {type(e).__name__}: {e}"
+        log.error(msg)
+        raise MigrationFail(msg)
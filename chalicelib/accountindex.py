@@ -0,0 +1,121 @@
+#
+# Copyright (c) 2018, Centrica Hive Ltd.
+#
+#     This file is part of chaim.
+#
+#     chaim is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     chaim is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with chaim.  If not, see <http://www.gnu.org/licenses/>.
+"""
+In-memory index of the account names and numbers
+
+Resolves what a user typed to an account without a database round trip:
+by exact name (any case), by account number, and otherwise offers the
+accounts whose names start with, or are spelt like, what was typed.
+The index is built from the container's reference data (see
+chalicelib/refdata.py) and rebuilt whenever that changes.
+"""
+from bisect import bisect_left
+import chalicelib.glue as glue
+from chalicelib.refdata import RefData
+
+log = glue.log
+
+# trigram similarity below which an account isn't suggested
+MINSIMILARITY = 0.3
+MAXSUGGESTIONS = 5
+
+
+def trigrams(text):
+    padded = "  {} ".format(text.lower())
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class AccountIndex:
+    # [AccountIndex, the RefData it was built from], for the life of the container
+    CACHED = [None, None]
+
+    def __init__(self, rows):
+        """rows are [accountid, name]"""
+        self.byname = {}
+        self.byid = {}
+        self.trigrams = {}
+        self.ntrigrams = {}
+        for accountid, name in rows:
+            self.byname[name.lower()] = (accountid, name)
+            self.byid[str(accountid)] = (accountid, name)
+            tris = trigrams(name)
+            self.ntrigrams[name] = len(tris)
+            for tri in tris:
+                self.trigrams.setdefault(tri, []).append(name)
+        self.names = sorted(self.byname)
+
+    @classmethod
+    def get(cls, pms):
+        """the container's index, rebuilt if the reference data has changed"""
+        index, builtfrom = cls.CACHED
+        refdata = RefData.get(pms)
+        if index is None or builtfrom is not refdata:
+            index = cls(refdata.accounts)
+            cls.CACHED[0] = index
+            cls.CACHED[1] = refdata
+            log.debug("built account index of {} accounts".format(len(index)))
+        return index
+
+    @classmethod
+    def clear(cls):
+        cls.CACHED[0] = None
+        cls.CACHED[1] = None
+
+    def __len__(self):
+        return len(self.byname)
+
+    def resolve(self, text):
+        """returns (accountid, name) for an exact name or account number, or None"""
+        text = text.strip()
+        if text.lower() in self.byname:
+            return self.byname[text.lower()]
+        return self.byid.get(text)
+
+    def prefixed(self, text):
+        text = text.lower()
+        names = []
+        i = bisect_left(self.names, text)
+        while i < len(self.names) and self.names[i].startswith(text):
+            names.append(self.byname[self.names[i]][1])
+            i += 1
+        return names
+
+    def similar(self, text):
+        """names ranked by the share of trigrams they have in common with text"""
+        tris = trigrams(text)
+        common = {}
+        for tri in tris:
+            for name in self.trigrams.get(tri, []):
+                common[name] = common.get(name, 0) + 1
+        scored = []
+        for name, count in common.items():
+            score = count / (len(tris) + self.ntrigrams[name] - count)
+            if score >= MINSIMILARITY:
+                scored.append((-score, name))
+        return [name for score, name in sorted(scored)]
+
+    def suggest(self, text, limit=MAXSUGGESTIONS):
+        """did you mean: accounts starting with text, then those spelt like it"""
+        text = text.strip()
+        if len(text) == 0:
+            return []
+        names = self.prefixed(text)
+        for name in self.similar(text):
+            if name not in names:
+                names.append(name)
+        return names[:limit]
@@ -0,0 +1,501 @@
+#
+# Copyright (c) 2018, Centrica Hive Ltd.
+#
+#     This file is part of chaim.
+#
+#     chaim is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     chaim is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with chaim.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Account and user audits
+
+Shared by the slack handlers in app.py and the command line runner.
+"""
+
+from collections import namedtuple
+from operator import attrgetter
+import os
+import re
+import sys
+import time
+
+from tabulate import tabulate
+
+from chalicelib.accountindex import AccountIndex
+from chalicelib.permissions import DataNotFound
+from chalicelib.refdata import RefData
+from chalicelib.snapshot import (
+    decodeSnapshot,
+    diffSnapshots,
+    displayDiff,
+    encodeSnapshot,
+    makeSnapshot,
+)
+from chalicelib.tracing import span
+
+
+def daysSince(lastused):
+    """the number of days since the lastused timestamp."""
+    if lastused == 0:
+        days = "Has never used chaim"
+    else:
+        now = int(time.time())
+        xlen = now - lastused
+        days = int(xlen / 86400)
+    return days
+
+
+# compact records for grants, namedtuples are a fraction of the size of dicts
+Role = namedtuple("Role", ["rid", "rname"])
+UserGrants = namedtuple("UserGrants", ["bucket", "days", "roles"])
+
+
+def roleRecord(rname, rid):
+    """Display record for one role, see userPermRow."""
+    # Ensure the basic roles are the last in the sorted list of user roles
+    # remove CrossAccount from the role name, the few role names are shared
+    return Role(
+        rid * 100 if rid < 101 else rid, sys.intern(rname.replace("CrossAccount", ""))
+    )
+
+
+BUCKETS = ("regular", "intermittent", "never")
+
+
+def usageThresholds():
+    """
+    The number of days within which a user must have last used chaim to be
+    counted as a regular or an intermittent user, from the environment.
+    """
+    try:
+        regular = int(os.environ.get("REGULARDAYS", 14))
+        intermittent = int(os.environ.get("INTERMITTENTDAYS", 60))
+        return regular, intermittent
+    except Exception as e:
+        msg = f"Exception in usageThresholds: {type(e).__name__}: {e}"
+        print(msg)
+        raise
+
+
+def usageColumns(thresholds=None):
+    """
+    SQL select columns for the last time a user used chaim, by slack or
+    cli, and the usage bucket that puts them in.
+    """
+    regular, intermittent = usageThresholds() if thresholds is None else thresholds
+    now = int(time.time())
+    lastused = "greatest(coalesce(u.lastslack, 0), coalesce(u.lastcli, 0))"
+    return f"""
+        {lastused} as lastused,
+        case
+        when {lastused} > {now - (regular * 86400)} then '{BUCKETS[0]}'
+        when {lastused} > {now - (intermittent * 86400)} then '{BUCKETS[1]}'
+        else '{BUCKETS[2]}'
+        end as bucket
+        """
+
+
+def getAccountUsers(account, pms, thresholds=None):
+    """
+    returns {username: UserGrants} for every user with a role in the
+    account, see usageColumns. The rows are streamed from the database.
+    """
+    try:
+        sql = f"""
+        select
+        u.name as uname, r.name as rname, r.id as rid,
+        {usageColumns(thresholds)}
+        from
+        useracctrolemap x, awsusers u, awsaccounts a, awsroles r
+        where
+        a.name='{account}'
+        and u.id=x.userid
+        and a.id=x.accountid
+        and r.id=x.roleid
+        order by u.name,r.id;
+        """
+        uname = 0
+        rname = 1
+        rid = 2
+        lastused = 3
+        bucket = 4
+        op = {}
+        for row in pms.readStream(sql):
+            if row[uname] not in op:
+                op[row[uname]] = UserGrants(
+                    sys.intern(row[bucket]), daysSince(row[lastused]), []
+                )
+            op[row[uname]].roles.append(roleRecord(row[rname], row[rid]))
+        for user in op:
+            op[user].roles.sort(key=attrgetter("rid"))
+        return op
+    except Exception as e:
+        msg = f"Exception in getAccountUsers: {type(e).__name__}: {e}"
+        print(msg)
+        raise
+
+
+def getUserAccounts(usernames, pms):
+    """
+    Generator over the grants of each of the named users in every account.
+
+    yields (username, days, {accountname: [roles]}) a user at a time,
+    as they are streamed from the database, days is as for daysSince.
+    """
+    if len(usernames) == 0:
+        return
+    try:
+        uname = 0
+        aname = 2
+        rname = 3
+        rid = 4
+        lastused = 5
+        current = None
+        days = None
+        op = {}
+        for row in pms.streamUserPerms(usernames):
+            if row[uname] != current:
+                if current is not None:
+                    yield current, days, sortData(op)
+                current = row[uname]
+                days = daysSince(row[lastused])
+                op = {}
+            if row[aname] not in op:
+                op[row[aname]] = []
+            op[row[aname]].append(roleRecord(row[rname], row[rid]))
+        if current is not None:
+            yield current, days, sortData(op)
+    except Exception as e:
+        msg = f"Exception in getUserAccounts: {type(e).__name__}: {e}"
+        print(msg)
+        raise
+
+
+def sortData(rows):
+    try:
+        op = {}
+        for name in rows:
+            op[name] = sorted(rows[name], key=attrgetter("rid"))
+        return op
+    except Exception as e:
+        msg = f"Exception in sortData: {type(e).__name__}: {e}"
+        print(msg)
+        raise
+
+
+def padLine(line, length=4):
+    try:
+        while len(line) < length:
+            line.append("")
+        return line
+    except Exception as e:
+        msg = f"Exception in padLine: {type(e).__name__}: {e}"
+        print(msg)
+        raise
+
+
+def userPermRow(row, username, days):
+    """Turns a user row into a display list for tabulate."""
+    try:
+        extras = []
+        line = []
+        for role in row:
+            # print(role)
+            if role.rid < 1000:
+                extras.append(role.rname)
+            else:
+                line.append(role.rname)
+        msg = f"{username} ({days})"
+        if len(line) > 0:
+            msg += "\n"
+            msg += tabulate([padLine(line)], tablefmt="plain")
+        if len(extras) > 0:
+            for extra in extras:
+                msg += f"\n{extra}"
+        msg += "\n----------------------------------------"
+        return msg
+    except Exception as e:
+        msg = f"Exception in userPermRow: {type(e).__name__}: {e}"
+        print(msg)
+        raise
+
+
+def iterSections(users, groups, thresholds=None):
+    """
+    Splits the users of an account into display sections by usage bucket,
+    yielding each section as soon as it is rendered.
+
+    yields [heading, [user texts]], the last section is the fixed SRE and
+    security group permissions with no heading.
+    """
+    try:
+        regular, intermittent = usageThresholds() if thresholds is None else thresholds
+        titles = {
+            "regular": f"Regular (used chaim in the last {regular} days)",
+            "intermittent": f"Intermittent (in the last {intermittent} days)",
+            "never": f"Not used chaim in the last {intermittent} days",
+        }
+        buckets = {bucket: [] for bucket in BUCKETS}
+        for user in users:
+            skip = False
+            for group in groups:
+                if user in group:
+                    skip = True
+            if skip:
+                continue
+            else:
+                buckets[users[user].bucket].append(user)
+        for bucket in BUCKETS:
+            if len(buckets[bucket]) > 0:
+                with span("render"):
+                    items = [
+                        userPermRow(users[user].roles, user, users[user].days)
+                        for user in buckets[bucket]
+                    ]
+                yield [titles[bucket], items]
+        groupperms = [
+            "SRE\nReadOnly  PowerUser  SysAdmin  AdminUser"
+            "\n----------------------------------------",
+            "Security\nReadOnly\n----------------------------------------",
+        ]
+        yield [None, groupperms]
+    except Exception as e:
+        msg = f"Exception in iterSections: {type(e).__name__}: {e}"
+        print(msg)
+        raise
+
+
+def accountSections(users, groups, thresholds=None):
+    """
+    Splits the users of an account into display sections by usage bucket.
+
+    returns a list of [heading, [user texts]], see iterSections.
+    """
+    return list(iterSections(users, groups, thresholds))
+
+
+def displaySections(sections):
+    """Renders display sections as plain text."""
+    try:
+        parts = []
+        for heading, items in sections:
+            text = "\n\n".join(items)
+            if heading is not None:
+                text = f"{heading}\n========================================\n{text}"
+            parts.append(text)
+        return "\n\n".join(parts)
+    except Exception as e:
+        msg = f"Exception in displaySections: {type(e).__name__}: {e}"
+        print(msg)
+        raise
+
+
+def displayPermissions(users, groups, thresholds=None):
+    """Renders the users of an account, grouped by their usage bucket."""
+    return displaySections(accountSections(users, groups, thresholds))
+
+
+def displayReport(title, sections):
+    """The slack mrkdwn text of an audit report, see accountReport."""
+    if len(sections) == 0:
+        return title
+    return f"{title}\n\n```{displaySections(sections)}```"
+
+
+def displayUserPermissions(username, days, accounts):
+    """Renders one user's grants, grouped by account."""
+    try:
+        op = f"{username} ({days})\n========================================"
+        for account in accounts:
+            op += "\n" + userPermRow(accounts[account], account, len(accounts[account]))
+        return op
+    except Exception as e:
+        msg = f"Exception in displayUserPermissions: {type(e).__name__}: {e}"
+        print(msg)
+        raise
+
+
+def parseUserNames(text, workspaceid, pms):
+    """
+    Splits the text of a user audit request into chaim usernames.
+
+    Accepts @name and slack escaped <@U1234|name> or <@U1234> mentions,
+    separated by spaces or commas.
+
+    returns [usernames, mentions of slack users with no chaim user]
+    """
+    try:
+        users = []
+        unknown = []
+        for mention in re.split(r"[\s,+]+", text.strip()):
+            m = re.match(r"^<@(\w+)(?:\|([^>]+))?>$", mention)
+            if m is None:
+                name = mention.lstrip("@")
+            elif m.group(2) is not None:
+                name = m.group(2)
+            else:
+                try:
+                    name = pms.userNameFromSlackIds(workspaceid, m.group(1))
+                except DataNotFound:
+                    unknown.append(mention)
+                    continue
+            if len(name) > 0:
+                users.append(name)
+        return [list(dict.fromkeys(users)), list(dict.fromkeys(unknown))]
+    except Exception as e:
+        msg = f"Exception in parseUserNames: {type(e).__name__}: {e}"
+        print(msg)
+        raise
+
+
+def userAudit(usernames, pms, unknown=None):
+    """
+    Reverse audit: the permissions of each user across all accounts.
+    unknown are the slack mentions that have no chaim user, see
+    parseUserNames.
+    """
+    try:
+        unknown = unknown or []
+        if len(usernames) == 0:
+            if len(unknown) == 0:
+                return "No user names given, try `@user.name`."
+            return "\n".join(f"no chaim user for {mention}" for mention in unknown)
+        title = "Permissions for user"
+        title += "s" if len(usernames) > 1 else ""
+        title += ": *" + ", ".join(usernames) + "*"
+        title += "\n\nThe number in brackets after the user is the number of days"
+        title += " since they last used chaim, after the account it is the number"
+        title += " of roles they have in it."
+        sections = []
+        found = []
+        for username, days, accounts in getUserAccounts(usernames, pms):
+            found.append(username)
+            sections.append(displayUserPermissions(username, days, accounts))
+        for username in usernames:
+            if username not in found:
+                sections.append(f"{username}: no chaim permissions found")
+        for mention in unknown:
+            sections.append(f"no chaim user for {mention}")
+        msg = "\n\n".join(sections)
+        return f"{title}\n\n```{msg}```"
+    except Exception as e:
+        msg = f"Exception in userAudit: {type(e).__name__}: {e}"
+        print(msg)
+        raise
+
+
+def auditDiff(account, accountid, snap, pms):
+    """
+    The changes to an account since the last audit snapshot.
+
+    returns [title, sections], see accountSections.
+    """
+    try:
+        last = pms.lastAuditSnapshot(accountid)
+        if last is None:
+            return [f"No previous audit of account *{account}* to compare with.", []]
+        taken, blob = last
+        when = time.strftime("%Y-%m-%d %H:%M", time.gmtime(taken))
+        changes = displayDiff(diffSnapshots(decodeSnapshot(blob), snap))
+        title = f"Changes to account *{account}* since the audit of {when} UTC"
+        if len(changes) == 0:
+            return [f"{title}\n\nNo changes.", []]
+        title += "\n\n+ user added, - user removed, ~ roles or usage changed"
+        return [title, [[None, [changes]]]]
+    except Exception as e:
+        msg = f"Exception in auditDiff: {type(e).__name__}: {e}"
+        print(msg)
+        raise
+
+
+def saveSnapshot(accountid, snap, pms):
+    """Stores the audit snapshot, failing to do so doesn't fail the audit."""
+    try:
+        pms.saveAuditSnapshot(accountid, encodeSnapshot(snap))
+    except Exception as e:
+        msg = f"Exception in saveSnapshot: {type(e).__name__}: {e}"
+        print(msg)
+
+
+def resolveAccount(account, pms):
+    """
+    Finds an account by name or number.
+
+    returns [accountid, name, None], or [None, account, not found text]
+    with suggestions of similar names.
+    """
+    index = AccountIndex.get(pms)
+    found = index.resolve(account)
+    if found is not None:
+        return [found[0], found[1], None]
+    # the account may be newer than the index
+    accountid = pms.singleField(
+        "awsaccounts", "id", "name", "Name", account, notfoundOK=True
+    )
+    if accountid is not None:
+        return [accountid, account, None]
+    text = f"Account {account} not found."
+    suggestions = index.suggest(account)
+    if len(suggestions) > 0:
+        text += f" Did you mean: {', '.join(suggestions)}?"
+    return [None, account, text]
+
+
+def accountTitle(account):
+    title = f"""Permissions for account: *{account}*"""
+    title += "\n\nThe number in brackets is the number of days since the"
+    title += " user last used chaim, from slack or the cli."
+    title += "\n(not necessarily last used chaim for this account)."
+    return title
+
+
+def accountGroups(pms):
+    """the members of the groups whose permissions are listed separately"""
+    groups = RefData.get(pms).groups
+    return (groups.get("SRE", []), groups.get("security", []))
+
+
+def accountReport(account, pms, diffmode=False):
+    """
+    Audits one account, by name or number, or the changes to it since
+    the last audit.
+
+    returns [accountid, snapshot, title, sections], accountid is None if
+    the account doesn't exist and the title suggests similar names.
+    See accountSections.
+    """
+    try:
+        accountid, account, notfound = resolveAccount(account, pms)
+        if accountid is None:
+            return [None, None, notfound, []]
+        users = getAccountUsers(account, pms)
+        snap = makeSnapshot(users)
+        if diffmode:
+            title, sections = auditDiff(account, accountid, snap, pms)
+        else:
+            sections = accountSections(users, accountGroups(pms))
+            title = accountTitle(account)
+        return [accountid, snap, title, sections]
+    except Exception as e:
+        msg = f"Exception in accountReport: {type(e).__name__}: {e}"
+        print(msg)
+        raise
+
+
+def accountAudit(account, pms, diffmode=False):
+    """
+    Audits one account, see accountReport.
+
+    returns [accountid, snapshot, text]
+    """
+    accountid, snap, title, sections = accountReport(account, pms, diffmode)
+    return [accountid, snap, displayReport(title, sections)]
@@ -0,0 +1,108 @@
+#
+# Copyright (c) 2018, Centrica Hive Ltd.
+#
+#     This file is part of chaim.
+#
+#     chaim is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     chaim is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with chaim.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Slack Block Kit rendering of audit reports, a page of users at a time
+"""
+import chalicelib.glue as glue
+
+log = glue.log
+
+# slack limits section text to 3000 characters
+MAXTEXT = 2900
+
+
+def textBlock(text):
+    return {"type": "section", "text": {"type": "mrkdwn", "text": text}}
+
+
+def pageButton(label, renderid, page):
+    return {
+        "type": "button",
+        "text": {"type": "plain_text", "text": label},
+        "action_id": "page{}".format(label.lower()),
+        "value": "{}:{}".format(renderid, page),
+    }
+
+
+def sectionBlocks(heading, items):
+    """
+    one or more section blocks for a heading and its items, split so that
+    each stays within the slack text limit
+    """
+    blocks = []
+    prefix = "*{}*\n".format(heading) if heading is not None else ""
+    chunk = []
+    for item in items:
+        item = item[:MAXTEXT - len(prefix) - 8]
+        size = len("\n\n".join(chunk + [item])) + len(prefix) + 6
+        if len(chunk) > 0 and size > MAXTEXT:
+            blocks.append(textBlock("{}```{}```".format(prefix, "\n\n".join(chunk))))
+            chunk = []
+        chunk.append(item)
+    if len(chunk) > 0:
+        blocks.append(textBlock("{}```{}```".format(prefix, "\n\n".join(chunk))))
+    return blocks
+
+
+def paginate(sections, pagesize=25):
+    """
+    splits [heading, [items]] sections into pages of at most pagesize items,
+    a section that runs over a page break carries on on the next page
+    """
+    pages = [[]]
+    count = 0
+    for heading, items in sections:
+        for item in items:
+            if count == pagesize:
+                pages.append([])
+                count = 0
+            page = pages[-1]
+            if len(page) == 0 or page[-1][0] != heading:
+                page.append([heading, []])
+            page[-1][1].append(item)
+            count += 1
+    return pages
+
+
+def renderPages(title, sections, renderid, pagesize=25):
+    """
+    renders an audit report, see chalicelib/audit.py accountReport,
+    as a list of pages of blocks with Prev/Next buttons that carry the
+    renderid and the page to show.
+    """
+    pages = paginate(sections, pagesize)
+    npages = len(pages)
+    rendered = []
+    for pageno, page in enumerate(pages):
+        blocks = [textBlock(title[:MAXTEXT])]
+        for heading, items in page:
+            blocks.extend(sectionBlocks(heading, items))
+        if npages > 1:
+            blocks.append({
+                "type": "context",
+                "elements": [{"type": "mrkdwn",
+                              "text": "Page {} of {}".format(pageno + 1, npages)}],
+            })
+            buttons = []
+            if pageno > 0:
+                buttons.append(pageButton("Prev", renderid, pageno - 1))
+            if pageno < npages - 1:
+                buttons.append(pageButton("Next", renderid, pageno + 1))
+            blocks.append({"type": "actions", "elements": buttons})
+        rendered.append(blocks)
+    return rendered
@@ -0,0 +1,72 @@
+#
+# Copyright (c) 2018, Centrica Hive Ltd.
+#
+#     This file is part of chaim.
+#
+#     chaim is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     chaim is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with chaim.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Bounded in-memory caches that live for the life of the container
+"""
+from collections import OrderedDict
+import time
+import chalicelib.glue as glue
+
+log = glue.log
+
+
+class LRUCache():
+    """
+    A dictionary that holds at most maxsize of the most recently used items,
+    each for at most ttl seconds if ttl is set.
+    """
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.expires = {}
+
+    def expired(self, key):
+        if self.ttl is not None and self.expires[key] <= time.time():
+            self.remove(key)
+            return True
+        return False
+
+    def get(self, key, default=None):
+        if key in self.items and not self.expired(key):
+            self.items.move_to_end(key)
+            return self.items[key]
+        return default
+
+    def put(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        if self.ttl is not None:
+            self.expires[key] = time.time() + self.ttl
+        while len(self.items) > self.maxsize:
+            oldest, _ = self.items.popitem(last=False)
+            self.expires.pop(oldest, None)
+
+    def remove(self, key):
+        self.items.pop(key, None)
+        self.expires.pop(key, None)
+
+    def clear(self):
+        self.items.clear()
+        self.expires.clear()
+
+    def __contains__(self, key):
+        return key in self.items and not self.expired(key)
+
+    def __len__(self):
+        return len(self.items)
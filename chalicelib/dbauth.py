@@ -0,0 +1,86 @@
+#
+# Copyright (c) 2018, Centrica Hive Ltd.
+#
+#     This file is part of chaim.
+#
+#     chaim is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     chaim is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with chaim.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Database passwords: IAM authentication tokens for RDS / RDS Proxy
+
+An IAM auth token is valid for 15 minutes, it is generated once and kept
+until shortly before then, for every connection the container opens.
+"""
+from abc import ABC, abstractmethod
+import time
+from chalicelib.botosession import BotoSession
+import chalicelib.glue as glue
+
+log = glue.log
+
+# seconds an IAM auth token is valid for
+TOKENLIFE = 900
+# stop using a token this many seconds before it expires
+TOKENMARGIN = 60
+
+
+class TokenProvider(ABC):
+    """
+    caches the tokens that generate(), which subclasses provide, makes per
+    host, port and user.
+    the cache is class level, so it is shared by every provider in
+    the container.
+    """
+
+    TOKENS = {}
+
+    @abstractmethod
+    def generate(self, host, port, user):
+        """returns a new token for user at host:port"""
+
+    def token(self, host, port, user):
+        key = (type(self).__name__, host, port, user)
+        cached = self.TOKENS.get(key)
+        if cached is not None and cached[1] > time.time():
+            return cached[0]
+        log.debug("generating db auth token for {}@{}".format(user, host))
+        token = self.generate(host, port, user)
+        self.TOKENS[key] = [token, time.time() + TOKENLIFE - TOKENMARGIN]
+        return token
+
+
+class RdsTokenProvider(TokenProvider, BotoSession):
+    def __init__(self, region=None, **kwargs):
+        BotoSession.__init__(self, **kwargs)
+        self.newClient("rds")
+        self.region = region
+
+    def generate(self, host, port, user):
+        return self.client.generate_db_auth_token(
+            DBHostname=host, Port=port, DBUsername=user, Region=self.region
+        )
+
+
+class LocalTokenProvider(TokenProvider):
+    """
+    stands in for RdsTokenProvider against a local database: the token is
+    the fixed password, generate() counts how often it is asked for one.
+    """
+
+    def __init__(self, password=""):
+        self.password = password
+        self.generated = 0
+
+    def generate(self, host, port, user):
+        self.generated += 1
+        return self.password
@@ -0,0 +1,166 @@
+#
+# Copyright (c) 2018, Centrica Hive Ltd.
+#
+#     This file is part of chaim.
+#
+#     chaim is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     chaim is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with chaim.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Streaming export of the account x user x role grant matrix
+
+Rows are read from an unbuffered cursor and written straight out as
+newline delimited json or csv, optionally gzipped, to a local file,
+stdout or an s3 object, so memory use doesn't grow with the estate.
+"""
+import csv
+import gzip
+import io
+import json
+import sys
+from chalicelib.botosession import BotoSession
+import chalicelib.glue as glue
+
+log = glue.log
+
+EXPORTFIELDS = ["accountid", "account", "user", "role", "lastslack", "lastcli"]
+
+
+class ExportFail(Exception):
+    pass
+
+
+class S3Writer(BotoSession):
+    """
+    write only file-like object that streams to an s3 object with a
+    multipart upload, holding at most one part in memory.
+    It has just enough of the io interface for io.TextIOWrapper and
+    gzip.GzipFile to write to it.
+    """
+
+    PARTSIZE = 8 * 1024 * 1024
+
+    def __init__(self, bucket, key, **kwargs):
+        super().__init__(**kwargs)
+        self.newClient("s3")
+        self.bucket = bucket
+        self.key = key
+        self.buffer = bytearray()
+        self.parts = []
+        self.closed = False
+        mpu = self.client.create_multipart_upload(Bucket=bucket, Key=key)
+        self.uploadid = mpu["UploadId"]
+
+    def readable(self):
+        return False
+
+    def seekable(self):
+        return False
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer.extend(data)
+        while len(self.buffer) >= self.PARTSIZE:
+            self.uploadPart(bytes(self.buffer[:self.PARTSIZE]))
+            del self.buffer[:self.PARTSIZE]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def uploadPart(self, data):
+        partno = len(self.parts) + 1
+        resp = self.client.upload_part(Bucket=self.bucket, Key=self.key,
+                                       UploadId=self.uploadid,
+                                       PartNumber=partno, Body=data)
+        self.parts.append({"ETag": resp["ETag"], "PartNumber": partno})
+
+    def close(self):
+        if self.closed:
+            return
+        if len(self.buffer) > 0 or len(self.parts) == 0:
+            self.uploadPart(bytes(self.buffer))
+            self.buffer = bytearray()
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.uploadid,
+            MultipartUpload={"Parts": self.parts})
+        self.closed = True
+
+    def abort(self):
+        if not self.closed:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key,
+                                               UploadId=self.uploadid)
+            self.closed = True
+
+
+def openTarget(target):
+    """
+    returns a binary file-like object for target, which is a file name,
+    '-' for stdout or s3://bucket/key
+    """
+    if target == "-":
+        return sys.stdout.buffer
+    if target.startswith("s3://"):
+        bucket, _, key = target[5:].partition("/")
+        if len(bucket) == 0 or len(key) == 0:
+            raise ExportFail("invalid s3 target: {}".format(target))
+        return S3Writer(bucket, key)
+    return open(target, "wb")
+
+
+def writeRows(ofn, rows, fmt="ndjson"):
+    """writes rows to the text stream ofn, returns the number written"""
+    count = 0
+    if fmt == "csv":
+        writer = csv.writer(ofn)
+        writer.writerow(EXPORTFIELDS)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    elif fmt == "ndjson":
+        for row in rows:
+            ofn.write(json.dumps(dict(zip(EXPORTFIELDS, row)), default=str))
+            ofn.write("\n")
+            count += 1
+    else:
+        raise ExportFail("unknown export format: {}".format(fmt))
+    return count
+
+
+def exportGrants(pms, target, fmt="ndjson", gz=False):
+    """
+    streams every grant to target, see openTarget
+    returns the number of rows exported
+    """
+    sink = openTarget(target)
+    try:
+        out = gzip.GzipFile(fileobj=sink, mode="wb") if gz else sink
+        text = io.TextIOWrapper(out, encoding="utf-8", newline="")
+        count = writeRows(text, pms.streamGrants(), fmt)
+        text.flush()
+        text.detach()
+        if gz:
+            out.close()
+        if sink is not sys.stdout.buffer:
+            sink.close()
+        else:
+            sink.flush()
+        log.info("exported {} grants to {}".format(count, target))
+        return count
+    except Exception as e:
+        msg = "exportGrants failed: {}: {}".format(type(e).__name__, e)
+        log.error(msg)
+        if isinstance(sink, S3Writer):
+            sink.abort()
+        raise ExportFail(msg)
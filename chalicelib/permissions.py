@@ -17,9 +17,18 @@
 #     along with chaim.  If not, see <http://www.gnu.org/licenses/>.
 #
 # from chalicelib.cognitoclient import CognitoClient
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import os
+import time
+
+from chalicelib.cache import LRUCache
+from chalicelib.dbauth import RdsTokenProvider
 from chalicelib.paramstore import ParamStore
+from chalicelib.resilience import CircuitOpen
 from chalicelib.slackiamdb import SlackIamDB
-from chalicelib.slackiamdb import DBNotConnected
+from chalicelib.slackiamdb import DBNotConnected, DBDOWN
+from chalicelib.tracing import span
 from chalicelib.utils import Utils
 import chalicelib.glue as glue
 
@@ -43,10 +52,50 @@ class InvalidEmailAddress(Exception):
 
 
 class Permissions:
+
+    WHOSKEY_CACHE = LRUCache(4096)
+    WHOSKEY_BATCH = 500
+    # (username, account, role): userAllowed decision
+    ALLOWED_TTL = 60
+    ALLOWED_CACHE = LRUCache(4096, ttl=ALLOWED_TTL)
+    # (workspaceid, slackid): chaim username
+    SLACKUSER_CACHE = LRUCache(4096, ttl=300)
+    # ssm path: workspace slack token or slack api token
+    WORKSPACE_TOKENS = LRUCache(64, ttl=900)
+    # username: [cli token, expires]
+    USERTOKEN_CACHE = LRUCache(4096, ttl=60)
+    # concurrent identity provider calls in provisionUsers
+    PROVISION_WORKERS = 8
+    # names per "in (...)" lookup in existingSlackUsers
+    SQL_IN_BATCH = 500
+    # keymap rows per multi-row insert in flushWrites
+    KEYMAP_INSERT_BATCH = 500
+    # audit snapshots kept per account, older ones are deleted on save
+    SNAPSHOT_KEEP = int(os.environ.get("SNAPSHOTKEEP", 10))
+    # seconds a replica may be behind the primary and still be read
+    MAXLAG = int(os.environ.get("DBMAXLAG", 30))
+    # seconds between checks of a replica's health and lag
+    LAGCHECK = 30
+    # seconds to wait for a replica connection, failing over is the retry
+    REPLICA_CONNECTTIMEOUT = 2
+    # seconds a query can take. Kept well inside the lambda timeout (30s),
+    # which the connection outlives, so it can't follow the deadline.
+    READTIMEOUT = 10
+    # host: [usable, checked at], for the life of the container
+    REPLICA_STATE = {}
+
     def __init__(
         self, secretpath="", testdb=False, quick=False, stagepath="", missing=False
     ):
         log.debug("Permissions Entry")
+        # write-behind buffers, see deferWrites
+        self.deferring = False
+        self.keymapbuffer = []
+        self.lastusedbuffer = {}
+        # read replicas, see readsid
+        self.replicahosts = []
+        self.replicas = {}
+        self.dbopts = {}
         self.missing = missing
         self.spath = secretpath
         self.env = stagepath if len(stagepath) > 0 else "prod"
@@ -64,36 +113,174 @@ class Permissions:
             "dbrwuser",
             "dbrwpass",
             "poolid",
+            "dbreplicas",
         ]
-        self.params = self.ps.getParams(plist, environment=self.env)
+        with span("ssm"):
+            self.params = self.ps.getParams(plist, environment=self.env)
         if len(self.params) == 0:
             raise IncorrectCredentials("failed to retrieve my parameters")
         self.topicarn = self.params["snstopicarn"]
         self.slackapitoken = None
         if not quick:
             self.fromslack = False
-            self.connectDB(testdb)
+            with span("db_connect"):
+                self.connectDB(testdb)
             # self.slackapitoken = self.params["slackapitoken"]
 
     def connectDB(self, testdb=False):
+        """
+        connects with the ro and rw users. Set DBIAMAUTH=1 to authenticate
+        with IAM auth tokens rather than the passwords (eg through an RDS
+        Proxy), DBSSLCA to the CA bundle to use tls (required for IAM auth)
+        and DBPORT, DBCONNECTTIMEOUT and DBREADTIMEOUT as needed.
+        """
         if testdb:
             dbhost = "127.0.0.1"
         else:
             dbhost = self.params["dbhost"]
         dbrouser = self.params["dbrouser"]
-        dbropass = self.params["dbropass"]
         dbrwuser = self.params["dbrwuser"]
-        dbrwpass = self.params["dbrwpass"]
         dbdb = self.params["dbdb"]
+        tokens = None
+        sslca = os.environ.get("DBSSLCA", "")
+        if os.environ.get("DBIAMAUTH", "0") not in ("", "0"):
+            if len(sslca) == 0:
+                # an auth token is a password, it is never sent in the clear
+                raise DBNotConnected("DBIAMAUTH needs DBSSLCA, refusing to connect")
+            tokens = RdsTokenProvider(region=os.environ.get("AWS_REGION"))
+        readtimeout = os.environ.get("DBREADTIMEOUT", str(self.READTIMEOUT))
+        dbopts = {
+            "port": int(os.environ.get("DBPORT", 3306)),
+            "tokens": tokens,
+            "ssl": {"ca": sslca} if len(sslca) > 0 else None,
+            "connecttimeout": int(os.environ.get("DBCONNECTTIMEOUT", 5)),
+            "readtimeout": int(readtimeout) if len(readtimeout) > 0 else None,
+        }
+        self.dbopts = dbopts
+        replicas = self.params.get("dbreplicas", "")
+        hosts = [host.strip() for host in replicas.split(",")]
+        self.replicahosts = [host for host in hosts if len(host) > 0]
+        if testdb:
+            self.replicahosts = []
         if dbhost is not None:
-            self.sid = SlackIamDB(dbhost, dbrouser, dbropass, dbdb)
+            dbropass = self.params.get("dbropass")
+            dbrwpass = self.params.get("dbrwpass")
+            self.sid = SlackIamDB(
+                dbhost, dbrouser, dbropass, dbdb, autocommit=True, **dbopts
+            )
             log.debug("Created db connection ok")
-            self.rwsid = SlackIamDB(dbhost, dbrwuser, dbrwpass, dbdb)
+            self.rwsid = SlackIamDB(dbhost, dbrwuser, dbrwpass, dbdb, **dbopts)
             log.debug("Created rw db connection ok")
         else:
             self.sid = None
             self.rwsid = None
 
+    def replicaDB(self, host):
+        """
+        the read only connection to a replica, opened on first use.
+        Connecting is tried once, with a short timeout, as a replica that is
+        down is failed over to the primary.
+        """
+        if host not in self.replicas:
+            dbopts = dict(self.dbopts)
+            dbopts["connecttimeout"] = min(
+                dbopts["connecttimeout"], self.REPLICA_CONNECTTIMEOUT
+            )
+            self.replicas[host] = SlackIamDB(
+                host,
+                self.params["dbrouser"],
+                self.params.get("dbropass"),
+                self.params["dbdb"],
+                name="db:{}".format(host),
+                autocommit=True,
+                connectattempts=1,
+                **dbopts,
+            )
+        return self.replicas[host]
+
+    def replicaLag(self, rsid):
+        """
+        seconds the replica is behind, None if replication has stopped.
+        0 if the host isn't a binlog replica (i.e. an Aurora reader).
+        Needs the REPLICATION CLIENT privilege.
+        """
+        rows = rsid.query("show slave status")
+        if len(rows) == 0:
+            return 0
+        for name in ("Seconds_Behind_Source", "Seconds_Behind_Master"):
+            if name in rsid.columns:
+                return rows[0][rsid.columns.index(name)]
+        return None
+
+    def replicaUsable(self, host):
+        """checks a replica's connection and lag, at most every LAGCHECK seconds"""
+        state = self.REPLICA_STATE.get(host)
+        if state is not None and time.time() - state[1] < self.LAGCHECK:
+            return state[0]
+        try:
+            lag = self.replicaLag(self.replicaDB(host))
+            usable = lag is not None and lag <= self.MAXLAG
+            if not usable:
+                log.warning("replica {} is {}s behind".format(host, lag))
+        except Exception as e:
+            log.warning("replica {} unavailable: {}".format(host, e))
+            self.replicas.pop(host, None)
+            usable = False
+        self.REPLICA_STATE[host] = [usable, time.time()]
+        return usable
+
+    def replicaDown(self, host):
+        self.REPLICA_STATE[host] = [False, time.time()]
+        self.replicas.pop(host, None)
+
+    def readsid(self):
+        """
+        the connection for reads that can be served by a replica: the
+        first usable replica in dbreplicas, or the primary if there is none.
+        Writes, and reads of what was just written, use sid and rwsid.
+        REPLICA_STATE is shared by every object in the container, so a
+        replica marked usable may not have a connection on this object yet.
+        """
+        for host in self.replicahosts:
+            if self.replicaUsable(host):
+                try:
+                    return self.replicaDB(host)
+                except DBDOWN + (CircuitOpen,) as e:
+                    log.warning("replica {} unavailable: {}".format(host, e))
+                    self.replicaDown(host)
+        return self.sid
+
+    def readQuery(self, sql, args=None):
+        """a query on a replica, on the primary if the replica fails"""
+        rsid = self.readsid()
+        try:
+            return rsid.query(sql, args)
+        except DBDOWN + (CircuitOpen,):
+            if rsid is self.sid:
+                raise
+            self.replicaDown(rsid.dbhost)
+            return self.sid.query(sql, args)
+
+    def readStream(self, sql, args=None):
+        """
+        a streamed query on a replica, on the primary if the replica fails
+        before the first row
+        """
+        rsid = self.readsid()
+        rows = rsid.streamQuery(sql, args)
+        try:
+            first = next(rows)
+        except StopIteration:
+            return
+        except DBDOWN + (CircuitOpen,):
+            if rsid is self.sid:
+                raise
+            self.replicaDown(rsid.dbhost)
+            yield from self.sid.streamQuery(sql, args)
+            return
+        yield first
+        yield from rows
+
     def getEncKey(self, keyname, extrapath=None):
         param = None
         spath = self.spath if self.spath.endswith("/") else self.spath + "/"
@@ -114,6 +301,10 @@ class Permissions:
         returns the chaim username for the user with the
         given workspace and slack ids
         """
+        key = (workspaceid, slackid)
+        username = self.SLACKUSER_CACHE.get(key)
+        if username is not None:
+            return username
         try:
             if self.sid is not None:
                 sql = "select a.name from awsusers a, slackmap b where a.id = b.userid "
@@ -143,8 +334,13 @@ class Permissions:
             emsg += "Exception: {}: {}".format(type(e).__name__, e)
             log.error(emsg)
             raise
+        self.SLACKUSER_CACHE.put(key, username)
         return username
 
+    def invalidateSlackUser(self, workspaceid, slackid):
+        """forget a cached slack user mapping, when it changes"""
+        self.SLACKUSER_CACHE.remove((workspaceid, slackid))
+
     def userNameFromSlackId(self, slackid):
         """returns the chaim username for the slackid"""
         try:
@@ -191,11 +387,29 @@ class Permissions:
             log.debug("path: {}".format(path))
         return path
 
+    def workspaceToken(self, workspaceid, name, refresh=False):
+        """
+        a workspace's slack token from ssm, cached for the WORKSPACE_TOKENS
+        ttl. refresh fetches it again, i.e. after it has been rotated.
+        """
+        path = self.buildPath((self.spath, workspaceid, self.env, name))
+        token = None if refresh else self.WORKSPACE_TOKENS.get(path)
+        if token is None:
+            log.debug("asking for {}".format(path))
+            # ParamStore keeps parameters forever, the ttl is kept here
+            self.ps.FETCHED_PARAMS.pop(path, None)
+            token = self.ps.getParam(path, True)
+            self.WORKSPACE_TOKENS.put(path, token)
+        return token
+
+    def invalidateWorkspaceTokens(self, workspaceid):
+        """forget a workspace's cached tokens, when they are rotated"""
+        for name in ("slacktoken", "slackapitoken"):
+            path = self.buildPath((self.spath, workspaceid, self.env, name))
+            self.WORKSPACE_TOKENS.remove(path)
+
     def setSlackApiToken(self, workspaceid):
-        pargs = (self.spath, workspaceid, self.env, "slackapitoken")
-        path = self.buildPath(pargs)
-        log.debug("asking for {}".format(path))
-        self.slackapitoken = self.ps.getParam(path, True)
+        self.slackapitoken = self.workspaceToken(workspaceid, "slackapitoken")
 
     def checkToken(self, token, username, workspaceid):
         log.debug(
@@ -204,17 +418,15 @@ class Permissions:
             )
         )
         ut = Utils()
-        pargs = (self.spath, workspaceid, self.env, "slacktoken")
-        path = self.buildPath(pargs)
-        # path = self.spath + workspaceid + "/" + self.env + "/slacktoken"
-        log.debug("asking for {}".format(path))
-        slacktoken = self.ps.getParam(path, True)
-        # slacktoken = self.params["slacktoken"]
-        if slacktoken == token:
-            self.fromslack = True
-            self.setSlackApiToken(workspaceid)
-            return True
-        else:
+        # the cached tokens first, then fresh ones in case they have changed
+        for refresh in (False, True):
+            slacktoken = self.workspaceToken(workspaceid, "slacktoken", refresh)
+            if slacktoken == token:
+                self.fromslack = True
+                self.setSlackApiToken(workspaceid)
+                return True
+            if refresh:
+                self.USERTOKEN_CACHE.remove(username)
             clitoken, expires = self.readUserToken(username)
             if token == clitoken:
                 if expires > ut.getNow():
@@ -254,47 +466,59 @@ class Permissions:
             raise DBNotConnected("No connection to database")
 
     def userAllowed(self, username, account, role):
+        """
+        checks that the user has the role in the account (by name or number)
+        with one query, raises DataNotFound if not.
+        Decisions are cached for ALLOWED_TTL seconds.
+        returns [True, accountid]
+        """
         log.debug("userAllowed test: {} {} {}".format(username, account, role))
-        if self.sid is not None:
-            userid = self.checkIDs("awsusers", "name", "User", username)
-            ut = Utils()
-            if ut.isNumeric(account):
-                accountid = account
-                self.derivedaccountname = self.sid.singleField(
-                    "awsaccounts", "name", "id='{}'".format(accountid)
-                )
-            else:
-                accountid = self.checkIDs("awsaccounts", "name", "Account", account)
-                log.debug(
-                    "userAllowed: username: {}, account:{}, role: {}, accountid is {}".format(
-                        username, account, role, accountid
-                    )
-                )
-                if accountid is None:
-                    return [False, None]
-                self.derivedaccountname = account
-            roleid = self.checkIDs("awsroles", "name", "Role", role)
-            sql = "select * from useracctrolemap where "
-            sql += "accountid='{}'".format(accountid)
-            sql += " and "
-            sql += "roleid={}".format(roleid)
-            sql += " and "
-            sql += "userid={}".format(userid)
-            rowa = self.sid.query(sql)
-            if len(rowa):
-                return [True, accountid]
-            else:
-                msg = "Permission not granted to {} in {} for {}".format(
-                    username, account, role
-                )
-                raise DataNotFound(msg)
-        else:
+        key = (username, account, role)
+        decision = self.ALLOWED_CACHE.get(key)
+        if decision is None:
+            decision = self.allowedDecision(username, account, role)
+            self.ALLOWED_CACHE.put(key, decision)
+        allowed, accountid, accountname, msg = decision
+        if not allowed:
+            raise DataNotFound(msg)
+        self.derivedaccountname = accountname
+        return [True, accountid]
+
+    def allowedDecision(self, username, account, role):
+        """returns [allowed, accountid, accountname, reason]"""
+        if self.sid is None:
             raise DBNotConnected("No connection to Database")
+        wfield = "a.id" if Utils().isNumeric(account) else "a.name"
+        sql = "select a.id, a.name, u.id, r.id, exists(select 1 from useracctrolemap m"
+        sql += " where m.accountid=a.id and m.userid=u.id and m.roleid=r.id)"
+        sql += " from awsaccounts a left join awsusers u on u.name=%s"
+        sql += " left join awsroles r on r.name=%s"
+        sql += " where {}=%s limit 1".format(wfield)
+        rows = self.sid.query(sql, [username, role, account])
+        if len(rows) == 0:
+            msg = self.createDataNotFoundMessage("Account", account)
+            return [False, None, None, msg]
+        row = rows[0]
+        accountid, accountname = row[0], row[1]
+        userid, roleid, granted = row[2], row[3], row[4]
+        if userid is None:
+            return [False, None, None, self.createDataNotFoundMessage("User", username)]
+        if roleid is None:
+            return [False, None, None, self.createDataNotFoundMessage("Role", role)]
+        if not granted:
+            msg = "Permission not granted to {} in {} for {}".format(
+                username, account, role
+            )
+            return [False, accountid, accountname, msg]
+        return [True, accountid, accountname, None]
 
     def updateKeyMap(self, username, accountid, accesskey, expires):
         try:
             if self.rwsid is not None:
                 userid = self.checkIDs("awsusers", "name", "User", username)
+                if self.deferring:
+                    self.keymapbuffer.append([userid, accountid, accesskey, expires])
+                    return
                 sql = "INSERT INTO keymap "
                 sql += "(userid, accountid, accesskey, expires) VALUES "
                 sql += "({}, '{}', '{}', {})".format(
@@ -335,6 +559,102 @@ class Permissions:
             raise DataNotFound(msg)
         return [tfr, afrows]
 
+    def estimateKeyMap(self, then):
+        """
+        returns index backed estimates of the number of rows in the keymap
+        table and the number of them that expired before then
+        """
+        sql = "select table_rows from information_schema.tables "
+        sql += "where table_schema=database() and table_name='keymap'"
+        rows = self.sid.query(sql)
+        tfr = int(rows[0][0]) if len(rows) > 0 and rows[0][0] is not None else 0
+        sql = "explain select accesskey from keymap where expires < {}".format(then)
+        rows = self.sid.query(sql)
+        icol = self.sid.columns.index("rows")
+        afrows = sum(int(row[icol] or 0) for row in rows)
+        return [tfr, afrows]
+
+    def cleanKeyMapBatched(
+        self,
+        days=30,
+        batchsize=1000,
+        pause=0.5,
+        dryrun=False,
+        startafter=None,
+        deadline=None,
+        progress=None,
+    ):
+        """
+        deletes expired keys from the keymap in batches of at most batchsize
+        rows, committing each batch and sleeping for pause seconds between
+        them so that live key issuance is not held up behind the locks.
+
+        startafter is the [expires, accesskey] checkpoint from a previous run,
+        deadline is an epoch time to stop by, progress is called with the
+        result dict after each batch.
+
+        returns a dict of the totals, the checkpoint of the last deleted
+        key and whether there are more to delete.
+        """
+        ut = Utils()
+        then = ut.getNow() - (days * 24 * 60 * 60)
+        res = {
+            "total": 0,
+            "deleted": 0,
+            "batches": 0,
+            "checkpoint": startafter,
+            "complete": False,
+        }
+        try:
+            if dryrun:
+                res["total"], res["deleted"] = self.estimateKeyMap(then)
+                res["complete"] = True
+                return res
+            if self.rwsid is None:
+                raise (DBNotConnected("no r/w connection to DB"))
+            while True:
+                if deadline is not None and time.time() > deadline:
+                    log.info("cleanKeyMapBatched: out of time, stopping")
+                    break
+                sql = "select expires, accesskey from keymap "
+                sql += "where expires < {}".format(then)
+                if res["checkpoint"] is not None:
+                    lastexp, lastkey = res["checkpoint"]
+                    sql += " and (expires > {} or (expires = {} and accesskey > {}))".format(
+                        int(lastexp), int(lastexp), self.rwsid.sqlStr(lastkey)
+                    )
+                sql += " order by expires, accesskey limit {}".format(int(batchsize))
+                rows = self.rwsid.query(sql)
+                if len(rows) == 0:
+                    res["complete"] = True
+                    break
+                keys = ",".join([self.rwsid.sqlStr(row[1]) for row in rows])
+                sql = "delete from keymap where expires < {} and accesskey in ({})".format(
+                    then, keys
+                )
+                res["deleted"] += self.rwsid.deleteQuery(sql)
+                res["batches"] += 1
+                res["checkpoint"] = [rows[-1][0], rows[-1][1]]
+                log.info(
+                    "cleanKeyMapBatched: batch {}, deleted {} so far".format(
+                        res["batches"], res["deleted"]
+                    )
+                )
+                if progress is not None:
+                    progress(res)
+                if len(rows) < batchsize:
+                    res["complete"] = True
+                    break
+                time.sleep(pause)
+            res["total"] = self.estimateKeyMap(then)[0]
+        except Exception as e:
+            msg = "A cleanKeyMapBatched error occurred: {}: {}".format(
+                type(e).__name__, e
+            )
+            log.error(msg)
+            raise DataNotFound(msg)
+        return res
+
     def updateUserToken(self, username, token, expires):
         ret = False
         try:
@@ -351,6 +671,7 @@ class Permissions:
                     affectedrows = self.rwsid.updateQuery(sql)
                 else:
                     affectedrows = self.rwsid.insertQuery(sql)
+                self.USERTOKEN_CACHE.remove(username)
                 if affectedrows == 1:
                     ret = True
             else:
@@ -361,6 +682,9 @@ class Permissions:
             raise DataNotFound(e)
 
     def readUserToken(self, username):
+        cached = self.USERTOKEN_CACHE.get(username)
+        if cached is not None:
+            return cached
         token = expires = None
         try:
             sql = "select token, tokenexpires from awsusers where name='{}'".format(
@@ -370,6 +694,7 @@ class Permissions:
             if len(rows) > 0:
                 token = rows[0][0]
                 expires = rows[0][1]
+                self.USERTOKEN_CACHE.put(username, [token, expires])
         except Exception as e:
             msg = "A readUserToken error occurred: {}: {}".format(type(e).__name__, e)
             log.error(msg)
@@ -440,6 +765,7 @@ class Permissions:
                 if cc.adminCreateUser(self.params["poolid"], slackname, email):
                     sql = self.slackMapInsert(cid, slackid, workspaceid)
                     naf = self.rwsid.insertQuery(sql)
+                    self.invalidateSlackUser(workspaceid, slackid)
                     if naf == 1:
                         return True
             return False
@@ -461,6 +787,135 @@ class Permissions:
             userid = 0
         return userid
 
+    def existingSlackUsers(self, names):
+        """
+        returns ({username: userid}, {(username, slackid, workspaceid)}) for
+        the names that are already chaim users, in one query per
+        SQL_IN_BATCH names. Reads the primary, provisioning writes next.
+        """
+        userids = {}
+        mapped = set()
+        for start in range(0, len(names), self.SQL_IN_BATCH):
+            batch = names[start:start + self.SQL_IN_BATCH]
+            sql = "select u.name, u.id, s.slackid, s.workspaceid from awsusers u"
+            sql += " left join slackmap s on s.userid=u.id"
+            sql += " where u.name in ({})".format(",".join(["%s"] * len(batch)))
+            for name, userid, slackid, workspaceid in self.rwsid.query(sql, batch):
+                userids[name] = userid
+                if slackid is not None:
+                    mapped.add((name, slackid, workspaceid))
+        return [userids, mapped]
+
+    def provisionUsers(self, users, idp=None, workers=None):
+        """
+        creates chaim users in bulk, users is a list of
+        [name, slackid, workspaceid, email].
+
+        The existing users and slack mappings are found in one query, the
+        identity provider (a CognitoClient by default, if this build has
+        one, otherwise every user to create fails) users are created
+        concurrently, at most workers at a time, then the new awsusers and
+        slackmap rows are inserted in one transaction, so a database failure
+        leaves nothing half done in the database. The identity provider
+        users it leaves behind are picked up when provisioning is re-run: a
+        user the identity provider refuses to create because it already has
+        them counts as created.
+
+        returns a list of {"name", "status", "reason"} in the order of users,
+        status is created, mapped (a new slack mapping for an existing
+        user), exists or failed.
+        """
+        if self.rwsid is None:
+            raise DBNotConnected("no connection to db for provisionUsers")
+        ut = Utils()
+        results = [{"name": user[0], "status": None, "reason": None} for user in users]
+
+        def fail(i, reason):
+            results[i]["status"] = "failed"
+            results[i]["reason"] = reason
+
+        valid = []
+        for i, (name, slackid, workspaceid, email) in enumerate(users):
+            if " " in name:
+                fail(i, "Invalid chaim name: {}".format(name))
+            elif not ut.checkIsEmailAddress(email):
+                fail(i, "invalid email address: {}".format(email))
+            else:
+                valid.append(i)
+        names = list(dict.fromkeys(users[i][0] for i in valid))
+        userids, mapped = self.existingSlackUsers(names)
+        pending = []
+        for i in valid:
+            key = tuple(users[i][:3])
+            if key in mapped:
+                results[i]["status"] = "exists"
+                results[i]["reason"] = "Chaim user already exists: {}".format(key[0])
+            else:
+                # a repeat of the same user in users is an exists too
+                mapped.add(key)
+                pending.append(i)
+        if len(pending) > 0 and idp is None:
+            try:
+                from chalicelib.cognitoclient import CognitoClient
+            except ImportError as e:
+                log.error("provisionUsers has no identity provider: {}".format(e))
+                for i in pending:
+                    fail(i, "no identity provider: {}".format(e))
+                return results
+            idp = CognitoClient()
+
+        def idpHas(name):
+            return isinstance(idp.adminGetUser(self.params["poolid"], name), dict)
+
+        def idpCreate(i):
+            name, email = users[i][0], users[i][3]
+            try:
+                if idp.adminCreateUser(self.params["poolid"], name, email):
+                    return True
+            except Exception:
+                # left behind by a run whose database insert failed
+                if idpHas(name):
+                    return True
+                raise
+            return idpHas(name)
+
+        created = []
+        with ThreadPoolExecutor(max_workers=workers or self.PROVISION_WORKERS) as pool:
+            futures = [[i, pool.submit(idpCreate, i)] for i in pending]
+            for i, future in futures:
+                try:
+                    if future.result():
+                        created.append(i)
+                    else:
+                        fail(i, "identity provider did not create the user")
+                except Exception as e:
+                    fail(i, "identity provider: {}: {}".format(type(e).__name__, e))
+        if len(created) == 0:
+            return results
+        newnames = dict.fromkeys(users[i][0] for i in created)
+        newnames = [name for name in newnames if name not in userids]
+        try:
+            if len(newnames) > 0:
+                sql = "insert into awsusers (name) values (%s)"
+                self.rwsid.executeMany(sql, [[name] for name in newnames])
+                userids.update(self.existingSlackUsers(newnames)[0])
+            sql = "insert into slackmap (userid, slackid, workspaceid)"
+            sql += " values (%s, %s, %s)"
+            rows = [[userids[users[i][0]], users[i][1], users[i][2]] for i in created]
+            self.rwsid.executeMany(sql, rows)
+            self.rwsid.commit()
+        except Exception as e:
+            self.rwsid.rollback()
+            log.error("provisionUsers failed, rolled back: {}".format(e))
+            for i in created:
+                fail(i, "database: {}: {}".format(type(e).__name__, e))
+            return results
+        for i in created:
+            name, slackid, workspaceid = users[i][:3]
+            results[i]["status"] = "created" if name in newnames else "mapped"
+            self.invalidateSlackUser(workspaceid, slackid)
+        return results
+
     def findCognitoUser(self, username):
         ret = None
         msg = "User not found in Cognito DB: {}".format(username)
@@ -480,13 +935,40 @@ class Permissions:
 
     def accountList(self):
         sql = "select * from awsaccounts order by name asc"
-        return self.sid.query(sql)
+        return self.readQuery(sql)
+
+    def accountIdNames(self):
+        sql = "select id, name from awsaccounts"
+        return [[row[0], row[1]] for row in self.readQuery(sql)]
+
+    def groupMembers(self):
+        """returns {group name: [user names]} for every group"""
+        sql = "select f.name, u.name from groupusermap g, awsusers u, awsgroups f"
+        sql += " where u.id=g.userid and g.groupid=f.id"
+        group = 0
+        username = 1
+        groups = {}
+        for row in self.readQuery(sql):
+            groups.setdefault(row[group], []).append(row[username])
+        return groups
+
+    def refDataVersion(self):
+        """
+        a version of the reference tables, see chalicelib/refdata.py.
+        Changes whenever any row of them does.
+        """
+        sql = "checksum table awsaccounts, awsgroups, groupusermap"
+        return ",".join(str(row[1]) for row in self.readQuery(sql))
+
+    def accountNames(self):
+        sql = "select name from awsaccounts order by name asc"
+        return [row[0] for row in self.readQuery(sql)]
 
     def whosKey(self, key):
         sql = "select k.accesskey, k.expires, u.name, a.name from keymap k, awsusers u, awsaccounts a where"
         sql += " k.accesskey='{}' ".format(key)
         sql += "and u.id=k.userid and a.id=k.accountid"
-        row = self.sid.query(sql)
+        row = self.readQuery(sql)
         if len(row) > 0:
             msg = "key: {}, search: {}".format(key, row)
             log.debug(msg)
@@ -494,6 +976,34 @@ class Permissions:
             log.debug("key {} not found.".format(key))
         return row
 
+    def whosKeys(self, keys):
+        """
+        resolves a list of access keys with one query per WHOSKEY_BATCH keys
+        returns a dict of key: [accesskey, expires, username, accountname]
+        with None for the keys that are not in the keymap
+        """
+        found = {}
+        missing = []
+        for key in keys:
+            row = self.WHOSKEY_CACHE.get(key)
+            if row is not None:
+                found[key] = row
+            elif key not in missing:
+                missing.append(key)
+        log.debug(
+            "whosKeys: {} cached, {} to look up".format(len(found), len(missing))
+        )
+        for i in range(0, len(missing), self.WHOSKEY_BATCH):
+            batch = missing[i : i + self.WHOSKEY_BATCH]
+            sql = "select k.accesskey, k.expires, u.name, a.name"
+            sql += " from keymap k, awsusers u, awsaccounts a"
+            sql += " where k.accesskey in ({})".format(",".join(["%s"] * len(batch)))
+            sql += " and u.id=k.userid and a.id=k.accountid"
+            for row in self.readQuery(sql, batch):
+                found[row[0]] = list(row)
+                self.WHOSKEY_CACHE.put(row[0], list(row))
+        return {key: found.get(key) for key in keys}
+
     def roleAliasDict(self):
         radict = {}
         sql = "select alias, name from awsroles"
@@ -508,10 +1018,117 @@ class Permissions:
     def lastupdated(self, userid, stamp, cli=False):
         if self.rwsid is not None:
             field = "lastslack" if cli is False else "lastcli"
+            if self.deferring:
+                key = (userid, field)
+                self.lastusedbuffer[key] = max(stamp, self.lastusedbuffer.get(key, 0))
+                return
             sql = "update awsusers set {}={} where id={}".format(field, stamp, userid)
             log.debug("update: {}".format(sql))
             self.rwsid.updateQuery(sql)
 
+    @contextmanager
+    def deferWrites(self):
+        """
+        buffers the keymap inserts and last used updates made inside the
+        with block and writes them in one transaction when it ends.
+        If the database is down they stay buffered and are written by the
+        next flush, the Permissions object is kept for the life of the
+        container. The flush isn't retried, a retried commit could be
+        applied twice. An exception from the block wins over one from the
+        flush.
+        """
+        self.deferring = True
+        try:
+            yield self
+        except BaseException:
+            self.deferring = False
+            try:
+                self.flushWrites()
+            except Exception as e:
+                log.error("flushWrites after an exception failed: {}".format(e))
+            raise
+        self.deferring = False
+        self.flushWrites()
+
+    def flushWrites(self):
+        """
+        writes the buffered keymap rows with multi-row inserts and the last
+        used times, the latest per user, with one update per field, in one
+        transaction.
+        If the database is down the writes are kept for the next flush. If
+        it refuses them (i.e. a duplicate access key) they are written one
+        at a time and the ones that still fail are logged and dropped, so
+        that one bad row can't block every later flush.
+        returns the number of buffered writes dealt with.
+        """
+        keymap = list(self.keymapbuffer)
+        lastused = dict(self.lastusedbuffer)
+        if len(keymap) == 0 and len(lastused) == 0:
+            return 0
+        try:
+            self.writeBuffered(keymap, lastused)
+        except DBDOWN + (CircuitOpen,) as e:
+            log.error("flushWrites failed, the writes are kept: {}".format(e))
+            raise
+        except Exception as e:
+            log.error("flushWrites failed, writing one at a time: {}".format(e))
+            self.writeSeparately(keymap, lastused)
+            return len(keymap) + len(lastused)
+        self.forgetWrites(keymap, lastused)
+        return len(keymap) + len(lastused)
+
+    def writeBuffered(self, keymap, lastused):
+        """writes keymap rows and last used times in one transaction"""
+        try:
+            for start in range(0, len(keymap), self.KEYMAP_INSERT_BATCH):
+                batch = keymap[start:start + self.KEYMAP_INSERT_BATCH]
+                sql = "insert into keymap (userid, accountid, accesskey, expires)"
+                sql += " values "
+                sql += ",".join(["(%s, %s, %s, %s)"] * len(batch))
+                self.rwsid.query(sql, [val for row in batch for val in row])
+            for field in ("lastslack", "lastcli"):
+                stamps = [[k[0], v] for k, v in lastused.items() if k[1] == field]
+                if len(stamps) > 0:
+                    sql = "update awsusers set {0}=greatest(coalesce({0}, 0), case id"
+                    sql += " when %s then %s" * len(stamps)
+                    sql += " end) where id in ({1})"
+                    sql = sql.format(field, ",".join(["%s"] * len(stamps)))
+                    args = [val for row in stamps for val in row]
+                    self.rwsid.query(sql, args + [row[0] for row in stamps])
+            self.rwsid.commit()
+        except Exception:
+            self.rwsid.rollback()
+            raise
+
+    def writeSeparately(self, keymap, lastused):
+        """
+        writes each keymap row, then the last used times, in transactions
+        of their own, dropping the ones the database refuses
+        """
+        for row in keymap:
+            try:
+                self.writeBuffered([row], {})
+            except DBDOWN + (CircuitOpen,):
+                raise
+            except Exception as e:
+                log.error("dropped keymap row for {}: {}".format(row[2], e))
+            self.forgetWrites([row], {})
+        try:
+            self.writeBuffered([], lastused)
+        except DBDOWN + (CircuitOpen,):
+            raise
+        except Exception as e:
+            log.error("dropped {} last used times: {}".format(len(lastused), e))
+        self.forgetWrites([], lastused)
+
+    def forgetWrites(self, keymap, lastused):
+        """removes writes that have been made, or dropped, from the buffers"""
+        for row in keymap:
+            self.keymapbuffer.remove(row)
+        for key, stamp in lastused.items():
+            if self.lastusedbuffer.get(key) == stamp:
+                del self.lastusedbuffer[key]
+
     def countLastSince(self, months=1):
         if self.sid is not None:
             ut = Utils()
@@ -519,25 +1136,25 @@ class Permissions:
             now = ut.getNow()
             then = now - (int(months) * 86400 * 30)
             sql = "select count(id) as cn from awsusers"
-            rows = self.sid.query(sql)
+            rows = self.readQuery(sql)
             log.debug("sql returns {}".format(rows))
             allusers = rows[0][0]
             log.debug("allusers {}".format(allusers))
             sql = "select count(lastcli) as cn from awsusers where lastcli > " + str(
                 then
             )
-            rows = self.sid.query(sql)
+            rows = self.readQuery(sql)
             log.debug("sql returns {}".format(rows))
             lastcli = rows[0][0]
             sql = (
                 "select count(lastslack) as cn from awsusers where lastslack > "
                 + str(then)
             )
-            rows = self.sid.query(sql)
+            rows = self.readQuery(sql)
             lastslack = rows[0][0]
             sql = "select count(lastcli) as cn from awsusers"
             sql += " where lastcli > " + str(then) + " and lastslack > " + str(then)
-            rows = self.sid.query(sql)
+            rows = self.readQuery(sql)
             lastboth = rows[0][0]
             active = (int(lastslack) + int(lastcli)) - int(lastboth)
             inactive = int(allusers) - active
@@ -552,6 +1169,68 @@ class Permissions:
         else:
             return "DB not connected"
 
+    def streamUserPerms(self, users):
+        """
+        generator of the grants for all the named users, ordered by user,
+        account name and role id.
+        yields (username, accountid, accountname, rolename, roleid, lastused)
+        """
+        sql = "select u.name as uname, a.id as aid, a.name as aname,"
+        sql += " r.name as rname, r.id as rid,"
+        sql += " greatest(coalesce(u.lastslack, 0), coalesce(u.lastcli, 0)) as lastused"
+        sql += " from"
+        sql += " useracctrolemap x, awsusers u, awsaccounts a, awsroles r"
+        sql += " where u.name in ({})".format(",".join(["%s"] * len(users)))
+        sql += " and u.id=x.userid and a.id=x.accountid and r.id=x.roleid"
+        sql += " order by u.name,a.name,r.id"
+        return self.readStream(sql, list(users))
+
+    def saveAuditSnapshot(self, accountid, blob):
+        """
+        stores an encoded audit snapshot, see chalicelib/snapshot.py, and
+        deletes all but the newest SNAPSHOT_KEEP snapshots of the account
+        """
+        if self.rwsid is None:
+            raise DBNotConnected("no r/w connection to DB")
+        ut = Utils()
+        sql = "insert into auditsnapshot (accountid, taken, snapshot) values (%s, %s, %s)"
+        ret = self.rwsid.insertQuery(sql, [accountid, ut.getNow(), blob])
+        self.pruneAuditSnapshots(accountid)
+        return ret
+
+    def pruneAuditSnapshots(self, accountid, keep=None):
+        """
+        deletes the account's snapshots older than its newest keep
+        (SNAPSHOT_KEEP), returns the number deleted. The derived table has a
+        limit, so mysql materialises it rather than reading the table being
+        deleted from.
+        """
+        keep = self.SNAPSHOT_KEEP if keep is None else keep
+        sql = "delete from auditsnapshot where accountid=%s and taken < ("
+        sql += "select taken from (select taken from auditsnapshot"
+        sql += " where accountid=%s order by taken desc limit 1 offset %s) newest)"
+        return self.rwsid.deleteQuery(sql, [accountid, accountid, keep - 1])
+
+    def lastAuditSnapshot(self, accountid):
+        """returns [taken, blob] for the latest snapshot of the account or None"""
+        sql = "select taken, snapshot from auditsnapshot where accountid=%s"
+        sql += " order by taken desc limit 1"
+        rows = self.sid.query(sql, [accountid])
+        if len(rows) > 0:
+            return [rows[0][0], rows[0][1]]
+        return None
+
+    def streamGrants(self):
+        """
+        generator of every grant in the estate, see chalicelib/export.py
+        yields (accountid, accountname, username, rolename, lastslack, lastcli)
+        """
+        sql = "select a.id, a.name, u.name, r.name, u.lastslack, u.lastcli from"
+        sql += " useracctrolemap x, awsusers u, awsaccounts a, awsroles r"
+        sql += " where u.id=x.userid and a.id=x.accountid and r.id=x.roleid"
+        sql += " order by a.name,u.name,r.id"
+        return self.readStream(sql)
+
     def listuserperms(self, user):
         try:
             sql = "select a.id as aid, a.name as aname, u.name as uname, r.name as rname, r.id as rid, r.alias as alias from"
@@ -559,7 +1238,7 @@ class Permissions:
             sql += " where u.name='{}'".format(user)
             sql += " and u.id=x.userid and a.id=x.accountid and r.id=x.roleid"
             sql += " order by a.name,r.id"
-            return self.sid.query(sql)
+            return self.readQuery(sql)
         except Exception as e:
             msg = "A pms.listuserperms error occurred: {}: {}".format(
                 type(e).__name__, e
@@ -0,0 +1,105 @@
+#
+# Copyright (c) 2018, Centrica Hive Ltd.
+#
+#     This file is part of chaim.
+#
+#     chaim is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     chaim is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with chaim.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Opt-in profiling of production invocations
+
+Turned on for every invocation by setting CHAIMPROFILE=1 in the lambda
+environment, or for one by adding the hidden --profile flag to the slash
+command text. The top CHAIMPROFILETOP (default 20) functions by cumulative
+time and allocation sites are logged, and if CHAIMPROFILEDUMP is set to
+a local path or s3://bucket/prefix/ the full pstats are written there.
+
+Callers should only import this module once profiling has been asked for,
+so that there is no cost when it is off.
+"""
+import cProfile
+import io
+import os
+import pstats
+import time
+import tracemalloc
+from contextlib import contextmanager
+from chalicelib.botosession import BotoSession
+import chalicelib.glue as glue
+
+log = glue.log
+
+FLAG = "--profile"
+
+
+def stripFlag(text):
+    """removes the hidden flag from the slash command text"""
+    return " ".join([word for word in text.split() if word != FLAG])
+
+
+def dumpStats(prof, label, target):
+    """writes the full pstats to a local path or under s3://bucket/prefix/"""
+    fname = "{}-{}.pstats".format(label, int(time.time()))
+    if target.startswith("s3://"):
+        bucket, _, prefix = target[5:].partition("/")
+        local = os.path.join("/tmp", fname)
+        prof.dump_stats(local)
+        bs = BotoSession()
+        bs.newClient("s3")
+        bs.client.upload_file(local, bucket, prefix + fname)
+        os.remove(local)
+        return "s3://{}/{}{}".format(bucket, prefix, fname)
+    if os.path.isdir(target):
+        target = os.path.join(target, fname)
+    prof.dump_stats(target)
+    return target
+
+
+def summary(prof, snap, topn=20):
+    """compact text of the hottest functions and allocation sites"""
+    sio = io.StringIO()
+    stats = pstats.Stats(prof, stream=sio)
+    stats.strip_dirs().sort_stats("cumulative").print_stats(topn)
+    lines = ["profile: top {} by cumulative time".format(topn)]
+    for line in sio.getvalue().splitlines():
+        if len(line.strip()) > 0 and not line.startswith("   Ordered by"):
+            lines.append(line.rstrip())
+    lines.append("profile: top {} allocation sites".format(topn))
+    for stat in snap.statistics("lineno")[:topn]:
+        lines.append(str(stat))
+    return "\n".join(lines)
+
+
+@contextmanager
+def profiled(label):
+    topn = int(os.environ.get("CHAIMPROFILETOP", 20))
+    prof = cProfile.Profile()
+    tracemalloc.start()
+    prof.enable()
+    try:
+        yield prof
+    finally:
+        prof.disable()
+        snap = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(summary(prof, snap, topn))
+        print("profile: traced memory peak {:.1f} KiB".format(peak / 1024))
+        target = os.environ.get("CHAIMPROFILEDUMP", "")
+        if len(target) > 0:
+            try:
+                print("profile: stats written to {}".format(
+                    dumpStats(prof, label, target)))
+            except Exception as e:
+                log.error("failed to write profile stats: {}: {}".format(
+                    type(e).__name__, e))
@@ -0,0 +1,138 @@
+#
+# Copyright (c) 2018, Centrica Hive Ltd.
+#
+#     This file is part of chaim.
+#
+#     chaim is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     chaim is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with chaim.  If not, see <http://www.gnu.org/licenses/>.
+"""
+The reference tables (accounts and groups) kept in a local file
+
+A cold container loads them from the file rather than querying the
+tables, after checking the file's version against the database with one
+CHECKSUM TABLE. The file is a json header line, holding the database
+version and a sha256 of the payload, followed by the json payload, and is
+read through mmap. In the lambdas it lives in /tmp, for the cli in the
+user's cache directory; set REFCACHE to put it somewhere else.
+"""
+import hashlib
+import json
+import mmap
+import os
+import time
+import chalicelib.glue as glue
+
+log = glue.log
+
+FORMAT = 2
+# seconds between version checks in a warm container
+REFRESH = 60
+
+
+def cachePath():
+    if "REFCACHE" in os.environ:
+        return os.environ["REFCACHE"]
+    if "AWS_LAMBDA_FUNCTION_NAME" in os.environ:
+        return "/tmp/chaim-refdata"
+    cachedir = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+    return os.path.join(cachedir, "chaim", "refdata")
+
+
+class RefData:
+    # [RefData, version checked at], for the life of the container
+    CACHED = [None, 0]
+
+    def __init__(self, version, accounts, groups):
+        """accounts: [[accountid, name]], groups: {group name: [user names]}"""
+        self.version = version
+        self.accounts = accounts
+        self.groups = groups
+
+    @classmethod
+    def get(cls, pms):
+        """
+        the reference data, checked against the database at most every
+        REFRESH seconds and only read from it when the version has changed
+        """
+        refdata, checked = cls.CACHED
+        if refdata is not None and time.time() - checked < REFRESH:
+            return refdata
+        version = pms.refDataVersion()
+        if refdata is None or refdata.version != version:
+            path = cachePath()
+            refdata = cls.load(path)
+            if refdata is None or refdata.version != version:
+                log.debug("reading reference data version {}".format(version))
+                refdata = cls.fromDB(pms, version)
+                refdata.save(path)
+        cls.CACHED[0] = refdata
+        cls.CACHED[1] = time.time()
+        return refdata
+
+    @classmethod
+    def clear(cls):
+        cls.CACHED[0] = None
+        cls.CACHED[1] = 0
+
+    @classmethod
+    def fromDB(cls, pms, version):
+        return cls(version, pms.accountIdNames(), pms.groupMembers())
+
+    def encode(self):
+        payload = json.dumps(
+            {"accounts": self.accounts, "groups": self.groups},
+            separators=(",", ":"),
+        ).encode()
+        header = {
+            "format": FORMAT,
+            "version": self.version,
+            "hash": hashlib.sha256(payload).hexdigest(),
+        }
+        return json.dumps(header).encode() + b"\n" + payload
+
+    @classmethod
+    def decode(cls, buf):
+        """buf is bytes or an mmap, returns None unless it is complete and current"""
+        eol = buf.find(b"\n")
+        if eol < 0:
+            return None
+        header = json.loads(buf[:eol])
+        payload = buf[eol + 1:]
+        if header.get("format") != FORMAT:
+            return None
+        if hashlib.sha256(payload).hexdigest() != header.get("hash"):
+            log.warning("reference data cache is corrupt, ignoring it")
+            return None
+        data = json.loads(payload)
+        return cls(header["version"], data["accounts"], data["groups"])
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(path, "rb") as ifn:
+                with mmap.mmap(ifn.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                    return cls.decode(buf)
+        except (OSError, ValueError) as e:
+            log.debug("no reference data cache at {}: {}".format(path, e))
+            return None
+
+    def save(self, path):
+        """writes the cache file atomically, a failure only costs a cache miss"""
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = "{}.{}".format(path, os.getpid())
+            with open(tmp, "wb") as ofn:
+                ofn.write(self.encode())
+            os.replace(tmp, path)
+        except OSError as e:
+            log.warning("failed to save reference data to {}: {}".format(path, e))
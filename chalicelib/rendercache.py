@@ -0,0 +1,68 @@
+#
+# Copyright (c) 2018, Centrica Hive Ltd.
+#
+#     This file is part of chaim.
+#
+#     chaim is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     chaim is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with chaim.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Cache of rendered audit pages
+
+The audit is rendered by the SNS handler and the pages are served by the
+interactivity route, which run in different lambdas, so the pages are
+kept in s3 with an in-memory copy in front.
+Expire the objects under PREFIX with a bucket lifecycle rule.
+"""
+import gzip
+import json
+from chalicelib.botosession import BotoSession
+from chalicelib.cache import LRUCache
+import chalicelib.glue as glue
+
+log = glue.log
+
+
+class RenderCache(BotoSession):
+
+    PREFIX = "renders/"
+    RENDERS = LRUCache(32)
+
+    def __init__(self, bucket, **kwargs):
+        super().__init__(**kwargs)
+        self.bucket = bucket
+        self.newClient("s3")
+
+    def objectKey(self, renderid):
+        return "{}{}.json.gz".format(self.PREFIX, renderid)
+
+    def put(self, renderid, pages):
+        body = gzip.compress(json.dumps(pages, separators=(",", ":")).encode())
+        self.client.put_object(Bucket=self.bucket, Key=self.objectKey(renderid),
+                               Body=body, ContentType="application/json",
+                               ContentEncoding="gzip")
+        self.RENDERS.put(renderid, pages)
+
+    def get(self, renderid):
+        """returns the cached pages or None if they have gone"""
+        pages = self.RENDERS.get(renderid)
+        if pages is not None:
+            return pages
+        try:
+            obj = self.client.get_object(Bucket=self.bucket,
+                                         Key=self.objectKey(renderid))
+            pages = json.loads(gzip.decompress(obj["Body"].read()).decode())
+        except self.client.exceptions.NoSuchKey:
+            log.warning("rendered pages not found: {}".format(renderid))
+            return None
+        self.RENDERS.put(renderid, pages)
+        return pages
@@ -0,0 +1,142 @@
+#
+# Copyright (c) 2018, Centrica Hive Ltd.
+#
+#     This file is part of chaim.
+#
+#     chaim is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     chaim is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with chaim.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Retries and circuit breakers for calls to the database and to Slack
+
+Retries are bounded, jittered and never sleep past the invocation's
+deadline. A breaker opens after repeated failures of its dependency and
+fails calls straight away until it has had time to recover, so that a
+broken database doesn't hold every lambda for its full timeout.
+"""
+import random
+import time
+import chalicelib.glue as glue
+
+log = glue.log
+
+# epoch seconds by which the current invocation has to finish, see setDeadline
+DEADLINE = None
+# seconds kept back from the deadline for the reply to slack
+DEADLINEMARGIN = 3
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """
+    closed: calls go through. After failures consecutive failures the
+    breaker opens and calls fail with CircuitOpen for reset seconds, then
+    one trial call is let through: success closes it, failure reopens it.
+    """
+
+    def __init__(self, name, failures=3, reset=30):
+        self.name = name
+        self.failures = failures
+        self.reset = reset
+        self.count = 0
+        self.openeduntil = 0
+
+    def isOpen(self):
+        return self.count >= self.failures and time.time() < self.openeduntil
+
+    def check(self):
+        if self.isOpen():
+            raise CircuitOpen("{} is unavailable, failing fast".format(self.name))
+
+    def success(self):
+        self.count = 0
+        self.openeduntil = 0
+
+    def failure(self):
+        self.count += 1
+        if self.count >= self.failures:
+            if self.count == self.failures:
+                log.error("circuit open for {}".format(self.name))
+            self.openeduntil = time.time() + self.reset
+
+
+# name: CircuitBreaker, for the life of the container
+BREAKERS = {}
+
+
+def breaker(name):
+    if name not in BREAKERS:
+        BREAKERS[name] = CircuitBreaker(name)
+    return BREAKERS[name]
+
+
+def setDeadline(deadline):
+    """deadline in epoch seconds, or None for no deadline"""
+    global DEADLINE
+    DEADLINE = deadline
+
+
+def remaining():
+    """seconds left before the deadline, less the margin, None if no deadline"""
+    if DEADLINE is None:
+        return None
+    return DEADLINE - DEADLINEMARGIN - time.time()
+
+
+def limit(timeout, least=0.5):
+    """
+    timeout cut down to the time left before the deadline, so that a call
+    started late can't outlast the invocation. Never below least seconds.
+    """
+    left = remaining()
+    if left is None:
+        return timeout
+    return max(least, min(timeout, left))
+
+
+def backoff(attempt, base=0.2, cap=2.0):
+    """full jitter exponential backoff"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def call(
+    name, func, retryon=(Exception,), attempts=3, base=0.2, cap=2.0, timeout=0
+):
+    """
+    calls func() through the named breaker, retrying the exceptions in
+    retryon up to attempts times in all while there is time left. timeout
+    is how long one attempt can take: a retry is only made if the backoff
+    and another attempt both fit before the deadline.
+    """
+    brk = breaker(name)
+    attempt = 0
+    while True:
+        brk.check()
+        try:
+            ret = func()
+            brk.success()
+            return ret
+        except retryon as e:
+            brk.failure()
+            attempt += 1
+            wait = backoff(attempt, base, cap)
+            left = remaining()
+            outoftime = left is not None and wait + timeout > left
+            if attempt >= attempts or brk.isOpen() or outoftime:
+                raise
+            log.warning(
+                "{} failed ({}), retry {} in {:.2f}s".format(name, e, attempt, wait)
+            )
+            time.sleep(wait)
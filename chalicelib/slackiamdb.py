@@ -17,30 +17,65 @@
 #     along with chaim.  If not, see <http://www.gnu.org/licenses/>.
 import pymysql
 import chalicelib.glue as glue
+from chalicelib.resilience import breaker, call, limit
+from chalicelib.tracing import span
 
 log = glue.log
 
+# errors that mean the database is unreachable rather than the sql is wrong
+DBDOWN = (pymysql.err.OperationalError, pymysql.err.InterfaceError)
+
 
 class DBNotConnected(Exception):
     pass
 
 
 class SlackIamDB():
-    def __init__(self, dbhost, dbuser, dbpass, dbdb):
+    def __init__(self, dbhost, dbuser, dbpass, dbdb, port=3306, tokens=None,
+                 ssl=None, connecttimeout=10, readtimeout=None, name="db",
+                 autocommit=False, connectattempts=3):
+        """
+        tokens is a chalicelib.dbauth TokenProvider, when set dbpass is
+        ignored and an IAM auth token is used as the password.
+        ssl is a pymysql ssl dict (eg {"ca": "/path/to/rds-ca.pem"}),
+        IAM authentication needs it.
+        name is the circuit breaker this connection reports to.
+        autocommit ends each statement's transaction straight away, use it
+        for read only connections that are kept open between invocations,
+        otherwise they keep reading the snapshot of their first query.
+        connectattempts is how many times connecting is tried.
+        """
         log.debug("SlackIamDB Entry")
         self.dbhost = dbhost
         self.dbuser = dbuser
         self.dbpass = dbpass
         self.dbdb = dbdb
+        self.port = port
+        self.tokens = tokens
+        self.ssl = ssl
+        self.connecttimeout = connecttimeout
+        self.readtimeout = readtimeout
+        self.name = name
+        self.autocommit = autocommit
+        self.connectattempts = connectattempts
         self.connected = False
         self.affectedrows = 0
         self.lastinsertid = 0
+        self.columns = []
         self.connect()
 
     def connect(self):
         try:
-            self.con = pymysql.connect(self.dbhost, user=self.dbuser,
-                                       passwd=self.dbpass, db=self.dbdb)
+            passwd = self.dbpass
+            if self.tokens is not None:
+                passwd = self.tokens.token(self.dbhost, self.port, self.dbuser)
+            self.con = call(self.name, lambda: pymysql.connect(
+                host=self.dbhost, port=self.port, user=self.dbuser,
+                passwd=passwd, db=self.dbdb, ssl=self.ssl,
+                connect_timeout=limit(self.connecttimeout),
+                read_timeout=self.readtimeout, autocommit=self.autocommit),
+                retryon=DBDOWN, attempts=self.connectattempts,
+                timeout=self.connecttimeout)
             log.debug("SlackIamDB connect ok to {}".format(self.dbhost))
             self.connected = True
         except Exception as e:
@@ -49,17 +84,39 @@ class SlackIamDB():
             self.connected = False
             raise
 
-    def query(self, sql):
+    def ping(self):
+        """
+        checks the connection is still up, reconnecting if it has gone.
+        connect() rather than pymysql reconnects, so that an expired auth
+        token is replaced.
+        """
+        try:
+            self.con.ping(reconnect=False)
+            self.connected = True
+        except Exception as e:
+            log.warning("SlackIamDB ping failed, reconnecting: {}".format(e))
+            self.connect()
+
+    def query(self, sql, args=None):
         rows = []
         if self.connected:
             try:
+                breaker(self.name).check()
                 with self.con.cursor() as cur:
                     log.debug("query: {}".format(sql))
-                    self.affectedrows = cur.execute(sql)
+                    with span("db_query"):
+                        self.affectedrows = cur.execute(sql, args)
                     self.lastinsertid = cur.lastrowid
+                    if cur.description is not None:
+                        self.columns = [col[0] for col in cur.description]
+                    else:
+                        self.columns = []
                     for row in cur:
                         rows.append(row)
+                breaker(self.name).success()
             except Exception as e:
+                if isinstance(e, DBDOWN):
+                    breaker(self.name).failure()
                 msg = "Failed to execute query: {}.".format(sql)
                 msg += ". Exception was: {}".format(e)
                 log.error(msg)
@@ -71,6 +128,34 @@ class SlackIamDB():
         log.debug("query completed successfully.")
         return rows
 
+    def streamQuery(self, sql, args=None):
+        """
+        generator that yields rows from an unbuffered cursor so that
+        large result sets are never held in memory.
+        The connection can't be used for anything else until it is exhausted.
+        """
+        if not self.connected:
+            msg = "DB Not connected, cannot execute query:{}".format(sql)
+            log.error(msg)
+            raise(DBNotConnected(msg))
+        try:
+            breaker(self.name).check()
+            with self.con.cursor(pymysql.cursors.SSCursor) as cur:
+                log.debug("stream query: {}".format(sql))
+                with span("db_query"):
+                    cur.execute(sql, args)
+                self.columns = [col[0] for col in cur.description]
+                for row in cur:
+                    yield row
+            breaker(self.name).success()
+        except Exception as e:
+            if isinstance(e, DBDOWN):
+                breaker(self.name).failure()
+            msg = "Failed to execute query: {}.".format(sql)
+            msg += ". Exception was: {}".format(e)
+            log.error(msg)
+            raise
+
     def singleField(self, table, field, where=None):
         sql = "select " + field + " from " + table
         if where is not None:
@@ -83,21 +168,53 @@ class SlackIamDB():
             ret = None
         return ret
 
-    def updateQuery(self, sql):
-        self.query(sql)
+    def updateQuery(self, sql, args=None):
+        self.query(sql, args)
         self.con.commit()
         return self.affectedrows
 
-    def insertQuery(self, sql):
-        self.query(sql)
+    def insertQuery(self, sql, args=None):
+        self.query(sql, args)
         self.con.commit()
         return self.affectedrows
 
-    def deleteQuery(self, sql):
-        self.query(sql)
+    def deleteQuery(self, sql, args=None):
+        self.query(sql, args)
         self.con.commit()
         return self.affectedrows
 
+    def executeMany(self, sql, argslist):
+        """
+        runs sql once for each set of args in argslist without committing,
+        so that several statements can go in one transaction, see commit.
+        """
+        if not self.connected:
+            msg = "DB Not connected, cannot execute query:{}".format(sql)
+            log.error(msg)
+            raise(DBNotConnected(msg))
+        try:
+            breaker(self.name).check()
+            with self.con.cursor() as cur:
+                log.debug("executemany: {} ({} rows)".format(sql, len(argslist)))
+                with span("db_query"):
+                    self.affectedrows = cur.executemany(sql, argslist)
+                self.lastinsertid = cur.lastrowid
+            breaker(self.name).success()
+        except Exception as e:
+            if isinstance(e, DBDOWN):
+                breaker(self.name).failure()
+            msg = "Failed to execute query: {}.".format(sql)
+            msg += ". Exception was: {}".format(e)
+            log.error(msg)
+            raise
+        return self.affectedrows
+
+    def commit(self):
+        self.con.commit()
+
+    def rollback(self):
+        self.con.rollback()
+
     def sqlStr(self, xstr):
         return "'" + xstr + "'"
 
@@ -0,0 +1,117 @@
+#
+# Copyright (c) 2018, Centrica Hive Ltd.
+#
+#     This file is part of chaim.
+#
+#     chaim is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     chaim is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with chaim.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Decoding and verifying the requests that Slack sends
+
+Slash commands and interactivity payloads arrive as url encoded forms
+signed with the application's signing secret, see
+https://api.slack.com/authentication/verifying-requests-from-slack
+The ack route decodes the form once and hands the fields to doSNSReq as
+json.
+"""
+import hashlib
+import hmac
+import json
+import os
+import time
+from urllib.parse import parse_qsl
+import chalicelib.glue as glue
+
+log = glue.log
+
+VERSION = "v0"
+# seconds a request timestamp may be away from now, to stop replays
+MAXAGE = 300
+# ssm parameter name, under SECRETPATH
+SECRETNAME = "slacksigningsecret"
+
+# the signing secret, for the life of the container
+SECRET = {}
+
+
+class InvalidSignature(Exception):
+    pass
+
+
+def decodeForm(body):
+    """
+    decodes a url encoded form into a dict, each key and value decoded on
+    its own so that an encoded & or = in a value is kept.
+    """
+    return {k.strip(): v.strip() for k, v in parse_qsl(body, keep_blank_values=True)}
+
+
+def decodeMessage(message):
+    """the fields from an SNS message: json, or a form from an older ack route"""
+    if message.startswith("{"):
+        return json.loads(message)
+    return decodeForm(message)
+
+
+def signature(secret, timestamp, body):
+    base = "{}:{}:{}".format(VERSION, timestamp, body)
+    mac = hmac.new(secret.encode(), base.encode(), hashlib.sha256)
+    return "{}={}".format(VERSION, mac.hexdigest())
+
+
+def verify(secret, headers, body, now=None):
+    """raises InvalidSignature unless the request was signed by slack"""
+    timestamp = headers.get("X-Slack-Request-Timestamp")
+    sig = headers.get("X-Slack-Signature")
+    if timestamp is None or sig is None:
+        raise InvalidSignature("request is not signed")
+    now = time.time() if now is None else now
+    try:
+        age = abs(now - int(timestamp))
+    except ValueError:
+        raise InvalidSignature("bad request timestamp: {}".format(timestamp))
+    if age > MAXAGE:
+        raise InvalidSignature("request timestamp is {} seconds old".format(age))
+    if not hmac.compare_digest(signature(secret, timestamp, body), sig):
+        raise InvalidSignature("signature mismatch")
+
+
+def signingSecret():
+    """the signing secret from ssm, fetched once per container"""
+    if "secret" not in SECRET:
+        from chalicelib.paramstore import ParamStore
+
+        spath = os.environ.get("SECRETPATH", "/sre/chaim/")
+        spath = spath if spath.endswith("/") else spath + "/"
+        SECRET["secret"] = ParamStore().getParam(spath + SECRETNAME, dcrypt=True)
+    return SECRET["secret"]
+
+
+def signedHeaders(body, now=None):
+    """
+    headers for a form post of body signed as slack would sign it, for the
+    requests the app makes to itself (i.e. keepWarm), unless SLACKVERIFY=0
+    """
+    headers = {"Content-Type": "application/x-www-form-urlencoded"}
+    if os.environ.get("SLACKVERIFY", "1") != "0":
+        timestamp = str(int(time.time() if now is None else now))
+        headers["X-Slack-Request-Timestamp"] = timestamp
+        headers["X-Slack-Signature"] = signature(signingSecret(), timestamp, body)
+    return headers
+
+
+def verifyRequest(headers, body):
+    """verifies a request against the signing secret, unless SLACKVERIFY=0"""
+    if os.environ.get("SLACKVERIFY", "1") == "0":
+        return
+    verify(signingSecret(), headers, body)
@@ -0,0 +1,109 @@
+#
+# Copyright (c) 2018, Centrica Hive Ltd.
+#
+#     This file is part of chaim.
+#
+#     chaim is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     chaim is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with chaim.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Compact account audit snapshots and the differences between them
+
+A snapshot is a dict of
+    grants: sorted list of [username, rolename]
+    buckets: {username: usage bucket}
+"""
+import json
+import zlib
+import chalicelib.glue as glue
+
+log = glue.log
+
+
+def makeSnapshot(users):
+    """makes a snapshot from the output of getAccountUsers"""
+    grants = []
+    buckets = {}
+    for user in users:
+        buckets[user] = users[user].bucket
+        for role in users[user].roles:
+            grants.append([user, role.rname])
+    return {"grants": sorted(grants), "buckets": buckets}
+
+
+def encodeSnapshot(snap):
+    return zlib.compress(json.dumps(snap, separators=(",", ":")).encode())
+
+
+def decodeSnapshot(blob):
+    return json.loads(zlib.decompress(blob).decode())
+
+
+def diffSnapshots(old, new):
+    """
+    compares two snapshots with a single merge pass over their sorted grants
+    returns a dict of
+        added: {username: [roles]} users that are new to the account
+        removed: {username: [roles]} users no longer in the account
+        changed: {username: [[added roles], [removed roles]]}
+        buckets: {username: [old bucket, new bucket]}
+    """
+    ogrants = old["grants"]
+    ngrants = new["grants"]
+    plus = {}
+    minus = {}
+    i = j = 0
+    while i < len(ogrants) or j < len(ngrants):
+        if j >= len(ngrants) or (i < len(ogrants) and ogrants[i] < ngrants[j]):
+            user, role = ogrants[i]
+            minus.setdefault(user, []).append(role)
+            i += 1
+        elif i >= len(ogrants) or ngrants[j] < ogrants[i]:
+            user, role = ngrants[j]
+            plus.setdefault(user, []).append(role)
+            j += 1
+        else:
+            i += 1
+            j += 1
+    obuckets = old["buckets"]
+    nbuckets = new["buckets"]
+    diff = {"added": {}, "removed": {}, "changed": {}, "buckets": {}}
+    for user in plus:
+        if user not in obuckets:
+            diff["added"][user] = plus[user]
+    for user in minus:
+        if user not in nbuckets:
+            diff["removed"][user] = minus[user]
+    for user in sorted(set(plus) | set(minus)):
+        if user in obuckets and user in nbuckets:
+            diff["changed"][user] = [plus.get(user, []), minus.get(user, [])]
+    for user in sorted(nbuckets):
+        if user in obuckets and obuckets[user] != nbuckets[user]:
+            diff["buckets"][user] = [obuckets[user], nbuckets[user]]
+    return diff
+
+
+def displayDiff(diff):
+    """renders a diff as text, an empty string if nothing changed"""
+    lines = []
+    for user in sorted(diff["added"]):
+        lines.append("+ {}: {}".format(user, ", ".join(diff["added"][user])))
+    for user in sorted(diff["removed"]):
+        lines.append("- {}: {}".format(user, ", ".join(diff["removed"][user])))
+    for user in diff["changed"]:
+        added, removed = diff["changed"][user]
+        roles = ["+" + role for role in added] + ["-" + role for role in removed]
+        lines.append("~ {}: {}".format(user, ", ".join(roles)))
+    for user in diff["buckets"]:
+        obucket, nbucket = diff["buckets"][user]
+        lines.append("~ {}: {} -> {}".format(user, obucket, nbucket))
+    return "\n".join(lines)
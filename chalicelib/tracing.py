@@ -0,0 +1,104 @@
+#
+# Copyright (c) 2018, Centrica Hive Ltd.
+#
+#     This file is part of chaim.
+#
+#     chaim is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     chaim is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with chaim.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Lightweight per-stage timing of an invocation
+
+A handler starts a trace, the code it calls wraps each stage in span(name)
+and the handler emits one json record of the time spent in each stage,
+i.e. for CloudWatch Logs Insights:
+
+    filter type = "trace" | stats pct(db_query_ms, 99) by handler
+
+span() does nothing when no trace has been started. The current trace is
+per thread, as `chalice local` serves requests on several threads.
+"""
+from contextlib import contextmanager
+import json
+import threading
+import time
+import chalicelib.glue as glue
+
+log = glue.log
+
+LOCAL = threading.local()
+
+
+class Trace():
+    def __init__(self, handler, correlationid=None):
+        self.handler = handler
+        self.correlationid = correlationid
+        self.started = time.perf_counter()
+        self.stages = {}
+
+    def add(self, stage, seconds):
+        ms, count = self.stages.get(stage, [0.0, 0])
+        self.stages[stage] = [ms + (seconds * 1000), count + 1]
+
+    def record(self):
+        rec = {
+            "type": "trace",
+            "handler": self.handler,
+            "correlationid": self.correlationid,
+            "total_ms": round((time.perf_counter() - self.started) * 1000, 1),
+        }
+        for stage in self.stages:
+            ms, count = self.stages[stage]
+            rec["{}_ms".format(stage)] = round(ms, 1)
+            rec["{}_count".format(stage)] = count
+        return rec
+
+
+def current():
+    """the trace started on this thread, or None"""
+    return getattr(LOCAL, "trace", None)
+
+
+def startTrace(handler, correlationid=None):
+    LOCAL.trace = Trace(handler, correlationid)
+    return LOCAL.trace
+
+
+def addStage(stage, seconds):
+    """records a stage that was timed elsewhere, i.e. the sns hop"""
+    trace = current()
+    if trace is not None:
+        trace.add(stage, seconds)
+
+
+@contextmanager
+def span(stage):
+    trace = current()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(stage, time.perf_counter() - start)
+
+
+def endTrace():
+    """emits the trace record and returns it"""
+    trace = current()
+    if trace is None:
+        return None
+    rec = trace.record()
+    LOCAL.trace = None
+    print(json.dumps(rec))
+    return rec
@@ -0,0 +1,104 @@
+#
+# Copyright (c) 2018, Centrica Hive Ltd.
+#
+#     This file is part of chaim.
+#
+#     chaim is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     chaim is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with chaim.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Connections and clients kept for the life of a lambda container, and
+priming them ahead of the first real request.
+"""
+import importlib
+import os
+import time
+import boto3
+import chalicelib.glue as glue
+
+log = glue.log
+
+# name: client, connection or session
+SHARED = {}
+# set once the container has been primed
+PRIMED = {}
+
+SLACKURL = "https://hooks.slack.com/"
+
+
+def snsClient():
+    if "sns" not in SHARED:
+        SHARED["sns"] = boto3.client("sns")
+    return SHARED["sns"]
+
+
+def httpSession():
+    """a requests session, so that the slack tls connection is reused"""
+    if "http" not in SHARED:
+        import requests
+
+        SHARED["http"] = requests.Session()
+    return SHARED["http"]
+
+
+def permissions(spath):
+    """
+    a Permissions object whose database connections are kept open between
+    invocations, and checked before each use.
+    The read only connections autocommit; anything a previous invocation
+    left open on the rw connection is rolled back so that this one doesn't
+    read that transaction's snapshot.
+    """
+    from chalicelib.permissions import Permissions
+
+    key = "pms:{}".format(spath)
+    pms = SHARED.get(key)
+    if pms is None:
+        pms = Permissions(spath)
+        SHARED[key] = pms
+    else:
+        for sid in (pms.sid, pms.rwsid):
+            if sid is not None:
+                sid.ping()
+        if pms.rwsid is not None:
+            pms.rwsid.rollback()
+    return pms
+
+
+def prime(spath=None, full=True):
+    """
+    warms this container: the ack route only needs the SNS client and the
+    slack signing secret, the audit handler (full) also imports the audit
+    modules, fetches the ssm parameters, opens the database connections
+    and the slack connection.
+    returns a report of what was done and how long it took.
+    """
+    if full in PRIMED:
+        return {"type": "warmup", "full": full, "cold": False, "ms": 0}
+    start = time.perf_counter()
+    snsClient()
+    if not full and os.environ.get("SLACKVERIFY", "1") != "0":
+        from chalicelib.slackrequest import signingSecret
+
+        signingSecret()
+    if full:
+        for mod in ("pymysql", "tabulate", "chalicelib.audit", "chalicelib.blocks"):
+            importlib.import_module(mod)
+        if spath is not None:
+            permissions(spath)
+        try:
+            httpSession().head(SLACKURL, timeout=2)
+        except Exception as e:
+            log.warning("failed to open slack connection: {}".format(e))
+    PRIMED[full] = time.time()
+    ms = round((time.perf_counter() - start) * 1000, 1)
+    return {"type": "warmup", "full": full, "cold": True, "ms": ms}
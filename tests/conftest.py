@@ -0,0 +1,27 @@
+import pytest
+
+from chaimaccountaudit.fakes import fakePermissions
+from chalicelib.permissions import Permissions
+
+
+def clearCaches():
+    for cache in (
+        Permissions.WHOSKEY_CACHE,
+        Permissions.ALLOWED_CACHE,
+        Permissions.SLACKUSER_CACHE,
+        Permissions.WORKSPACE_TOKENS,
+        Permissions.USERTOKEN_CACHE,
+    ):
+        cache.clear()
+    Permissions.REPLICA_STATE.clear()
+
+
+@pytest.fixture
+def permissions():
+    """
+    builds Permissions objects with chaimaccountaudit.fakes.fakePermissions.
+    The container level caches are emptied before and after each test.
+    """
+    clearCaches()
+    yield fakePermissions
+    clearCaches()
@@ -0,0 +1,36 @@
+from chaimaccountaudit.fakes import FakeDB, refTables
+from chalicelib.accountindex import AccountIndex
+from chalicelib.refdata import RefData
+
+ROWS = [
+    ["111111111111", "sre-prod"],
+    ["222222222222", "sre-dev"],
+    ["333333333333", "payments-prod"],
+    ["444444444444", "Analytics"],
+]
+
+
+def test_resolve_by_name_any_case_and_number():
+    index = AccountIndex(ROWS)
+    assert index.resolve("analytics") == ("444444444444", "Analytics")
+    assert index.resolve(" 333333333333 ") == ("333333333333", "payments-prod")
+    assert index.resolve("sre") is None
+
+
+def test_suggest_prefix_first_then_typos():
+    index = AccountIndex(ROWS)
+    assert index.suggest("sre-") == ["sre-dev", "sre-prod"]
+    assert index.suggest("paymnets-prod")[0] == "payments-prod"
+    assert index.suggest("zzzz") == []
+
+
+def test_index_built_once_per_container(permissions, tmp_path, monkeypatch):
+    monkeypatch.setenv("REFCACHE", str(tmp_path / "refdata"))
+    RefData.clear()
+    AccountIndex.clear()
+    db = FakeDB(refTables(ROWS))
+    pms = permissions(sid=db)
+    assert AccountIndex.get(pms) is AccountIndex.get(pms)
+    assert len([sql for sql, args in db.statements if "from awsaccounts" in sql]) == 1
+    AccountIndex.clear()
+    RefData.clear()
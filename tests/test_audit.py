@@ -0,0 +1,155 @@
+import sqlite3
+import time
+
+from chaimaccountaudit.fakes import FakeDB
+from chalicelib.audit import (
+    UserGrants,
+    getAccountUsers,
+    getUserAccounts,
+    parseUserNames,
+    usageColumns,
+    usageThresholds,
+    userAudit,
+)
+
+DAY = 86400
+
+
+def slackmapDB(mapped):
+    """answers the slackmap lookup, mapped is {slackid: chaim name}"""
+
+    def answer(sql, args):
+        for slackid, name in mapped.items():
+            if "b.slackid='{}'".format(slackid) in sql:
+                return [[name]]
+        return []
+
+    return FakeDB(answer)
+
+
+def grantsDB(grants):
+    """answers streamUserPerms with grants, [user, account, role, rid, lastused]"""
+
+    def answer(sql, args):
+        return [
+            (user, "1", account, role, rid, lastused)
+            for user, account, role, rid, lastused in grants
+            if user in (args or [])
+        ]
+
+    return FakeDB(answer)
+
+
+def test_parse_user_names(permissions):
+    pms = permissions(sid=slackmapDB({"U2": "carol"}))
+    text = "@alice, <@U1|bob> <@U2>+@alice <@U9>"
+    users, unknown = parseUserNames(text, "T0", pms)
+    assert users == ["alice", "bob", "carol"]
+    assert unknown == ["<@U9>"]
+
+
+def test_parse_skips_empty_names(permissions):
+    pms = permissions(sid=slackmapDB({}))
+    assert parseUserNames("@", "T0", pms) == [[], []]
+    assert parseUserNames(" @ ,, @bob ", "T0", pms) == [["bob"], []]
+    assert pms.sid.statements == []
+
+
+def test_user_accounts_a_user_at_a_time(permissions):
+    used = int(time.time()) - 3 * DAY
+    grants = [
+        ["alice", "dev", "CrossAccountReadOnly", 1, used],
+        ["alice", "dev", "CustomRole", 1001, used],
+        ["alice", "prod", "CrossAccountReadOnly", 1, used],
+        ["bob", "prod", "CrossAccountAdminUser", 4, 0],
+    ]
+    pms = permissions(sid=grantsDB(grants))
+    users = list(getUserAccounts(["alice", "bob", "nobody"], pms))
+    assert [(name, days) for name, days, accounts in users] == [
+        ("alice", 3),
+        ("bob", "Has never used chaim"),
+    ]
+    alice = users[0][2]
+    assert list(alice) == ["dev", "prod"]
+    assert [role.rname for role in alice["dev"]] == ["ReadOnly", "CustomRole"]
+    assert [role.rname for role in users[1][2]["prod"]] == ["AdminUser"]
+    assert len(pms.sid.statements) == 1
+
+
+def test_no_user_names_no_query(permissions):
+    pms = permissions(sid=grantsDB([]))
+    assert list(getUserAccounts([], pms)) == []
+    assert userAudit([], pms).startswith("No user names given")
+    assert userAudit([], pms, ["<@U9>"]) == "no chaim user for <@U9>"
+    assert pms.sid.statements == []
+
+
+def test_user_audit_reports_missing_users(permissions):
+    grants = [["alice", "dev", "CrossAccountReadOnly", 1, 0]]
+    pms = permissions(sid=grantsDB(grants))
+    text = userAudit(["alice", "nobody"], pms, ["<@U9>"])
+    assert text.startswith("Permissions for users: *alice, nobody*")
+    assert "alice (Has never used chaim)" in text
+    assert "nobody: no chaim permissions found" in text
+    assert "no chaim user for <@U9>" in text
+
+
+def usage(users, thresholds=None):
+    """
+    runs the usageColumns sql over users, [lastslack, lastcli], in sqlite
+    returns [lastused, bucket] for each
+    """
+    db = sqlite3.connect(":memory:")
+    db.create_function("greatest", 2, max)
+    db.execute("create table awsusers (id integer, lastslack integer, lastcli integer)")
+    rows = [[i, slack, cli] for i, (slack, cli) in enumerate(users)]
+    db.executemany("insert into awsusers values (?, ?, ?)", rows)
+    sql = f"select {usageColumns(thresholds)} from awsusers u order by u.id"
+    return [list(row) for row in db.execute(sql)]
+
+
+def test_usage_buckets_from_lastslack_and_lastcli():
+    now = int(time.time())
+    users = [
+        [now - DAY, None],
+        [None, now - 20 * DAY],
+        [now - 100 * DAY, now - 2 * DAY],
+        [now - 100 * DAY, now - 70 * DAY],
+        [None, None],
+    ]
+    assert usage(users, (14, 60)) == [
+        [now - DAY, "regular"],
+        [now - 20 * DAY, "intermittent"],
+        [now - 2 * DAY, "regular"],
+        [now - 70 * DAY, "never"],
+        [0, "never"],
+    ]
+
+
+def test_usage_thresholds_from_the_environment(monkeypatch):
+    now = int(time.time())
+    users = [[now - 2 * DAY, None], [now - 20 * DAY, None]]
+    monkeypatch.delenv("REGULARDAYS", raising=False)
+    monkeypatch.delenv("INTERMITTENTDAYS", raising=False)
+    assert usageThresholds() == (14, 60)
+    assert [row[1] for row in usage(users)] == ["regular", "intermittent"]
+    monkeypatch.setenv("REGULARDAYS", "1")
+    monkeypatch.setenv("INTERMITTENTDAYS", "10")
+    assert usageThresholds() == (1, 10)
+    assert [row[1] for row in usage(users)] == ["intermittent", "never"]
+
+
+def test_account_users_grouped_with_their_bucket(permissions):
+    used = int(time.time()) - 3 * DAY
+    grants = [
+        ("alice", "CrossAccountReadOnly", 1, used, "regular"),
+        ("alice", "CrossAccountPowerUser", 2, used, "regular"),
+        ("bob", "CrossAccountReadOnly", 1, 0, "never"),
+    ]
+    pms = permissions(sid=FakeDB(lambda sql, args: list(grants)))
+    users = getAccountUsers("dev", pms, thresholds=(14, 60))
+    assert users["alice"].bucket == "regular" and users["alice"].days == 3
+    assert [role.rname for role in users["alice"].roles] == ["ReadOnly", "PowerUser"]
+    bob = UserGrants("never", "Has never used chaim", users["bob"].roles)
+    assert users["bob"] == bob
+    assert "a.name='dev'" in pms.sid.statements[0][0]
@@ -0,0 +1,30 @@
+from chalicelib.blocks import MAXTEXT, paginate, renderPages
+
+
+def test_paginate_carries_sections_over_pages():
+    sections = [["regular", ["a", "b", "c"]], ["never", ["d"]], [None, ["sre"]]]
+    pages = paginate(sections, pagesize=2)
+    assert pages == [
+        [["regular", ["a", "b"]]],
+        [["regular", ["c"]], ["never", ["d"]]],
+        [[None, ["sre"]]],
+    ]
+
+
+def test_renderPages_buttons_and_limits():
+    sections = [["regular", ["x" * 1000 for i in range(30)]]]
+    pages = renderPages("title", sections, "rid", pagesize=25)
+    assert len(pages) == 2
+    first, last = pages
+    assert [b["value"] for b in first[-1]["elements"]] == ["rid:1"]
+    assert [b["value"] for b in last[-1]["elements"]] == ["rid:0"]
+    for page in pages:
+        for block in page:
+            if block["type"] == "section":
+                assert len(block["text"]["text"]) <= MAXTEXT
+
+
+def test_single_page_has_no_buttons():
+    pages = renderPages("title", [[None, ["sre"]]], "rid")
+    assert len(pages) == 1
+    assert [b["type"] for b in pages[0]] == ["section", "section"]
@@ -0,0 +1,28 @@
+import time
+
+from chalicelib.cache import LRUCache
+
+
+def test_lru_evicts_least_recently_used():
+    c = LRUCache(2)
+    c.put("a", 1)
+    c.put("b", 2)
+    assert c.get("a") == 1
+    c.put("c", 3)
+    assert "b" not in c
+    assert c.get("a") == 1
+    assert c.get("c") == 3
+    assert len(c) == 2
+
+
+def test_lru_ttl_expires_items(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "time", lambda: now[0])
+    c = LRUCache(2, ttl=10)
+    c.put("a", 1)
+    now[0] += 5
+    assert c.get("a") == 1
+    now[0] += 6
+    assert "a" not in c
+    assert c.get("a", "gone") == "gone"
+    assert len(c) == 0
@@ -0,0 +1,34 @@
+import time
+
+import pytest
+
+import chalicelib.dbauth as dbauth
+from chalicelib.dbauth import LocalTokenProvider
+from chalicelib.slackiamdb import DBNotConnected
+
+
+def test_token_cached_until_near_expiry(monkeypatch):
+    monkeypatch.setattr(dbauth.TokenProvider, "TOKENS", {})
+    now = [1000.0]
+    monkeypatch.setattr(time, "time", lambda: now[0])
+    tp = LocalTokenProvider("secret")
+    assert tp.token("db", 3306, "ro") == "secret"
+    assert tp.token("db", 3306, "ro") == "secret"
+    assert tp.generated == 1
+    tp.token("db", 3306, "rw")
+    assert tp.generated == 2
+    now[0] += dbauth.TOKENLIFE - dbauth.TOKENMARGIN - 1
+    tp.token("db", 3306, "ro")
+    assert tp.generated == 2
+    now[0] += 2
+    tp.token("db", 3306, "ro")
+    assert tp.generated == 3
+
+
+def test_iam_auth_without_a_ca_refuses_to_connect(permissions, monkeypatch):
+    monkeypatch.setenv("DBIAMAUTH", "1")
+    monkeypatch.delenv("DBSSLCA", raising=False)
+    pms = permissions()
+    with pytest.raises(DBNotConnected, match="DBSSLCA"):
+        pms.connectDB()
+    assert pms.sid is None
@@ -0,0 +1,101 @@
+import csv
+import gzip
+import io
+import json
+
+import pytest
+
+import chalicelib.export as export
+from chalicelib.export import ExportFail, exportGrants
+
+ROWS = [
+    ["111111111111", "sre-prod", "alice", "ReadOnly", 100, None],
+    ["111111111111", "sre-prod", "bob", "Admin", None, 200],
+]
+
+
+class FakePermissions:
+    def streamGrants(self):
+        yield from ROWS
+
+
+class FakeS3:
+    def __init__(self, failpart=False):
+        self.failpart = failpart
+        self.parts = {}
+        self.body = None
+        self.aborted = False
+
+    def create_multipart_upload(self, Bucket, Key):
+        return {"UploadId": "u1"}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        if self.failpart:
+            raise RuntimeError("slow down")
+        self.parts[PartNumber] = Body
+        return {"ETag": "e{}".format(PartNumber)}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        numbers = [part["PartNumber"] for part in MultipartUpload["Parts"]]
+        self.body = b"".join(self.parts[no] for no in numbers)
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.aborted = True
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    client = FakeS3()
+
+    def newClient(self, service):
+        self.client = client
+
+    monkeypatch.setattr(export.S3Writer, "newClient", newClient)
+    return client
+
+
+def ndjson(data):
+    return [json.loads(line) for line in data.decode().splitlines()]
+
+
+def test_export_local_ndjson(tmp_path):
+    target = tmp_path / "grants.ndjson"
+    assert exportGrants(FakePermissions(), str(target)) == 2
+    rows = ndjson(target.read_bytes())
+    assert rows[0]["user"] == "alice" and rows[1]["lastcli"] == 200
+
+
+def test_export_local_csv_gzip(tmp_path):
+    target = tmp_path / "grants.csv.gz"
+    assert exportGrants(FakePermissions(), str(target), fmt="csv", gz=True) == 2
+    with gzip.open(str(target), "rt", newline="") as ifn:
+        rows = list(csv.reader(ifn))
+    assert rows[0] == export.EXPORTFIELDS
+    assert rows[2][2:4] == ["bob", "Admin"]
+
+
+@pytest.mark.parametrize("fmt", ["ndjson", "csv"])
+def test_export_s3(s3, fmt):
+    assert exportGrants(FakePermissions(), "s3://bucket/grants", fmt=fmt) == 2
+    assert b"alice" in s3.body and not s3.aborted
+
+
+def test_export_s3_gzip_in_parts(s3, monkeypatch):
+    monkeypatch.setattr(export.S3Writer, "PARTSIZE", 16)
+    exportGrants(FakePermissions(), "s3://bucket/grants.gz", gz=True)
+    assert len(s3.parts) > 1
+    assert ndjson(gzip.decompress(s3.body))[1]["role"] == "Admin"
+
+
+def test_failed_s3_export_is_aborted(s3):
+    s3.failpart = True
+    with pytest.raises(ExportFail):
+        exportGrants(FakePermissions(), "s3://bucket/grants")
+    assert s3.aborted and s3.body is None
+
+
+def test_bad_target_and_format(tmp_path):
+    with pytest.raises(ExportFail):
+        export.openTarget("s3://bucket")
+    with pytest.raises(ExportFail):
+        export.writeRows(io.StringIO(), ROWS, fmt="xml")
@@ -0,0 +1,20 @@
+import pytest
+
+import chalicelib.slackrequest as slackrequest
+import chalicelib.warmup as warmup
+from chaimaccountaudit.loadtest import BUDGETMS, localTarget, runLoad
+
+
+@pytest.fixture
+def post(monkeypatch):
+    monkeypatch.setattr(warmup, "SHARED", {})
+    monkeypatch.setattr(slackrequest, "SECRET", {})
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "eu-west-1")
+    monkeypatch.setenv("SNSTOPICARN", "arn:aws:sns:eu-west-1:123456789012:x")
+    return localTarget()
+
+
+def test_ack_latency_within_budget(post):
+    for res in runLoad(post, levels=[1, 8], nrequests=50):
+        assert res["errors"] == 0
+        assert res["p99"] <= BUDGETMS
@@ -0,0 +1,8 @@
+import pytest
+
+from chaimaccountaudit.membench import CEILINGS, measure
+
+
+@pytest.mark.parametrize("entry", sorted(CEILINGS))
+def test_peak_memory_within_budget(entry):
+    assert measure(entry) <= CEILINGS[entry]
@@ -0,0 +1,451 @@
+import re
+import sqlite3
+import time
+
+import pymysql
+import pytest
+
+import chalicelib.permissions
+from chaimaccountaudit.fakes import FakeDB, rows
+from chalicelib.permissions import DataNotFound, Permissions
+from chalicelib.resilience import breaker
+
+
+def test_user_allowed_one_query_then_cached(permissions):
+    pms = permissions(sid=FakeDB(rows(["123456789012", "myaccount", 7, 3, 1])))
+    assert pms.userAllowed("someone", "myaccount", "ro") == [True, "123456789012"]
+    assert pms.userAllowed("someone", "myaccount", "ro") == [True, "123456789012"]
+    assert pms.derivedaccountname == "myaccount"
+    assert len(pms.sid.statements) == 1
+
+
+@pytest.mark.parametrize(
+    "row,reason",
+    [
+        (None, "Account not found"),
+        (["1", "myaccount", None, 3, 0], "User not found"),
+        (["1", "myaccount", 7, None, 0], "Role not found"),
+        (["1", "myaccount", 7, 3, 0], "Permission not granted"),
+    ],
+)
+def test_user_denied(permissions, row, reason):
+    pms = permissions(sid=FakeDB(rows() if row is None else rows(row)))
+    with pytest.raises(DataNotFound, match=reason):
+        pms.userAllowed("someone", "myaccount", "ro")
+    with pytest.raises(DataNotFound, match=reason):
+        pms.userAllowed("someone", "myaccount", "ro")
+    assert len(pms.sid.statements) == 1
+
+
+def tokenPermissions(permissions, slacktoken):
+    params = {
+        "/sre/chaim/T0/prod/slacktoken": slacktoken,
+        "/sre/chaim/T0/prod/slackapitoken": "xoxb-api",
+    }
+    return permissions(sid=FakeDB(rows(["clitoken", 0])), params=params)
+
+
+def test_slack_token_checked_from_cache(permissions):
+    pms = tokenPermissions(permissions, "slacktok")
+    assert pms.checkToken("slacktok", "someone", "T0")
+    calls = pms.ps.calls
+    assert pms.checkToken("slacktok", "someone", "T0")
+    assert pms.ps.calls == calls
+    assert pms.slackapitoken == "xoxb-api"
+
+
+def test_rotated_slack_token_is_refetched(permissions):
+    pms = tokenPermissions(permissions, "oldtok")
+    assert pms.checkToken("oldtok", "someone", "T0")
+    pms.ps.values["/sre/chaim/T0/prod/slacktoken"] = "newtok"
+    assert pms.checkToken("newtok", "someone", "T0")
+
+
+def provisionDB(existing, fail=False):
+    """
+    existing is [name, userid, slackid, workspaceid], the awsusers rows
+    inserted in the open transaction are found too. fail refuses the
+    slackmap insert.
+    """
+
+    def answer(sql, args):
+        found = list(existing)
+        for stmt, argslist in db.pending:
+            if "into awsusers" in stmt:
+                for (name,) in argslist:
+                    found.append([name, 100 + len(found), None, None])
+        return [row for row in found if row[0] in args]
+
+    def refuse(sql, args):
+        if fail and "into slackmap" in sql:
+            return RuntimeError("deadlock")
+
+    db = FakeDB(answer, refuse)
+    return db
+
+
+def slackmapRows(db):
+    inserts = [argslist for sql, argslist in db.committed if "into slackmap" in sql]
+    return [row for argslist in inserts for row in argslist]
+
+
+class FakeIdp:
+    def __init__(self):
+        self.created = []
+
+    def adminCreateUser(self, poolid, name, email):
+        if name == "refused":
+            return False
+        if name in self.created:
+            raise RuntimeError("UsernameExistsException")
+        self.created.append(name)
+        return True
+
+    def adminGetUser(self, poolid, name):
+        return {"Enabled": True} if name in self.created else None
+
+
+USERS = [
+    ["new.user", "U1", "T0", "new@example.com"],
+    ["old.user", "U2", "T0", "old@example.com"],
+    ["mapped.user", "U3", "T0", "mapped@example.com"],
+    ["refused", "U4", "T0", "refused@example.com"],
+    ["bad email", "U5", "T0", "nope"],
+]
+EXISTING = [["old.user", 2, None, None], ["mapped.user", 3, "U3", "T0"]]
+
+
+def test_provision_users_report(permissions):
+    rwsid = provisionDB(EXISTING)
+    idp = FakeIdp()
+    res = permissions(rwsid=rwsid).provisionUsers(USERS, idp=idp, workers=2)
+    assert [r["status"] for r in res] == [
+        "created",
+        "mapped",
+        "exists",
+        "failed",
+        "failed",
+    ]
+    assert sorted(idp.created) == ["new.user", "old.user"]
+    assert sorted(row[1] for row in slackmapRows(rwsid)) == ["U1", "U2"]
+
+
+def test_provision_users_rolls_back_on_failure(permissions):
+    rwsid = provisionDB(EXISTING, fail=True)
+    res = permissions(rwsid=rwsid).provisionUsers(USERS[:2], idp=FakeIdp())
+    assert rwsid.rollbacks == 1
+    assert rwsid.committed == []
+    assert [r["status"] for r in res] == ["failed", "failed"]
+
+
+def test_provision_users_rerun_after_rollback(permissions):
+    idp = FakeIdp()
+    rwsid = provisionDB(EXISTING, fail=True)
+    permissions(rwsid=rwsid).provisionUsers(USERS[:2], idp=idp)
+    assert sorted(idp.created) == ["new.user", "old.user"]
+    rwsid = provisionDB(EXISTING)
+    res = permissions(rwsid=rwsid).provisionUsers(USERS[:2], idp=idp)
+    assert [r["status"] for r in res] == ["created", "mapped"]
+    assert sorted(idp.created) == ["new.user", "old.user"]
+    assert sorted(row[1] for row in slackmapRows(rwsid)) == ["U1", "U2"]
+
+
+def test_provision_users_without_an_identity_provider(permissions):
+    rwsid = provisionDB(EXISTING)
+    res = permissions(rwsid=rwsid).provisionUsers(USERS[:3])
+    assert [r["status"] for r in res] == ["failed", "failed", "exists"]
+    assert res[0]["reason"].startswith("no identity provider")
+    assert rwsid.committed == []
+
+
+def keymapRows(keys):
+    """a FakeDB answer for whosKeys, keys is {accesskey: [expires, user, account]}"""
+    return lambda sql, args: [[key] + keys[key] for key in args if key in keys]
+
+
+def test_whos_keys_in_batches(permissions, monkeypatch):
+    monkeypatch.setattr(Permissions, "WHOSKEY_BATCH", 2)
+    keys = {"AKIA{}".format(i): [100 + i, "user{}".format(i), "dev"] for i in range(5)}
+    pms = permissions(sid=FakeDB(keymapRows(keys)))
+    asked = ["AKIA0", "AKIA1", "AKIA2", "AKIA1", "AKIA3", "AKIA4"]
+    res = pms.whosKeys(asked)
+    assert res["AKIA3"] == ["AKIA3", 103, "user3", "dev"]
+    assert list(res) == ["AKIA0", "AKIA1", "AKIA2", "AKIA3", "AKIA4"]
+    assert [args for sql, args in pms.sid.statements] == [
+        ["AKIA0", "AKIA1"],
+        ["AKIA2", "AKIA3"],
+        ["AKIA4"],
+    ]
+
+
+def test_whos_keys_cached_and_missing(permissions):
+    keys = {"AKIA1": [100, "someone", "dev"]}
+    pms = permissions(sid=FakeDB(keymapRows(keys)))
+    assert pms.whosKeys(["AKIA1", "AKIANOPE"]) == {
+        "AKIA1": ["AKIA1", 100, "someone", "dev"],
+        "AKIANOPE": None,
+    }
+    pms.sid.statements = []
+    assert pms.whosKeys(["AKIA1"]) == {"AKIA1": ["AKIA1", 100, "someone", "dev"]}
+    assert pms.sid.statements == []
+    # a key that wasn't found is looked up again
+    assert pms.whosKeys(["AKIA1", "AKIANOPE"])["AKIANOPE"] is None
+    assert [args for sql, args in pms.sid.statements] == [["AKIANOPE"]]
+
+
+def lostConnection(sql, args):
+    return pymysql.err.OperationalError(2013, "Lost connection")
+
+
+def test_deferred_writes_flushed_in_one_transaction(permissions):
+    pms = permissions(sid=FakeDB(rows([7])), rwsid=FakeDB())
+    rwsid = pms.rwsid
+    with pms.deferWrites():
+        pms.updateKeyMap("someone", "111111111111", "AKIA1", 100)
+        pms.updateKeyMap("someone", "222222222222", "AKIA2", 200)
+        pms.lastupdated(7, 10)
+        pms.lastupdated(7, 30)
+        pms.lastupdated(7, 20)
+        pms.lastupdated(7, 5, cli=True)
+        assert rwsid.statements == []
+    assert rwsid.commits == 1
+    inserts, slack, cli = rwsid.committed
+    assert inserts[0].count("(%s, %s, %s, %s)") == 2
+    assert "lastslack" in slack[0] and slack[1] == [7, 30, 7]
+    assert "lastcli" in cli[0] and cli[1] == [7, 5, 7]
+    assert pms.keymapbuffer == [] and pms.lastusedbuffer == {}
+
+
+def test_failed_flush_keeps_the_writes(permissions):
+    pms = permissions(sid=FakeDB(rows([7])), rwsid=FakeDB(refuse=lostConnection))
+    rwsid = pms.rwsid
+    pms.deferring = True
+    pms.updateKeyMap("someone", "111111111111", "AKIA1", 100)
+    pms.lastupdated(7, 10)
+    with pytest.raises(pymysql.err.OperationalError):
+        pms.flushWrites()
+    assert rwsid.rollbacks == 1
+    assert len(pms.keymapbuffer) == 1 and len(pms.lastusedbuffer) == 1
+    rwsid.refuse = lambda sql, args: None
+    assert pms.flushWrites() == 2
+    assert pms.keymapbuffer == [] and pms.lastusedbuffer == {}
+
+
+def test_refused_row_is_dropped_without_retries(permissions):
+    def duplicate(sql, args):
+        if "AKIA1" in (args or []):
+            return pymysql.err.IntegrityError(1062, "Duplicate entry")
+
+    pms = permissions(sid=FakeDB(rows([7])), rwsid=FakeDB(refuse=duplicate))
+    rwsid = pms.rwsid
+    with pytest.raises(KeyError):
+        with pms.deferWrites():
+            pms.updateKeyMap("someone", "111111111111", "AKIA1", 100)
+            pms.updateKeyMap("someone", "222222222222", "AKIA2", 200)
+            pms.lastupdated(7, 10)
+            raise KeyError("from the body")
+    # the batch, then AKIA1 on its own, fail; AKIA2 and the time are written
+    assert rwsid.rollbacks == 2
+    assert rwsid.commits == 2
+    assert [args[2] for sql, args in rwsid.committed if "keymap" in sql] == ["AKIA2"]
+    assert pms.keymapbuffer == [] and pms.lastusedbuffer == {}
+    assert not breaker("db").isOpen()
+
+
+def replicaDB(host, lag=0, down=False):
+    def answer(sql, args):
+        if sql == "show slave status":
+            return [["Yes", lag]]
+        return [["replica"]]
+
+    def refuse(sql, args):
+        if down and sql != "show slave status":
+            return pymysql.err.OperationalError(2013, "Lost connection")
+
+    columns = ["Slave_IO_Running", "Seconds_Behind_Master"]
+    return FakeDB(answer, refuse, dbhost=host, columns=columns)
+
+
+def reads(db):
+    return [sql for sql, args in db.statements if sql.startswith("select")]
+
+
+def router(permissions, *replicas):
+    pms = permissions(sid=FakeDB(rows(["primary"])))
+    pms.replicahosts = [rep.dbhost for rep in replicas]
+    pms.replicas = {rep.dbhost: rep for rep in replicas}
+    return pms
+
+
+def test_reads_go_to_a_replica_within_lag(permissions):
+    lagging = replicaDB("r1", lag=Permissions.MAXLAG + 1)
+    pms = router(permissions, lagging, replicaDB("r2"))
+    assert pms.readQuery("select name from awsaccounts") == [["replica"]]
+    assert len(reads(pms.replicas["r2"])) == 1
+    assert pms.sid.statements == []
+
+
+def test_reads_fail_over_to_the_primary(permissions):
+    pms = router(permissions, replicaDB("r1", down=True))
+    assert pms.readQuery("select name from awsaccounts") == [["primary"]]
+    assert Permissions.REPLICA_STATE["r1"][0] is False
+    Permissions.REPLICA_STATE.clear()
+    pms = router(permissions, replicaDB("r1", down=True))
+    assert list(pms.readStream("select name from awsaccounts")) == [["primary"]]
+    assert Permissions.REPLICA_STATE["r1"][0] is False
+
+
+def test_stopped_replication_reads_the_primary(permissions):
+    pms = router(permissions, replicaDB("r1", lag=None))
+    assert pms.readsid() is pms.sid
+
+
+def test_second_object_opens_its_own_replica_connection(permissions, monkeypatch):
+    opened = []
+
+    def connect(host, *args, **kwargs):
+        opened.append(host)
+        return replicaDB(host)
+
+    monkeypatch.setattr(chalicelib.permissions, "SlackIamDB", connect)
+    first = router(permissions)
+    first.dbopts = {"connecttimeout": 5}
+    first.replicahosts = ["r1"]
+    assert first.readQuery("select name from awsaccounts") == [["replica"]]
+    second = router(permissions)
+    second.dbopts = {"connecttimeout": 5}
+    second.replicahosts = ["r1"]
+    assert second.readQuery("select name from awsaccounts") == [["replica"]]
+    assert opened == ["r1", "r1"]
+    assert second.sid.statements == []
+
+
+def test_dead_replica_is_tried_once(permissions, monkeypatch):
+    connects = []
+
+    def connect(**kwargs):
+        connects.append(kwargs)
+        raise pymysql.err.OperationalError(2003, "Can't connect")
+
+    monkeypatch.setattr(pymysql, "connect", connect)
+    pms = router(permissions)
+    pms.dbopts = {"connecttimeout": 5}
+    pms.replicahosts = ["dead.replica"]
+    assert pms.readsid() is pms.sid
+    assert len(connects) == 1
+    assert connects[0]["connect_timeout"] == Permissions.REPLICA_CONNECTTIMEOUT
+
+
+def keymapDB(keys):
+    """a keymap table of [expires, accesskey] rows, in db.table"""
+
+    def answer(sql, args):
+        if "information_schema" in sql:
+            return [[len(db.table)]]
+        if sql.startswith("delete"):
+            keys = re.search(r"accesskey in \((.*)\)", sql).group(1)
+            keys = [key.strip("'") for key in keys.split(",")]
+            deleted = [row for row in db.table if row[1] in keys]
+            db.table = [row for row in db.table if row[1] not in keys]
+            return deleted
+        then = int(re.search(r"expires < (\d+)", sql).group(1))
+        expired = [row for row in db.table if row[0] < then]
+        if sql.startswith("explain"):
+            return [[1, len(expired)]]
+        after = re.search(r"expires > (\d+) or .* accesskey > '(\w+)'", sql)
+        if after is not None:
+            start = [int(after.group(1)), after.group(2)]
+            expired = [row for row in expired if row > start]
+        return expired[: int(re.search(r"limit (\d+)", sql).group(1))]
+
+    db = FakeDB(answer, columns=["id", "rows"])
+    db.table = sorted(keys)
+    return db
+
+
+def keyMapPermissions(permissions, keys):
+    db = keymapDB(keys)
+    return permissions(sid=db, rwsid=db)
+
+
+OLD = int(time.time()) - 40 * 86400
+KEYS = [[OLD + i, "AKIA{}".format(i)] for i in range(5)] + [[OLD * 2, "AKIALIVE"]]
+
+
+def test_clean_keymap_in_batches(permissions):
+    pms = keyMapPermissions(permissions, KEYS)
+    batches = []
+    res = pms.cleanKeyMapBatched(
+        batchsize=2, pause=0, progress=lambda r: batches.append(r["deleted"])
+    )
+    assert batches == [2, 4, 5]
+    assert res["complete"] and res["deleted"] == 5
+    assert res["checkpoint"] == KEYS[4]
+    assert pms.rwsid.table == [KEYS[5]]
+
+
+def test_clean_keymap_stops_at_the_deadline_and_resumes(permissions):
+    pms = keyMapPermissions(permissions, KEYS)
+    res = pms.cleanKeyMapBatched(batchsize=2, pause=0.1, deadline=time.time() + 0.05)
+    assert res["batches"] == 1 and res["deleted"] == 2
+    assert not res["complete"]
+    assert res["checkpoint"] == KEYS[1]
+    res = pms.cleanKeyMapBatched(batchsize=2, pause=0, deadline=time.time() - 1)
+    assert res["batches"] == 0 and not res["complete"]
+
+
+def test_clean_keymap_honours_startafter(permissions):
+    pms = keyMapPermissions(permissions, KEYS)
+    res = pms.cleanKeyMapBatched(batchsize=10, pause=0, startafter=KEYS[2])
+    assert res["deleted"] == 2 and res["complete"]
+    assert pms.rwsid.table == KEYS[:3] + [KEYS[5]]
+
+
+def test_clean_keymap_dry_run_estimates(permissions):
+    pms = keyMapPermissions(permissions, KEYS)
+    res = pms.cleanKeyMapBatched(dryrun=True)
+    assert res["total"] == 6 and res["deleted"] == 5 and res["complete"]
+    assert not any("count(*)" in sql for sql, args in pms.sid.statements)
+    assert not any(sql.startswith("delete") for sql, args in pms.sid.statements)
+    assert len(pms.rwsid.table) == 6
+
+
+def snapshotDB(snapshots):
+    """an auditsnapshot table in sqlite, snapshots is [[accountid, taken]]"""
+    con = sqlite3.connect(":memory:")
+    con.execute("create table auditsnapshot (accountid, taken, snapshot)")
+    rows = [[accountid, taken, b""] for accountid, taken in snapshots]
+    con.executemany("insert into auditsnapshot values (?, ?, ?)", rows)
+
+    def answer(sql, args):
+        cur = con.execute(sql.replace("%s", "?"), args)
+        if sql.startswith(("insert", "delete")):
+            # FakeDB gives the number of rows answered as the rows affected
+            return [None] * cur.rowcount
+        return cur.fetchall()
+
+    db = FakeDB(answer)
+    db.snapshots = lambda: con.execute(
+        "select accountid, taken from auditsnapshot order by accountid, taken"
+    ).fetchall()
+    return db
+
+
+def test_old_snapshots_pruned_per_account(permissions):
+    snapshots = [["1", taken] for taken in range(1, 13)] + [["2", 5], ["2", 6]]
+    pms = permissions(rwsid=snapshotDB(snapshots))
+    assert pms.pruneAuditSnapshots("1", keep=10) == 2
+    assert pms.rwsid.snapshots() == [("1", taken) for taken in range(3, 13)] + [
+        ("2", 5),
+        ("2", 6),
+    ]
+    assert pms.pruneAuditSnapshots("2", keep=10) == 0
+
+
+def test_saving_a_snapshot_prunes(permissions, monkeypatch):
+    monkeypatch.setattr(Permissions, "SNAPSHOT_KEEP", 2)
+    pms = permissions(rwsid=snapshotDB([["1", 1], ["1", 2]]))
+    now = int(time.time())
+    pms.saveAuditSnapshot("1", b"snap")
+    taken = [taken for accountid, taken in pms.rwsid.snapshots()]
+    assert taken[0] == 2 and taken[1] >= now and len(taken) == 2
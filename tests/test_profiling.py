@@ -0,0 +1,57 @@
+import json
+import sys
+
+from chalice.test import Client
+
+import app
+from chalicelib.profiling import profiled, stripFlag
+
+
+def test_strip_flag():
+    assert stripFlag("myaccount --profile") == "myaccount"
+    assert stripFlag("--profile  diff   myaccount") == "diff myaccount"
+    assert stripFlag("--profiles") == "--profiles"
+
+
+def test_profile_wanted_by_env_or_flag(monkeypatch):
+    monkeypatch.delenv("CHAIMPROFILE", raising=False)
+    assert not app.profileWanted("myaccount")
+    assert not app.profileWanted("myaccount--profile")
+    assert app.profileWanted("myaccount --profile")
+    monkeypatch.setenv("CHAIMPROFILE", "0")
+    assert not app.profileWanted("myaccount")
+    monkeypatch.setenv("CHAIMPROFILE", "1")
+    assert app.profileWanted("myaccount")
+
+
+def test_profiled_logs_a_summary(capsys, tmp_path, monkeypatch):
+    monkeypatch.setenv("CHAIMPROFILETOP", "3")
+    monkeypatch.setenv("CHAIMPROFILEDUMP", str(tmp_path))
+    with profiled("test"):
+        sorted(str(i) for i in range(1000))
+    out = capsys.readouterr().out
+    assert "profile: top 3 by cumulative time" in out
+    assert "profile: top 3 allocation sites" in out
+    assert "profile: traced memory peak" in out
+    assert len(list(tmp_path.glob("test-*.pstats"))) == 1
+
+
+def snsAudit(monkeypatch, text):
+    """invokes doSNSReq with text, returns the texts auditRequest was given"""
+    audited = []
+    monkeypatch.delenv("CHAIMPROFILE", raising=False)
+    monkeypatch.setattr(app, "auditRequest", lambda body: audited.append(body["text"]))
+    with Client(app.app) as client:
+        message = json.dumps({"text": text, "response_url": "https://e.com/r"})
+        event = client.events.generate_sns_event(message=message)
+        client.lambda_.invoke("doSNSReq", event)
+    return audited
+
+
+def test_profiling_module_only_imported_when_asked(monkeypatch, capsys):
+    monkeypatch.delitem(sys.modules, "chalicelib.profiling")
+    assert snsAudit(monkeypatch, "myaccount") == ["myaccount"]
+    assert "chalicelib.profiling" not in sys.modules
+    assert snsAudit(monkeypatch, "myaccount --profile") == ["myaccount"]
+    assert "chalicelib.profiling" in sys.modules
+    assert "profile: top" in capsys.readouterr().out
@@ -0,0 +1,60 @@
+import app
+
+
+def sections(n):
+    for i in range(n):
+        yield [f"heading {i}", [f"user {i}"]]
+    yield [None, ["footer"]]
+
+
+def sent(monkeypatch, n):
+    messages = []
+    monkeypatch.setattr(app, "sendToSlack", lambda url, msg: messages.append(msg))
+    app.sendSections("https://example.com/r", sections(n))
+    return messages
+
+
+def test_sections_sent_in_order_footer_with_last(monkeypatch):
+    messages = sent(monkeypatch, 3)
+    assert len(messages) == 3
+    assert "heading 0" in messages[0]
+    assert "heading 1" in messages[1]
+    assert "heading 2" in messages[2] and "footer" in messages[2]
+
+
+def test_sections_stay_within_slack_response_limit(monkeypatch):
+    messages = sent(monkeypatch, 8)
+    # the title has already used one response
+    assert len(messages) == app.MAXRESPONSES - 1
+    assert "heading 7" in messages[-1] and "footer" in messages[-1]
+    assert "".join(messages).index("heading 2") < "".join(messages).index("heading 3")
+
+
+def test_first_page_sent_before_render_is_stored(monkeypatch):
+    import chalicelib.audit as audit
+    import chalicelib.rendercache as rendercache
+
+    calls = []
+
+    class FakeRenderCache:
+        def __init__(self, bucket):
+            pass
+
+        def put(self, renderid, pages):
+            calls.append("put")
+
+    monkeypatch.setenv("RENDERBUCKET", "bucket")
+    monkeypatch.setenv("SECRETPATH", "/sre/chaim/")
+    monkeypatch.setattr(app, "permissions", lambda spath: None)
+    monkeypatch.setattr(
+        audit,
+        "accountReport",
+        lambda account, pms, diffmode: ["1", {}, "title", list(sections(2))],
+    )
+    monkeypatch.setattr(audit, "saveSnapshot", lambda accountid, snap, pms: None)
+    monkeypatch.setattr(rendercache, "RenderCache", FakeRenderCache)
+    monkeypatch.setattr(
+        app, "sendBlocksToSlack", lambda url, title, blocks: calls.append("send")
+    )
+    app.auditRequest({"text": "myaccount", "response_url": "https://example.com/r"})
+    assert calls == ["send", "put"]
@@ -0,0 +1,51 @@
+import chalicelib.refdata as refdata
+from chaimaccountaudit.fakes import FakeDB, refTables
+from chalicelib.refdata import RefData
+
+ACCOUNTS = [["111111111111", "sre-prod"], ["222222222222", "sre-dev"]]
+GROUPS = {"SRE": ["alice"], "security": ["bob"]}
+
+
+def accountReads(db):
+    return len([sql for sql, args in db.statements if "from awsaccounts" in sql])
+
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / "chaim" / "refdata")
+    RefData("1", ACCOUNTS, GROUPS).save(path)
+    loaded = RefData.load(path)
+    assert loaded.version == "1"
+    assert loaded.accounts == ACCOUNTS
+    assert loaded.groups == GROUPS
+
+
+def test_corrupt_or_missing_file_is_ignored(tmp_path):
+    path = tmp_path / "refdata"
+    assert RefData.load(str(path)) is None
+    path.write_bytes(b"")
+    assert RefData.load(str(path)) is None
+    RefData("1", ACCOUNTS, GROUPS).save(str(path))
+    path.write_bytes(path.read_bytes().replace(b"sre-dev", b"sre-xxx"))
+    assert RefData.load(str(path)) is None
+
+
+def test_cold_start_uses_file_until_version_changes(
+    permissions, tmp_path, monkeypatch
+):
+    monkeypatch.setenv("REFCACHE", str(tmp_path / "refdata"))
+    RefData.clear()
+    db = FakeDB(refTables(ACCOUNTS, GROUPS, version="1"))
+    pms = permissions(sid=db)
+    assert RefData.get(pms).accounts == ACCOUNTS
+    assert accountReads(db) == 1
+    # a new container finds the file
+    RefData.clear()
+    assert RefData.get(pms).groups == GROUPS
+    assert accountReads(db) == 1
+    # a warm container doesn't check the version again until REFRESH
+    db.answer = refTables(ACCOUNTS, GROUPS, version="2")
+    assert RefData.get(pms).version == "1"
+    monkeypatch.setattr(refdata, "REFRESH", 0)
+    assert RefData.get(pms).version == "2"
+    assert accountReads(db) == 2
+    RefData.clear()
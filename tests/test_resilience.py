@@ -0,0 +1,82 @@
+import time
+
+import pytest
+
+import chalicelib.resilience as resilience
+from chalicelib.resilience import CircuitBreaker, CircuitOpen, call, limit
+
+
+@pytest.fixture(autouse=True)
+def fresh(monkeypatch):
+    monkeypatch.setattr(resilience, "BREAKERS", {})
+    monkeypatch.setattr(resilience, "DEADLINE", None)
+    monkeypatch.setattr(time, "sleep", lambda secs: None)
+
+
+def test_breaker_opens_then_lets_a_trial_through(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "time", lambda: now[0])
+    brk = CircuitBreaker("db", failures=2, reset=30)
+    brk.failure()
+    brk.check()
+    brk.failure()
+    with pytest.raises(CircuitOpen):
+        brk.check()
+    now[0] += 31
+    brk.check()
+    brk.success()
+    assert not brk.isOpen()
+
+
+def test_call_retries_then_succeeds():
+    tries = []
+
+    def flaky():
+        tries.append(1)
+        if len(tries) < 3:
+            raise ConnectionError("down")
+        return "ok"
+
+    assert call("slack", flaky, retryon=(ConnectionError,)) == "ok"
+    assert len(tries) == 3
+
+
+def test_call_gives_up_at_the_deadline():
+    tries = []
+
+    def down():
+        tries.append(1)
+        raise ConnectionError("down")
+
+    resilience.setDeadline(time.time() + resilience.DEADLINEMARGIN - 1)
+    with pytest.raises(ConnectionError):
+        call("db", down, retryon=(ConnectionError,), attempts=5, base=1)
+    assert len(tries) == 1
+
+
+def test_call_needs_time_for_another_attempt():
+    tries = []
+
+    def slow():
+        tries.append(1)
+        raise TimeoutError("slow")
+
+    resilience.setDeadline(time.time() + resilience.DEADLINEMARGIN + 4)
+    with pytest.raises(TimeoutError):
+        call("slack", slow, retryon=(TimeoutError,), base=0.01, timeout=5)
+    assert len(tries) == 1
+
+
+def test_timeouts_are_cut_to_the_deadline():
+    assert limit(5) == 5
+    resilience.setDeadline(time.time() + resilience.DEADLINEMARGIN + 2)
+    assert 1.5 < limit(5) <= 2
+    resilience.setDeadline(time.time())
+    assert limit(5) == 0.5
+
+
+def test_open_breaker_fails_fast():
+    for _ in range(3):
+        resilience.breaker("db").failure()
+    with pytest.raises(CircuitOpen):
+        call("db", lambda: "never called")
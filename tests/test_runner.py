@@ -0,0 +1,69 @@
+import multiprocessing
+import time
+
+import pytest
+
+import chaimaccountaudit.runner as runner
+from chaimaccountaudit.runner import auditAccount, runAudits
+
+ACCOUNTS = ["sre-prod", "nosuch", "broken", "sre-dev"]
+
+
+def fakeAudit(account, pms, diffmode=False):
+    """accountAudit: [accountid, snapshot, text]"""
+    if account == "nosuch":
+        return [None, None, f"Account {account} not found."]
+    if account == "broken":
+        raise RuntimeError("lost connection")
+    # the first accounts finish last
+    time.sleep(0.05 * (len(ACCOUNTS) - ACCOUNTS.index(account)))
+    return [f"id-{account}", {"snap": account}, f"{account} diff={diffmode}"]
+
+
+@pytest.fixture
+def audits(monkeypatch):
+    saved = []
+    monkeypatch.setattr(runner, "Permissions", lambda *args, **kwargs: "pms")
+    monkeypatch.setattr(runner, "accountAudit", fakeAudit)
+    monkeypatch.setattr(
+        runner, "saveSnapshot", lambda accountid, snap, pms: saved.append(accountid)
+    )
+    monkeypatch.setattr(runner, "WORKERPMS", None)
+    return saved
+
+
+def test_audit_account_results(audits):
+    runner.initWorker("/sre/chaim/", "prod", False)
+    assert auditAccount("sre-prod") == ["sre-prod", True, "sre-prod diff=False"]
+    assert auditAccount("nosuch") == ["nosuch", False, "Account nosuch not found."]
+    account, ok, text = auditAccount("broken")
+    assert not ok and text == "audit of broken failed: RuntimeError: lost connection"
+    assert audits == []
+
+
+def test_in_process_audits_in_order_and_saved(audits):
+    results = list(runAudits(ACCOUNTS, "/sre/chaim/", "prod", workers=1, save=True))
+    assert [[account, ok] for account, ok, text in results] == [
+        ["sre-prod", True],
+        ["nosuch", False],
+        ["broken", False],
+        ["sre-dev", True],
+    ]
+    assert runner.WORKERPMS == "pms"
+    assert audits == ["id-sre-prod", "id-sre-dev"]
+
+
+def test_audits_not_saved_by_default(audits):
+    results = list(runAudits(ACCOUNTS, "/sre/chaim/", "prod", workers=1, diffmode=True))
+    assert results[0][2] == "sre-prod diff=True"
+    assert audits == []
+
+
+@pytest.mark.skipif(
+    multiprocessing.get_start_method() != "fork",
+    reason="the workers only see the fakes when they are forked",
+)
+def test_worker_pool_keeps_the_order(audits):
+    results = list(runAudits(ACCOUNTS, "/sre/chaim/", "prod", workers=3))
+    assert [account for account, ok, text in results] == ACCOUNTS
+    assert [ok for account, ok, text in results] == [True, False, False, True]
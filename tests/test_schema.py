@@ -0,0 +1,168 @@
+import re
+
+import pymysql
+import pytest
+
+import chaimaccountaudit.explaincheck as explaincheck
+from chaimaccountaudit.explaincheck import ExplainDB, checkPlans, fullScans
+from chaimaccountaudit.schema import (
+    MigrationFail,
+    migrate,
+    readMigrations,
+    splitStatements,
+)
+
+
+def test_splitStatements():
+    sql = "-- a comment\ncreate index a on b (c);\n\ncreate index d on e (f);\n"
+    assert splitStatements(sql) == [
+        "create index a on b (c)",
+        "create index d on e (f)",
+    ]
+
+
+def test_readMigrations_in_version_order():
+    migs = readMigrations()
+    versions = [m[0] for m in migs]
+    assert versions == sorted(versions)
+    assert len(versions) == len(set(versions))
+    for version, name, stmts in migs:
+        assert len(stmts) > 0
+
+
+def test_fullScans():
+    plan = [
+        {"table": "u", "type": "ref", "rows": 1},
+        {"table": "x", "type": "ALL", "rows": 50000},
+        {"table": "r", "type": "ALL", "rows": 12},
+    ]
+    assert fullScans(plan, minrows=1000) == ["x (50000 rows)"]
+
+
+class FakeCursor:
+    def __init__(self, plans):
+        self.plans = plans
+        self.plan = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, sql, args=None):
+        self.plan = self.plans.get("fullscan" if "useracctrolemap" in sql else "ok")
+
+    def fetchall(self):
+        return self.plan
+
+
+class FakeConnection:
+    def __init__(self, plans):
+        self.plans = plans
+
+    def cursor(self, cursorclass=None):
+        return FakeCursor(self.plans)
+
+
+class FakeSid:
+    def __init__(self, plans):
+        self.con = FakeConnection(plans)
+
+    def sqlStr(self, xstr):
+        return "'" + xstr + "'"
+
+    def sqlInt(self, xint):
+        return str(xint)
+
+
+def explainPermissions(permissions, plans):
+    pms = permissions(sid=FakeSid(plans), rwsid=FakeSid(plans))
+    pms.replicahosts = ["replica"]
+    return pms
+
+
+def test_every_hot_query_can_be_explained(permissions):
+    plans = {"ok": [{"table": "u", "type": "ref", "rows": 1}]}
+    plans["fullscan"] = plans["ok"]
+    pms = explainPermissions(permissions, plans)
+    assert checkPlans(pms) == []
+    assert pms.replicahosts == ["replica"]
+
+
+def test_full_scans_and_failures_are_reported(permissions, monkeypatch):
+    plans = {"ok": [], "fullscan": [{"table": "x", "type": "ALL", "rows": 5000}]}
+    queries = [
+        ["scans", lambda p: p.listuserperms("x"), False],
+        ["scansok", lambda p: list(p.streamGrants()), True],
+        ["broken", lambda p: p.sid.query("select")[0][9], False],
+    ]
+    monkeypatch.setattr(explaincheck, "hotQueries", lambda: queries)
+    failed = checkPlans(explainPermissions(permissions, plans))
+    assert [row[0] for row in failed] == ["scans", "broken"]
+    assert failed[0][2] == "full table scan of x (5000 rows)"
+    assert failed[1][2].startswith("failed: IndexError")
+
+
+class FakeMigrateSid:
+    """records the indexes and tables created, failing on the index named fail"""
+
+    def __init__(self, fail=None):
+        self.fail = fail
+        self.created = set()
+        self.versions = []
+        self.statements = []
+
+    def sqlStr(self, xstr):
+        return "'" + xstr + "'"
+
+    def query(self, sql, args=None):
+        self.statements.append(sql.strip())
+        if "information_schema" in sql:
+            return [[1]] if args[-1] in self.created else []
+        if sql.startswith("select version"):
+            return [[version] for version in self.versions]
+        m = re.match(r"create (?:index|table) (\w+)", sql)
+        if m is not None and m.group(1) != "if":
+            if m.group(1) == self.fail:
+                raise pymysql.err.OperationalError(1205, "Lock wait timeout")
+            if m.group(1) in self.created:
+                raise pymysql.err.OperationalError(1061, "Duplicate key name")
+            self.created.add(m.group(1))
+        return []
+
+    def insertQuery(self, sql, args=None):
+        self.versions.append(int(re.search(r"\((\d+),", sql).group(1)))
+
+
+def test_migrate_carries_on_after_a_partial_failure(tmp_path):
+    (tmp_path / "0001_indexes.sql").write_text(
+        "create index ix_a on a (x);\ncreate index ix_b on b (y);\n"
+        "create table c (id int);\n"
+    )
+    rwsid = FakeMigrateSid(fail="ix_b")
+    with pytest.raises(MigrationFail):
+        migrate(rwsid, mdir=str(tmp_path))
+    assert rwsid.created == {"ix_a"} and rwsid.versions == []
+    rwsid.fail = None
+    assert migrate(rwsid, mdir=str(tmp_path)) == [1]
+    assert rwsid.created == {"ix_a", "ix_b", "c"}
+    assert migrate(rwsid, mdir=str(tmp_path)) == []
+
+
+def test_dry_run_creates_nothing(tmp_path):
+    (tmp_path / "0001_indexes.sql").write_text("create index ix_a on a (x);\n")
+    rwsid = FakeMigrateSid()
+    assert migrate(rwsid, mdir=str(tmp_path), dryrun=True) == [1]
+    assert not any(sql.startswith("create") for sql in rwsid.statements)
+    assert rwsid.created == set() and rwsid.versions == []
+
+
+def test_checksum_explained_as_a_read_of_each_table():
+    db = ExplainDB(FakeSid({"ok": []}))
+    db.query("checksum table awsaccounts, awsgroups, groupusermap")
+    assert [sql for sql, plan in db.plans] == [
+        "select * from awsaccounts",
+        "select * from awsgroups",
+        "select * from groupusermap",
+    ]
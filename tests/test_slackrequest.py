@@ -0,0 +1,60 @@
+import json
+
+import pytest
+from chalice.test import Client
+
+import app
+import chalicelib.slackrequest as slackrequest
+import chalicelib.warmup as warmup
+from chalicelib.slackrequest import (
+    InvalidSignature,
+    decodeForm,
+    decodeMessage,
+    signature,
+    signedHeaders,
+    verify,
+)
+
+BODY = "text=diff+my%26account&response_url=https%3A%2F%2Fhooks.slack.com%2Fx%3Fa%3Db"
+
+
+def test_decode_form_keeps_encoded_separators():
+    fields = decodeForm(BODY)
+    assert fields["text"] == "diff my&account"
+    assert fields["response_url"] == "https://hooks.slack.com/x?a=b"
+
+
+def test_decode_message_json_or_form():
+    assert decodeMessage(json.dumps({"text": "a=b"})) == {"text": "a=b"}
+    assert decodeMessage("warmup=1") == {"warmup": "1"}
+
+
+def test_verify_signature():
+    headers = {
+        "X-Slack-Request-Timestamp": "1000",
+        "X-Slack-Signature": signature("secret", "1000", BODY),
+    }
+    verify("secret", headers, BODY, now=1010)
+    with pytest.raises(InvalidSignature):
+        verify("other", headers, BODY, now=1010)
+    with pytest.raises(InvalidSignature):
+        verify("secret", headers, BODY + "&x=1", now=1010)
+    with pytest.raises(InvalidSignature):
+        verify("secret", headers, BODY, now=2000)
+    with pytest.raises(InvalidSignature):
+        verify("secret", {}, BODY, now=1010)
+
+
+@pytest.mark.parametrize("signed,status", [(False, 401), (True, 200)])
+def test_warmup_request_must_be_signed(monkeypatch, signed, status):
+    monkeypatch.setattr(slackrequest, "SECRET", {"secret": "secret"})
+    monkeypatch.setattr(warmup, "SHARED", {"sns": object()})
+    monkeypatch.setattr(warmup, "PRIMED", {})
+    monkeypatch.delenv("SLACKVERIFY", raising=False)
+    headers = signedHeaders("warmup=1")
+    if not signed:
+        headers = {"Content-Type": headers["Content-Type"]}
+    with Client(app.app) as client:
+        resp = client.http.post("/", headers=headers, body="warmup=1")
+    assert resp.status_code == status
+    assert (False in warmup.PRIMED) is signed
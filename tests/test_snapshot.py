@@ -0,0 +1,47 @@
+from chalicelib.audit import Role, UserGrants
+from chalicelib.snapshot import (
+    decodeSnapshot,
+    diffSnapshots,
+    displayDiff,
+    encodeSnapshot,
+    makeSnapshot,
+)
+
+
+def users(grants):
+    return {
+        user: UserGrants(bucket, 1, [Role(1, r) for r in roles])
+        for user, (bucket, roles) in grants.items()
+    }
+
+
+def test_snapshot_round_trip():
+    snap = makeSnapshot(users({"bob": ["regular", ["ReadOnly"]]}))
+    assert decodeSnapshot(encodeSnapshot(snap)) == snap
+
+
+def test_diffSnapshots():
+    old = makeSnapshot(
+        users(
+            {
+                "alice": ["regular", ["ReadOnly", "AdminUser"]],
+                "bob": ["regular", ["ReadOnly"]],
+                "carol": ["never", ["ReadOnly"]],
+            }
+        )
+    )
+    new = makeSnapshot(
+        users(
+            {
+                "alice": ["regular", ["ReadOnly", "PowerUser"]],
+                "bob": ["intermittent", ["ReadOnly"]],
+                "dave": ["regular", ["ReadOnly"]],
+            }
+        )
+    )
+    diff = diffSnapshots(old, new)
+    assert diff["added"] == {"dave": ["ReadOnly"]}
+    assert diff["removed"] == {"carol": ["ReadOnly"]}
+    assert diff["changed"] == {"alice": [["PowerUser"], ["AdminUser"]]}
+    assert diff["buckets"] == {"bob": ["regular", "intermittent"]}
+    assert displayDiff(diffSnapshots(new, new)) == ""
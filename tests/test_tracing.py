@@ -0,0 +1,22 @@
+import chalicelib.tracing as tracing
+
+
+def test_spans_are_recorded_per_stage():
+    tracing.startTrace("handler", "cid")
+    with tracing.span("db_query"):
+        pass
+    with tracing.span("db_query"):
+        pass
+    tracing.addStage("sns_hop", 0.25)
+    rec = tracing.endTrace()
+    assert rec["handler"] == "handler"
+    assert rec["correlationid"] == "cid"
+    assert rec["db_query_count"] == 2
+    assert rec["sns_hop_ms"] == 250.0
+    assert tracing.current() is None
+
+
+def test_span_without_trace_is_a_noop():
+    with tracing.span("db_query"):
+        pass
+    assert tracing.endTrace() is None
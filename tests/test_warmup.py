@@ -0,0 +1,48 @@
+import pymysql
+
+import chalicelib.permissions
+import chalicelib.slackrequest as slackrequest
+import chalicelib.warmup as warmup
+from chaimaccountaudit.fakes import FakeDB
+
+
+def test_permissions_reused_and_pinged(permissions, monkeypatch):
+    created = []
+
+    def build(spath):
+        created.append(permissions(sid=FakeDB(), rwsid=FakeDB()))
+        return created[-1]
+
+    monkeypatch.setattr(chalicelib.permissions, "Permissions", build)
+    monkeypatch.setattr(warmup, "SHARED", {})
+    first = warmup.permissions("/x/")
+    second = warmup.permissions("/x/")
+    assert first is second
+    assert len(created) == 1
+    assert first.sid.pings == 1
+    assert first.rwsid.pings == 1
+    assert first.rwsid.rollbacks == 1
+
+
+def test_kept_read_connections_autocommit(permissions, monkeypatch):
+    connects = []
+    monkeypatch.setattr(pymysql, "connect", lambda **kwargs: connects.append(kwargs))
+    monkeypatch.delenv("DBIAMAUTH", raising=False)
+    pms = permissions()
+    pms.connectDB()
+    pms.replicaDB("replica")
+    sid, rwsid, replica = connects
+    assert sid["user"] == "ro" and sid["autocommit"] is True
+    assert rwsid["user"] == "rw" and rwsid["autocommit"] is False
+    assert replica["host"] == "replica" and replica["autocommit"] is True
+
+
+def test_prime_skips_when_warm(monkeypatch):
+    monkeypatch.setattr(warmup, "SHARED", {"sns": object()})
+    monkeypatch.setattr(warmup, "PRIMED", {})
+    monkeypatch.setattr(slackrequest, "SECRET", {"secret": "x"})
+    report = warmup.prime(full=False)
+    assert report["cold"] is True
+    report = warmup.prime(full=False)
+    assert report["cold"] is False
+    assert report["ms"] == 0